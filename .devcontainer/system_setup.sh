@@ -16,3 +16,6 @@ pip install --upgrade pip
 
 echo "Setting up package in dev mode..."
 pip install -e .
+
+echo "Downloading NLTK corpora..."
+python -m nltk.downloader stopwords wordnet
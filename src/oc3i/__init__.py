@@ -1,7 +1,18 @@
 # src/oc3i/__init__.py
 __version__ = "0.1.0"
 
-from .coder import Coder
-from .cleaner import Cleaner
+__all__ = ["Coder", "Cleaner"]
 
-__all__ = ["Coder", "Cleaner"]
\ No newline at end of file
+
+def __getattr__(name):
+    # Coder and Cleaner are imported on first use, so that importing oc3i, for
+    # its version or a single module, does not load their dependencies
+    if name == "Coder":
+        from .coder import Coder
+
+        return Coder
+    if name == "Cleaner":
+        from .cleaner import Cleaner
+
+        return Cleaner
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,652 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the coding pipeline.
+
+Generates synthetic vacancy data from the bundled dictionaries and example
+vacancies, codes it with a Coder and reports how long each stage took, as
+timed by the Coder's own stats. Results are written as JSON, so that runs on different commits can
+be compared, for example:
+
+    python -m oc3i.benchmark --rows 1000 100000 --json benchmark.json
+"""
+import sys
+import json
+import time
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+from argparse import ArgumentParser
+from itertools import repeat
+
+from oc3i import __version__, cleaner
+from oc3i.coder import Coder, lookup_dir, get_example_file
+
+config = cleaner.load_config()
+
+# Stages of the pipeline that are timed, in the order they run
+STAGES = ["clean", "exact", "tfidf", "fuzzy", "shape", "io"]
+
+# Default numbers of rows to benchmark
+DEFAULT_ROWS = [1000, 10000]
+
+# Fraction a stage can slow down by before it is reported as a regression
+REGRESSION_TOLERANCE = 0.2
+
+# Seconds a stage must slow down by to be reported, ignoring timer noise
+REGRESSION_MIN_SECONDS = 0.01
+
+# Default number of records coded one at a time to time single record latency
+LATENCY_RECORDS = 1000
+
+# Percentiles of single record latency reported
+LATENCY_PERCENTILES = [50, 99]
+
+# Seconds a latency percentile must slow down by to be reported
+REGRESSION_MIN_LATENCY = 0.0001
+
+# Num. records whose TF-IDF candidates are found to time ranking
+RANKING_RECORDS = 5000
+
+# Num. descriptions synthetic_vacancies makes at once, bounding the memory
+# taken by their words
+SYNTHETIC_CHUNK_SIZE = 100000
+
+
+def synthetic_vacancies(
+    n_rows,
+    scheme="soc",
+    duplicate_rate=0.5,
+    description_words=30,
+    seed=0,
+    lookup_dir=lookup_dir,
+):
+    """
+    Generates a DataFrame of made up vacancies. Titles are drawn from the
+    scheme's titles and the example vacancies, in a mix of cases, and
+    descriptions are random words from the scheme's buckets and the example
+    descriptions.
+
+    Keyword arguments:
+        n_rows -- num. rows to generate
+        scheme -- scheme whose dictionaries to draw titles and words from
+        duplicate_rate -- fraction of rows that repeat an earlier row, 0 to 1
+        description_words -- num. words in each description, 0 for none
+        seed -- seed for the random number generator
+        lookup_dir -- directory holding the scheme dictionaries
+    Returns:
+        pandas DataFrame with job_title, job_description and job_sector columns
+    """
+    if not 0 <= duplicate_rate < 1:
+        raise ValueError("duplicate_rate must be at least 0 and less than 1")
+    rng = np.random.default_rng(seed)
+    example = pd.read_csv(get_example_file()).fillna("")
+
+    with open(lookup_dir / f"{scheme}/titles_{scheme}.json", "r") as infile:
+        scheme_titles = json.load(infile)
+    titles = np.array(
+        [title for code_titles in scheme_titles.values() for title in code_titles]
+        + example["job_title"].to_list(),
+        dtype=object,
+    )
+    buckets = pd.read_json(lookup_dir / f"{scheme}/buckets_{scheme}.json", dtype=str)
+    words = np.array(
+        " ".join(buckets.iloc[:, 1].to_list() + example["job_description"].to_list())
+        .split(),
+        dtype=object,
+    )
+    sectors = np.array(example["job_sector"].to_list() + [""], dtype=object)
+
+    n_unique = max(1, n_rows - round(n_rows * duplicate_rate)) if n_rows else 0
+    unique_titles = titles[rng.integers(len(titles), size=n_unique)]
+    cases = rng.integers(3, size=n_unique)
+    unique_titles[cases == 1] = [t.title() for t in unique_titles[cases == 1]]
+    unique_titles[cases == 2] = [t.upper() for t in unique_titles[cases == 2]]
+    descriptions = np.empty(n_unique, dtype=object)
+    for start in range(0, n_unique, SYNTHETIC_CHUNK_SIZE):
+        stop = min(start + SYNTHETIC_CHUNK_SIZE, n_unique)
+        chunk_words = words[
+            rng.integers(len(words), size=(stop - start, description_words))
+        ]
+        descriptions[start:stop] = [" ".join(row) for row in chunk_words]
+    unique_df = pd.DataFrame(
+        {
+            "job_title": unique_titles,
+            "job_description": descriptions,
+            "job_sector": sectors[rng.integers(len(sectors), size=n_unique)],
+        }
+    )
+
+    # Every unique row once, then repeats of them, in a random order
+    rows = np.concatenate(
+        [np.arange(n_unique), rng.integers(max(n_unique, 1), size=n_rows - n_unique)]
+    )
+    rng.shuffle(rows)
+    return unique_df.iloc[rows].reset_index(drop=True)
+
+
+def time_stages(
+    commCoder,
+    record_df,
+    title_column="job_title",
+    sector_column="job_sector",
+    description_column="job_description",
+):
+    """
+    Codes a DataFrame with Coder.code_data_frame, without deduplicating, and
+    reports how long each stage took from the Coder's stats, followed by
+    writing and reading the coded data back. The Coder's stats are reset.
+
+    Keyword arguments:
+        commCoder -- Coder to benchmark
+        record_df -- DataFrame of records to code
+        title_column, sector_column, description_column -- columns to code
+    Returns:
+        dict of stage name to seconds taken, and the total, which also
+        includes the time code_data_frame spent between stages
+    """
+    # Cleaning from scratch each time, so that runs are comparable
+    commCoder.cl.reset()
+    commCoder.reset_stats()
+    tic = time.perf_counter()
+    coded_df = commCoder.code_data_frame(
+        record_df.copy(),
+        title_column=title_column,
+        sector_column=sector_column,
+        description_column=description_column,
+        deduplicate=False,
+        verbose=False,
+    )
+    coding = time.perf_counter() - tic
+    stages = commCoder.stats()["stages"]
+    timings = {stage: stages[stage]["seconds"] for stage in STAGES if stage in stages}
+
+    tic = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_file = Path(tmp_dir) / "output.csv"
+        coded_df.to_csv(out_file, index=False, encoding="utf-8")
+        pd.read_csv(out_file)
+    timings["io"] = time.perf_counter() - tic
+
+    timings["total"] = coding + timings["io"]
+    return timings
+
+
+def time_single_records(
+    commCoder,
+    record_df,
+    title_column="job_title",
+    sector_column="job_sector",
+    description_column="job_description",
+):
+    """
+    Times Coder.code_record on each record in turn, as a service coding
+    records as they arrive would
+
+    Keyword arguments:
+        commCoder -- Coder to benchmark
+        record_df -- DataFrame of records to code
+        title_column, sector_column, description_column -- columns to code,
+            sector and description being left out when None
+    Returns:
+        dict of the latency percentiles, e.g. "p50", and the mean, in seconds
+    """
+    columns = [
+        record_df[col].fillna("") if col is not None else repeat(None)
+        for col in [title_column, sector_column, description_column]
+    ]
+    # Cleaning from scratch, so that runs are comparable
+    commCoder.cl.reset()
+    latencies = []
+    for title, sector, description in zip(*columns):
+        tic = time.perf_counter()
+        commCoder.code_record(title, sector, description)
+        latencies.append(time.perf_counter() - tic)
+    latencies = np.array(latencies)
+    timings = {
+        f"p{percentile}": float(np.percentile(latencies, percentile))
+        for percentile in LATENCY_PERCENTILES
+    }
+    timings["mean"] = float(latencies.mean())
+    return timings
+
+
+def time_threads(
+    commCoder,
+    record_df,
+    thread_counts,
+    title_column="job_title",
+    sector_column="job_sector",
+    description_column="job_description",
+):
+    """
+    Times coding a data frame in threaded batch mode with different numbers
+    of threads, all sharing one Coder
+
+    Keyword arguments:
+        commCoder -- Coder to benchmark
+        record_df -- DataFrame of records to code
+        thread_counts -- list of num. threads to time, the first being the
+            baseline speedups are measured against, usually 1
+        title_column, sector_column, description_column -- columns to code
+    Returns:
+        list of dicts of the num. threads, seconds taken and speedup
+    """
+    results = []
+    for threads in thread_counts:
+        # Cleaning from scratch, so that runs are comparable
+        commCoder.cl.reset()
+        tic = time.perf_counter()
+        commCoder.code_data_frame(
+            record_df.copy(),
+            title_column=title_column,
+            sector_column=sector_column,
+            description_column=description_column,
+            threads=threads,
+        )
+        seconds = time.perf_counter() - tic
+        results.append(
+            {
+                "threads": threads,
+                "seconds": seconds,
+                "speedup": results[0]["seconds"] / seconds if results else 1.0,
+            }
+        )
+    return results
+
+
+def scaled_tfidf_matrix(tfidf_matrix, copies, seed=0):
+    """
+    Makes a scheme's TF-IDF matrix copies times larger, to time matching
+    against larger schemes. Each copy of a bucket keeps a random half of the
+    bucket's terms.
+
+    Keyword arguments:
+        tfidf_matrix -- sparse matrix of TF-IDF vectors, one row per bucket
+        copies -- num. copies of each bucket
+        seed -- seed for the random number generator
+    Returns:
+        scipy.sparse CSR matrix with copies rows per bucket
+    """
+    import scipy.sparse as sp
+
+    matrix = sp.csr_matrix(tfidf_matrix)
+    if copies == 1:
+        return matrix
+    rng = np.random.default_rng(seed)
+    scaled = matrix[np.repeat(np.arange(matrix.shape[0]), copies)]
+    scaled.data[rng.random(scaled.nnz) < 0.5] = 0
+    scaled.eliminate_zeros()
+    return scaled
+
+
+def time_ranking(
+    commCoder,
+    record_df,
+    scales,
+    seed=0,
+    title_column="job_title",
+    description_column="job_description",
+):
+    """
+    Times finding the TF-IDF candidates of records with and without the
+    ranking prefilter of scoring.TfidfIndex, against the scheme's buckets and
+    against schemes made larger by scaled_tfidf_matrix
+
+    Keyword arguments:
+        commCoder -- Coder whose scheme to time
+        record_df -- DataFrame of records to find candidates for
+        scales -- list of num. copies of each bucket to time, 1 for the scheme
+            as it is
+        seed -- seed for scaled_tfidf_matrix
+        title_column, description_column -- columns of text to match
+    Returns:
+        list of dicts of the num. buckets, fraction of the buckets each record
+        shares terms with on average, and seconds taken with the prefilter and
+        without it
+    """
+    from sklearn.preprocessing import normalize
+    from oc3i.scoring import TfidfIndex
+
+    model = commCoder._model
+    texts = commCoder.cl.clean_series(
+        record_df[title_column].fillna("") + " " + record_df[description_column].fillna(""),
+        known_only=False,
+    )
+    vectors = normalize(model.tfidf.transform(texts))
+    results = []
+    for copies in scales:
+        index = TfidfIndex(scaled_tfidf_matrix(model.tfidf_matrix, copies, seed))
+        result = {
+            "buckets": index.n_buckets,
+            "density": index.scores(vectors).nnz / (len(texts) * index.n_buckets),
+        }
+        for name, prefilter in [("prefilter", True), ("no_prefilter", False)]:
+            tic = time.perf_counter()
+            index.top_n(vectors, prefilter=prefilter)
+            result[name] = time.perf_counter() - tic
+        results.append(result)
+    return results
+
+
+def git_commit():
+    """The current git commit of the package source, if it is in a repository"""
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def run_benchmark(
+    rows=DEFAULT_ROWS,
+    scheme="soc",
+    output="single",
+    duplicate_rate=0.5,
+    description_words=30,
+    seed=0,
+    latency_records=LATENCY_RECORDS,
+    thread_counts=None,
+    ranking_scales=None,
+):
+    """
+    Times each stage of coding synthetic data sets of different sizes, and
+    the latency of coding single records
+
+    Keyword arguments:
+        rows -- list of num. rows to benchmark
+        scheme, output -- settings for the Coder
+        duplicate_rate, description_words, seed -- settings for
+            synthetic_vacancies
+        latency_records -- num. distinct records to code one at a time, 0 to
+            skip timing single records
+        thread_counts -- list of num. threads to also time each size with in
+            threaded batch mode, see time_threads (default None, not timed)
+        ranking_scales -- list of num. copies of each bucket in the schemes to
+            time finding TF-IDF candidates against, see time_ranking (default
+            None, not timed)
+    Returns:
+        dict of the settings, environment, a list of results, one per
+        number of rows, holding the seconds taken by each stage, and the
+        latency percentiles of single records, with a title only and with a
+        sector and description too. With thread_counts, each result also
+        holds the seconds taken and speedup with each num. threads. With
+        ranking_scales, the timings of finding TF-IDF candidates too.
+    """
+    tic = time.perf_counter()
+    commCoder = Coder(scheme=scheme, output=output)
+    startup = time.perf_counter() - tic
+
+    results = []
+    for n_rows in rows:
+        record_df = synthetic_vacancies(
+            n_rows,
+            scheme=scheme,
+            duplicate_rate=duplicate_rate,
+            description_words=description_words,
+            seed=seed,
+        )
+        timings = time_stages(commCoder, record_df)
+        print(
+            f"{n_rows} rows: "
+            + ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in timings.items())
+        )
+        results.append(
+            {
+                "rows": n_rows,
+                "seconds": timings,
+                "rows_per_second": n_rows / timings["total"] if timings["total"] else None,
+            }
+        )
+        if thread_counts:
+            results[-1]["threads"] = time_threads(commCoder, record_df, thread_counts)
+            print(
+                f"{n_rows} rows in threads: "
+                + ", ".join(
+                    f"{entry['threads']} {entry['seconds']:.3f}s "
+                    f"(x{entry['speedup']:.2f})"
+                    for entry in results[-1]["threads"]
+                )
+            )
+
+    latency = {}
+    if latency_records:
+        record_df = synthetic_vacancies(
+            latency_records,
+            scheme=scheme,
+            duplicate_rate=0,
+            description_words=description_words,
+            seed=seed,
+        )
+        latency = {
+            "records": latency_records,
+            "title": time_single_records(
+                commCoder, record_df, sector_column=None, description_column=None
+            ),
+            "full": time_single_records(commCoder, record_df),
+        }
+        for kind in ["title", "full"]:
+            print(
+                f"Single records, {kind}: "
+                + ", ".join(
+                    f"{stat} {seconds * 1000:.3f}ms"
+                    for stat, seconds in latency[kind].items()
+                )
+            )
+
+    ranking = []
+    if ranking_scales:
+        record_df = synthetic_vacancies(
+            RANKING_RECORDS,
+            scheme=scheme,
+            duplicate_rate=0,
+            description_words=description_words,
+            seed=seed,
+        )
+        ranking = time_ranking(commCoder, record_df, ranking_scales, seed=seed)
+        for entry in ranking:
+            print(
+                f"TF-IDF candidates of {RANKING_RECORDS} records among "
+                f"{entry['buckets']} buckets ({entry['density']:.0%} touched): "
+                f"{entry['prefilter']:.3f}s, {entry['no_prefilter']:.3f}s "
+                "without the ranking prefilter"
+            )
+
+    return {
+        "version": __version__,
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "settings": {
+            "scheme": scheme,
+            "output": output,
+            "duplicate_rate": duplicate_rate,
+            "description_words": description_words,
+            "seed": seed,
+        },
+        "startup_seconds": startup,
+        "results": results,
+        "latency": latency,
+        "ranking": ranking,
+    }
+
+
+def compare_reports(baseline, report, tolerance=REGRESSION_TOLERANCE):
+    """
+    Compares two benchmark reports, as returned by run_benchmark
+
+    Keyword arguments:
+        baseline -- earlier report to compare against
+        report -- new report
+        tolerance -- fraction a stage can slow down by before it is reported
+    Returns:
+        list of (rows, stage, baseline seconds, new seconds) for every stage
+        that got slower by more than the tolerance, and by more than
+        REGRESSION_MIN_SECONDS, for sizes in both reports. Single record
+        latency percentiles that got slower by more than the tolerance, and
+        by more than REGRESSION_MIN_LATENCY, are included as stages such as
+        "latency full p99", with the num. records timed as the rows, and
+        threaded timings as stages such as "4 threads".
+    """
+    baseline_results = {result["rows"]: result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        if result["rows"] not in baseline_results:
+            continue
+        old_seconds = baseline_results[result["rows"]]["seconds"]
+        for stage, seconds in result["seconds"].items():
+            if stage not in old_seconds:
+                continue
+            slower = seconds - old_seconds[stage]
+            if (
+                slower > old_seconds[stage] * tolerance
+                and slower > REGRESSION_MIN_SECONDS
+            ):
+                regressions.append((result["rows"], stage, old_seconds[stage], seconds))
+
+        old_threads = {
+            entry["threads"]: entry["seconds"]
+            for entry in baseline_results[result["rows"]].get("threads", [])
+        }
+        for entry in result.get("threads", []):
+            old = old_threads.get(entry["threads"])
+            if old is None:
+                continue
+            slower = entry["seconds"] - old
+            if slower > old * tolerance and slower > REGRESSION_MIN_SECONDS:
+                regressions.append(
+                    (result["rows"], f"{entry['threads']} threads", old, entry["seconds"])
+                )
+
+    old_latency = baseline.get("latency") or {}
+    latency = report.get("latency") or {}
+    for kind in ["title", "full"]:
+        if kind not in old_latency or kind not in latency:
+            continue
+        for stat, seconds in latency[kind].items():
+            old = old_latency[kind].get(stat)
+            if old is None:
+                continue
+            if seconds - old > old * tolerance and seconds - old > REGRESSION_MIN_LATENCY:
+                regressions.append(
+                    (latency["records"], f"latency {kind} {stat}", old, seconds)
+                )
+    return regressions
+
+
+def parse_cli_input():
+    arg_parser = ArgumentParser(description="Benchmark the occupation coder")
+    arg_parser.add_argument(
+        "--rows",
+        help="Numbers of rows to benchmark, up to 10 million",
+        type=int,
+        nargs="+",
+        default=DEFAULT_ROWS,
+    )
+    arg_parser.add_argument(
+        "--scheme", help="Scheme to code to", default=config["user"]["scheme"]
+    )
+    arg_parser.add_argument(
+        "--output",
+        help="Type of Outputs: single or multi",
+        default=config["user"]["output"],
+    )
+    arg_parser.add_argument(
+        "--duplicate_rate",
+        help="Fraction of rows that repeat an earlier row",
+        type=float,
+        default=0.5,
+    )
+    arg_parser.add_argument(
+        "--description_words",
+        help="Number of words in each job description",
+        type=int,
+        default=30,
+    )
+    arg_parser.add_argument(
+        "--seed", help="Seed for generating data", type=int, default=0
+    )
+    arg_parser.add_argument(
+        "--latency_records",
+        help="Number of records to code one at a time for single record "
+        "latency, 0 to skip",
+        type=int,
+        default=LATENCY_RECORDS,
+    )
+    arg_parser.add_argument(
+        "--threads",
+        help="Numbers of threads to also time coding with in threaded batch "
+        "mode, e.g. 1 2 4 8, speedups being relative to the first",
+        type=int,
+        nargs="+",
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--ranking_scales",
+        help="Numbers of copies of each bucket in larger schemes to time finding "
+        "TF-IDF candidates against, with and without the ranking prefilter, "
+        "e.g. 1 10 40",
+        type=int,
+        nargs="+",
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--json", help="File to write results to", default="benchmark.json"
+    )
+    arg_parser.add_argument(
+        "--compare",
+        help="Earlier results file to check for regressions against",
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--tolerance",
+        help="Fraction a stage can slow down by before it counts as a regression",
+        type=float,
+        default=REGRESSION_TOLERANCE,
+    )
+    return arg_parser.parse_args()
+
+
+def main():
+    args = parse_cli_input()
+    report = run_benchmark(
+        rows=args.rows,
+        scheme=args.scheme,
+        output=args.output,
+        duplicate_rate=args.duplicate_rate,
+        description_words=args.description_words,
+        seed=args.seed,
+        latency_records=args.latency_records,
+        thread_counts=args.threads,
+        ranking_scales=args.ranking_scales,
+    )
+    with open(args.json, "w") as outfile:
+        json.dump(report, outfile, indent=2)
+    print("Benchmark results written to:", args.json)
+
+    if args.compare:
+        with open(args.compare, "r") as infile:
+            baseline = json.load(infile)
+        regressions = compare_reports(baseline, report, args.tolerance)
+        for n_rows, stage, old_seconds, seconds in regressions:
+            print(
+                f"Regression: {stage} on {n_rows} rows took {seconds:.4g}s, "
+                f"was {old_seconds:.4g}s"
+            )
+        if regressions:
+            sys.exit(1)
+        print("No regressions against:", args.compare)
+
+
+if __name__ == "__main__":
+    main()
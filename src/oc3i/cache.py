@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of coded results.
+
+Datasets coded again and again, such as daily extracts of vacancies, repeat
+most of their records from one run to the next. The cache keeps each record's
+coded result in a SQLite file in a local directory, keyed by its cleaned
+title, sector and description, and by the settings and dictionaries it was
+coded with, so a later run, or another process, can reuse it instead of
+matching the record again. Changing a scheme's dictionaries changes its
+Coder's dictionary_version, so results coded with the old ones are no longer
+found, and are evicted in time as the least recently used.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from pathlib import Path
+
+# Name of the cache's file, in the directory it is kept in
+CACHE_FILE = "results.sqlite"
+
+# Most results kept in the cache before the least recently used are evicted
+CACHE_SIZE = 1000000
+
+# Fraction of the cache size evicted down to once it is full, so that eviction
+# does not run on every insert
+EVICT_TO = 0.9
+
+# Most keys in one SQL statement, below SQLite's limit on parameters
+BATCH_SIZE = 500
+
+
+class ResultCache:
+    def __init__(self, path, max_entries=CACHE_SIZE):
+        """
+        Keyword arguments:
+        path:str
+            directory to keep the cache in, created if missing, or the path of
+            the cache's SQLite file
+        max_entries:int
+            most results kept, the least recently used being evicted beyond it
+        """
+        path = Path(path).expanduser()
+        if path.suffix != ".sqlite":
+            path = path / CACHE_FILE
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._pid = None
+        self._count = None
+        # The connection is shared by threads, one statement at a time
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Connections cannot be pickled, each process opens its own
+        state = self.__dict__.copy()
+        state.update(_connection=None, _pid=None, _count=None, _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """
+        Helper, the connection to the cache's file, opened on first use in
+        each process, as a connection cannot be used across a fork
+
+        Returns: sqlite3 Connection
+        """
+        if self._connection is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False
+            )
+            # Write-ahead logging lets processes read while another writes
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key BLOB PRIMARY KEY, result TEXT NOT NULL, used REAL NOT NULL) "
+                "WITHOUT ROWID"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS results_used ON results (used)"
+            )
+            connection.commit()
+            self._connection = connection
+            self._pid = os.getpid()
+            self._count = None
+        return self._connection
+
+    @staticmethod
+    def key(namespace, clean_title, all_text):
+        """
+        The key a record's result is cached under
+
+        Keyword arguments:
+            namespace -- string identifying the scheme, settings and
+                         dictionaries the record was coded with
+            clean_title -- cleaned job title
+            all_text -- cleaned title, sector and description joined together
+        Returns:
+            bytes, a digest of the three
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        for item in (namespace, clean_title, all_text):
+            digest.update(item.encode("utf-8") + b"\0")
+        return digest.digest()
+
+    def get_many(self, keys):
+        """
+        Looks up the cached results for a list of keys, marking those found
+        as recently used
+
+        Keyword arguments:
+            keys -- list of keys, from ResultCache.key
+        Returns:
+            dict of key to cached result, for the keys that were found
+        """
+        found = {}
+        with self._lock:
+            connection = self._connect()
+            unique = list(dict.fromkeys(keys))
+            for start in range(0, len(unique), BATCH_SIZE):
+                batch = unique[start : start + BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                for key, result in connection.execute(
+                    f"SELECT key, result FROM results WHERE key IN ({placeholders})",
+                    batch,
+                ):
+                    found[key] = json.loads(result)
+            if found:
+                now = time.time()
+                connection.executemany(
+                    "UPDATE results SET used = ? WHERE key = ?",
+                    ((now, key) for key in found),
+                )
+                connection.commit()
+            hits = sum(key in found for key in keys)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return found
+
+    def put_many(self, items):
+        """
+        Adds results to the cache, evicting the least recently used once it
+        holds more than max_entries
+
+        Keyword arguments:
+            items -- list of (key, result) pairs, results being JSON-able
+        """
+        if not items:
+            return
+        with self._lock:
+            connection = self._connect()
+            now = time.time()
+            connection.executemany(
+                "INSERT OR REPLACE INTO results (key, result, used) VALUES (?, ?, ?)",
+                ((key, json.dumps(result), now) for key, result in items),
+            )
+            if self._count is None:
+                (self._count,) = connection.execute(
+                    "SELECT COUNT(*) FROM results"
+                ).fetchone()
+            else:
+                self._count += len(items)
+            if self._count > self.max_entries:
+                # Other processes may have added to or evicted from the cache
+                (self._count,) = connection.execute(
+                    "SELECT COUNT(*) FROM results"
+                ).fetchone()
+                excess = self._count - int(self.max_entries * EVICT_TO)
+                if self._count > self.max_entries and excess > 0:
+                    connection.execute(
+                        "DELETE FROM results WHERE key IN "
+                        "(SELECT key FROM results ORDER BY used LIMIT ?)",
+                        (excess,),
+                    )
+                    self._count -= excess
+            connection.commit()
+
+    def clear(self):
+        """Removes every result from the cache"""
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM results")
+            connection.commit()
+            self._count = 0
+
+    def info(self):
+        """
+        Returns:
+            dict of the cache's file, num. results held, its size limit, and
+            the hits, misses and hit rate of lookups made through this object
+        """
+        with self._lock:
+            (entries,) = self._connect().execute(
+                "SELECT COUNT(*) FROM results"
+            ).fetchone()
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "path": str(self.path),
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else None,
+        }
+
+    def close(self):
+        """Closes this process's connection to the cache"""
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
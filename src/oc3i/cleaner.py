@@ -1,25 +1,56 @@
 # -*- coding: utf-8 -*-
 
-import nltk
 import re
 import json
 import yaml
 
-from nltk.corpus import stopwords
 from pathlib import Path
+from functools import lru_cache
+from itertools import chain
 
-# Ensure required NLTK corpora are downloaded
-resources = ["stopwords", "wordnet"]
-for res in resources:
-    try:
-        nltk.data.find(f"corpora/{res}")
-    except LookupError:
-        nltk.download(res, quiet=True)
+# NLTK corpora needed for advanced cleaning. NLTK is slow to import, so it is
+# only loaded once a Cleaner needs it, and the corpora are never downloaded
+# automatically
+NLTK_RESOURCES = ["stopwords", "wordnet"]
 
-STOPWORDS = stopwords.words("english")
 
-# If we put this here we only have to instantiate it once...
-wnl = nltk.WordNetLemmatizer()
+@lru_cache(maxsize=None)
+def load_nltk():
+    """
+    Imports NLTK and loads the stopwords and lemmatiser used for advanced
+    cleaning, the first time they are needed
+
+    Raises: LookupError, naming any required corpora that are not installed
+    Returns: tuple of the English stopwords as a list and as a set, and a
+        WordNetLemmatizer
+    """
+    import nltk
+
+    missing = []
+    for res in NLTK_RESOURCES:
+        try:
+            nltk.data.find(f"corpora/{res}")
+        except LookupError:
+            missing.append(res)
+    if missing:
+        raise LookupError(
+            f"NLTK corpora not found: {', '.join(missing)}. Install them with "
+            f"'python -m nltk.downloader {' '.join(missing)}'"
+        )
+
+    from nltk.corpus import stopwords
+
+    stopwords_list = stopwords.words("english")
+    return stopwords_list, set(stopwords_list), nltk.WordNetLemmatizer()
+
+
+def __getattr__(name):
+    """Loads the NLTK based module attributes, STOPWORDS and wnl, on first use"""
+    resources = {"STOPWORDS": 0, "STOPWORDS_SET": 1, "wnl": 2}
+    if name in resources:
+        return load_nltk()[resources[name]]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 # List of terms we want to NOT lemmatize for some reason
 KEEP_AS_IS = [
@@ -40,8 +71,19 @@ KEEP_AS_IS = [
     "years",
 ]
 
+# Patterns replaced by spaces in basic_clean: HTML tags, and then each run of
+# anything but lowercase letters, which leaves the letters single spaced
+PATTERN_HTML = re.compile(r"<.*?>")
+PATTERN_NON_LETTERS = re.compile(r"[^a-z]+")
+
+# Texts longer than this (e.g. job descriptions) bypass the simple_clean cache,
+# so that its memory use stays predictable
+CACHE_MAX_LENGTH = 256
+
+
+@lru_cache(maxsize=None)
 def load_config():
-    """parse configuration file
+    """parse configuration file, once per process
 
     Returns
     -------
@@ -63,39 +105,139 @@ lookup_dir = Path(config["dirs"]["lookup_dir"])
 ### Would have suggested just putting into simple_clean() but that works row by row (lots of closing/reopening files).
 
 
+def basic_clean(text: str):
+    """
+    The part of cleaning that is the same for every scheme: strips HTML tags,
+    lowercases, and keeps only single spaced letters
+
+    Keyword arguments:
+        text -- String representing human freetext to clean up
+    """
+    if type(text) is not str:
+        raise TypeError("simple_clean expects a string")
+    text = PATTERN_HTML.sub(" ", text)  # Clean out any HTML tags
+    # Keep only letters, single spaced
+    return PATTERN_NON_LETTERS.sub(" ", text.lower()).strip()
+
+
+def _distinct(texts):
+    """
+    Helper, the distinct values of a pandas Series of strings
+
+    Raises: TypeError, if any value is not a string
+    Returns: tuple of the position of each value in the distinct values, and
+        the distinct values as a Series
+    """
+    # pandas is slow to import, and only needed for cleaning whole Series
+    import pandas as pd
+
+    codes, uniques = pd.factorize(texts)
+    uniques = pd.Series(uniques, dtype=object)
+    if (codes < 0).any() or not uniques.map(type).eq(str).all():
+        raise TypeError("clean_series expects a Series of strings")
+    return codes, uniques
+
+
+def basic_clean_series(texts):
+    """
+    Vectorised basic_clean, over a pandas Series of strings. Each distinct
+    string is cleaned once.
+
+    Keyword arguments:
+        texts -- pandas Series of strings
+    Returns:
+        pandas Series of cleaned strings, aligned with texts
+    """
+    import pandas as pd
+
+    codes, uniques = _distinct(texts)
+    cleaned = (
+        uniques.str.replace(PATTERN_HTML, " ", regex=True)
+        .str.lower()
+        .str.replace(PATTERN_NON_LETTERS, " ", regex=True)
+        .str.strip()
+    )
+    return pd.Series(cleaned.to_numpy()[codes], index=texts.index, dtype=object)
+
+
 class Cleaner:
-    def __init__(self, scheme=config["user"]["scheme"]):
+    def __init__(
+        self,
+        scheme=config["user"]["scheme"],
+        cache_size=0,
+        cache_max_length=CACHE_MAX_LENGTH,
+    ):
         """
         set scheme and load known_words json
         Parameters
         ----------
         scheme:str
             string containing scheme
+        cache_size:int
+            number of cleaned texts to keep in simple_clean's least recently
+            used cache, 0 to switch caching off
+        cache_max_length:int
+            texts longer than this many characters are never cached
         """
 
         self.scheme = scheme
         self.advanced = True
+        self.cache_max_length = cache_max_length
+        self._cached_clean = (
+            lru_cache(maxsize=cache_size)(self._simple_clean) if cache_size else None
+        )
+
+        # Files the known words and synonyms are loaded from, if found
+        self.dictionary_files = [
+            lookup_dir / f"{scheme.lower()}/known_words_dict.json",
+            lookup_dir / f"{scheme.lower()}/expand_dict.json",
+        ]
 
         try:
-            with open(
-                lookup_dir / f"{scheme.lower()}/known_words_dict.json", "r"
-            ) as infile:
+            with open(self.dictionary_files[0], "r") as infile:
                 self.known_words_dict = json.load(infile)
-            with open(lookup_dir / f"{scheme.lower()}/expand_dict.json", "r") as infile:
+            with open(self.dictionary_files[1], "r") as infile:
                 self.expand_dict = json.load(infile)
         except FileNotFoundError:
             self.advanced = False
+            self.dictionary_files = []
+
+        # Lookup tables from raw token to final token (None when it is dropped),
+        # one for each known_only setting. Tokens are added as they are first
+        # met, so NLTK is only loaded once there is text to clean
+        self._token_tables = {True: {}, False: {}}
+        if self.advanced:
+            self._known_words = set(self.known_words_dict)
 
     def lemmatize(self, string):
         """Helper, handles generating lemmas. Uses NLTK's WordNetLemmatizer
 
         Returns: List of lemmatised tokens for an inputted string
         """
+        _, _, lemmatizer = load_nltk()
         return [
-            wnl.lemmatize(token) if token not in KEEP_AS_IS else token
+            lemmatizer.lemmatize(token) if token not in KEEP_AS_IS else token
             for token in string.split()
         ]
 
+    def _normalise_token(self, token, known_only):
+        """
+        Helper, lemmatises a single token, replaces it with a known synonym and
+        optionally drops it if it is not a known, non-stopword job title word.
+        The result is stored in the token table for known_only.
+
+        Returns: Final token, or None if the token is dropped
+        """
+        _, stopwords_set, lemmatizer = load_nltk()
+        result = lemmatizer.lemmatize(token) if token not in KEEP_AS_IS else token
+        result = self.expand_dict.get(result, result)
+        if known_only and (
+            result not in self._known_words or result in stopwords_set
+        ):
+            result = None
+        self._token_tables[known_only][token] = result
+        return result
+
     def simple_clean(self, text: str, advanced=None, known_only=True):
         """
         Takes string as input, cleans, lowercases, tokenizes and lemmatises,
@@ -117,27 +259,116 @@ class Cleaner:
         if type(text) is not str:
             raise TypeError("simple_clean expects a string")
 
-        text = re.sub(r"<.*?>", " ", text)  # Clean out any HTML tags
-        text = re.sub(r"[^a-z ]", " ", text.lower())  # Keep only letters & spaces
-        text = re.sub(" +", " ", text).strip()  # Remove excess whitespace
+        if self._cached_clean is not None and len(text) <= self.cache_max_length:
+            return self._cached_clean(text, advanced, known_only)
+        return self._simple_clean(text, advanced, known_only)
 
-        # Lemmatise tokens
+    def clean_series(self, texts, advanced=None, known_only=True):
+        """
+        Batch version of simple_clean, cleaning a whole pandas Series of
+        strings at once with the same result. HTML stripping, lowercasing and
+        whitespace are handled by vectorised string operations on the
+        distinct texts, and each distinct token is lemmatised and looked up
+        only once.
 
+        Keyword arguments:
+            texts -- pandas Series of strings
+            advanced, known_only -- as for simple_clean
+        Raises:
+            TypeError, if any value is not a string
+        Returns:
+            pandas Series of cleaned strings, aligned with texts
+        """
+        if not advanced:
+            advanced = self.advanced
+        return self._finish_series(basic_clean_series(texts), advanced, known_only)
+
+    def finish_series(self, texts, known_only=True):
+        """
+        Batch version of finish_clean, for a pandas Series of strings
+        returned by basic_clean_series
+        """
+        return self._finish_series(texts, self.advanced, known_only)
+
+    def _finish_series(self, texts, advanced, known_only):
+        """Helper, the scheme dependent part of clean_series"""
+        if not advanced or len(texts) == 0:
+            return texts
+        import pandas as pd
+
+        codes, uniques = _distinct(texts)
+        split = [text.split() for text in uniques.tolist()]
+
+        # Each token not yet in the table is normalised once
+        known_only = bool(known_only)
+        table = self._token_tables[known_only]
+        # Checked token by token, as other threads may be adding to the table
+        for token in set(chain.from_iterable(split)):
+            if token not in table:
+                self._normalise_token(token, known_only)
+
+        finished = [
+            " ".join(table[token] for token in tokens if table[token] is not None)
+            for tokens in split
+        ]
+        return pd.Series(
+            pd.Series(finished, dtype=object).to_numpy()[codes],
+            index=texts.index,
+            dtype=object,
+        )
+
+    def _simple_clean(self, text, advanced, known_only):
+        """Helper, does the work of simple_clean without any caching"""
+        return self._finish_clean(basic_clean(text), advanced, known_only)
+
+    def finish_clean(self, text, known_only=True):
+        """
+        Finishes cleaning text that has been through basic_clean, giving the
+        same result as simple_clean on the original text. Lets the scheme
+        independent part of cleaning be shared by Cleaners for several schemes.
+
+        Keyword arguments:
+            text -- String returned by basic_clean
+            known_only -- Bool, whether to filter to only known job title words
+                          (default True)
+        """
+        return self._finish_clean(text, self.advanced, known_only)
+
+    def _finish_clean(self, text, advanced, known_only):
+        """Helper, the scheme dependent part of simple_clean"""
         if advanced:
-            tokens = self.lemmatize(text)
-            # Replace some lemmas with known synonyms, if known
-            tokens = [self.expand_dict.get(token, token) for token in tokens]
-
-            # Filter out words not present in the vocabulary we're matching to
-            if known_only:
-                tokens = [
-                    token
-                    for token in tokens
-                    if token in list(self.known_words_dict.keys())
-                ]
-
-                # Filter out stopwords
-                tokens = [token for token in tokens if token not in STOPWORDS]
-            return " ".join(tokens)
+            # Lemmatise, replace with known synonyms and, if known_only, filter
+            # to the vocabulary we're matching to, in one lookup per token
+            known_only = bool(known_only)
+            table = self._token_tables[known_only]
+            tokens = [
+                table[token] if token in table else self._normalise_token(token, known_only)
+                for token in text.split()
+            ]
+            return " ".join(token for token in tokens if token is not None)
 
         return text
+
+    def cache_info(self):
+        """
+        Reports on simple_clean's cache
+
+        Returns: named tuple of hits, misses, maxsize and currsize, or None
+        if caching is switched off
+        """
+        if self._cached_clean is None:
+            return None
+        return self._cached_clean.cache_info()
+
+    def clear_cache(self):
+        """Empties simple_clean's cache and resets its hit/miss counters"""
+        if self._cached_clean is not None:
+            self._cached_clean.cache_clear()
+
+    def reset(self):
+        """
+        Empties simple_clean's cache and the token tables, so that the next
+        text cleaned is cleaned from scratch, as by a new Cleaner
+        """
+        self.clear_cache()
+        self._token_tables = {True: {}, False: {}}
@@ -1,19 +1,28 @@
 # -*- coding: utf-8 -*-
 """Main module."""
+import os
 import sys
 import json
+import math
 import time
+import threading
+import numpy as np
 import pandas as pd
 
 from pathlib import Path
+from typing import NamedTuple
 from importlib.resources import files
 
-# NLP related packages to support fuzzy-matching
-from oc3i import cleaner
-from rapidfuzz import process, fuzz
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+# NLP related packages to support fuzzy-matching. rapidfuzz and scikit-learn
+# are slow to import, so are imported where they are first used
+from oc3i import cleaner, model, columnar, scoring, processes
+from oc3i.titles import TitleStore
+from oc3i.cache import ResultCache, CACHE_SIZE
 from argparse import ArgumentParser
+from functools import partial, lru_cache
+from contextlib import nullcontext
+from itertools import repeat, chain
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # For preventing windows multiprocessing error
 from multiprocessing import freeze_support
@@ -27,13 +36,93 @@ parent_dir = (PACKAGE_ROOT / config["dirs"]["parent_dir"]).resolve()
 lookup_dir = (PACKAGE_ROOT / config["dirs"]["lookup_dir"]).resolve()
 output_dir = (PACKAGE_ROOT / config["dirs"]["output_dir"]).resolve()
 
+# Number of records scored against the TF-IDF matrix at once in batch mode
+TFIDF_CHUNK_SIZE = 5000
+
+# Number of cleaned texts the Coder's Cleaner keeps cached
+CLEAN_CACHE_SIZE = 100000
+
+# Threads used by rapidfuzz when fuzzy matching in batch mode, -1 for all cores
+FUZZY_WORKERS = -1
+
+# Number of codes whose titles are kept decoded for coding single records
+TITLE_CACHE_SIZE = 256
+
+# Number of best matching codes and scores returned in multi output
+MULTI_OUTPUT_WIDTH = 3
+
+# Most records sent to a worker process at once in parallel mode. Fewer are
+# sent when that would leave workers idle
+PARALLEL_CHUNK_SIZE = 20000
+
+# Number of records coded by a thread at once in threaded mode
+THREAD_CHUNK_SIZE = 5000
+
+# Number of records coded between progress reports, when coding in this process
+PROGRESS_CHUNK_SIZE = 10000
+
+# Thresholds past which Coder.drift_report recommends refitting the TF-IDF
+# model: the fraction of buckets updated, the fraction of the terms in updated
+# buckets missing from the vocabulary, and the mean relative IDF difference
+DRIFT_BUCKET_FRACTION = 0.1
+DRIFT_UNKNOWN_TERMS = 0.2
+DRIFT_IDF = 0.05
+
+# Stages of coding that are counted and timed, reported by Coder.stats
+STAGES = ["clean", "cache", "exact", "tfidf", "fuzzy", "shape"]
+
+# How each record was coded: found in the result cache, matched exactly, by
+# TF-IDF and fuzzy matching, to a broader group as its fuzzy match was too
+# weak, or not at all as it had no text
+OUTCOMES = ["cached", "exact", "fuzzy", "fallback", "no_text"]
+
+# The Coder used by each worker process in parallel mode
+_worker_coder = None
+
+
+class _Model(NamedTuple):
+    """
+    Everything a Coder codes records with. It is never changed in place:
+    update_titles, update_buckets and refit build a new one and swap it in
+    with a single assignment, and each call coding records reads it once, so
+    records coded while another thread updates the Coder are coded wholly
+    with the old model or wholly with the new one.
+    """
+
+    # Version of the dictionaries and updates the model was built from
+    dictionary_version: str
+    # The scheme's cleaned job titles, and the titles of the codes most
+    # recently matched one record at a time
+    titles: TitleStore
+    code_titles: object
+    # The buckets, the fitted vectorizer and the buckets' TF-IDF vectors
+    mg_buckets: pd.DataFrame
+    tfidf: object
+    tfidf_matrix: object
+    # Code of each bucket, and the index buckets are scored with
+    codes: np.ndarray
+    index: object
+    # The vectorizer's pieces, for turning single records into TF-IDF
+    # vectors without the overhead of transform
+    analyzer: object
+    vocabulary: dict
+    idf: list
+    # Lookup of code -> name, keeping the first name listed for each code
+    code_names: dict
+
 class Coder:
     def __init__(
         self,
         lookup_dir=lookup_dir,
         scheme=config["user"]["scheme"],
         output=config["user"]["output"],
-        get_titles=config["user"]["get_titles"]
+        get_titles=config["user"]["get_titles"],
+        cache_size=CLEAN_CACHE_SIZE,
+        compiled=True,
+        hierarchical=False,
+        fallback_score=None,
+        result_cache=None,
+        result_cache_size=CACHE_SIZE,
     ):
         """
         Main class initialiser
@@ -48,36 +137,521 @@ class Coder:
         get_titles:str
             string, one of three options: "all", "best", "none"
             whether to return titles for all matches, only the best match, or none
+        cache_size:int
+            number of cleaned texts to cache, 0 to switch caching off
+        compiled:bool
+            whether to load the compiled model saved next to the scheme's
+            dictionaries, building and saving it if it is missing or stale
+        hierarchical:bool
+            whether to find TF-IDF candidates coarse to fine, through the
+            broader groups of codes at each level of the scheme, rather than
+            scoring records against every code
+        fallback_score:float
+            in hierarchical mode, the fuzzy match score (0 to 100) below which
+            a record is coded to its best matching group at the level above
+            the scheme's codes instead (default None, never)
+        result_cache:str
+            directory to keep a persistent cache of coded results in, shared
+            between runs and processes, or a ResultCache (default None, no
+            cache)
+        result_cache_size:int
+            most results kept in the result cache
         """
+        if fallback_score is not None and not hierarchical:
+            raise ValueError("fallback_score needs hierarchical=True")
         self.scheme = scheme.lower()
         self.output = output
         self.get_titles = get_titles
-        self.cl = cleaner.Cleaner(scheme=self.scheme)
+        self.hierarchical = hierarchical
+        self.fallback_score = fallback_score
+        self.cl = cleaner.Cleaner(scheme=self.scheme, cache_size=cache_size)
+        if result_cache is not None and not isinstance(result_cache, ResultCache):
+            result_cache = ResultCache(result_cache, max_entries=result_cache_size)
+        self.result_cache = result_cache
+
+        # Settings to recreate this Coder in worker processes, where they are
+        # not forked from this one
+        self._settings = {
+            "lookup_dir": lookup_dir,
+            "scheme": scheme,
+            "output": output,
+            "get_titles": get_titles,
+            "cache_size": cache_size,
+            "hierarchical": hierarchical,
+            "fallback_score": fallback_score,
+            "result_cache": result_cache,
+        }
+
+        titles_file = lookup_dir / f"{self.scheme}/titles_{self.scheme}.json"
+        buckets_file = lookup_dir / f"{self.scheme}/buckets_{self.scheme}.json"
+
+        # The compiled model depends on the dictionaries and how titles are cleaned
+        compiled_file = model.model_file(lookup_dir, self.scheme)
+        dictionary_version = model.dictionary_hash(
+            [titles_file, buckets_file, *self.cl.dictionary_files],
+            self.scheme,
+            self.cl.advanced,
+        )
+        compiled_model = (
+            model.load_model(compiled_file, dictionary_version)
+            if compiled
+            else None
+        )
+        if compiled_model is None:
+            compiled_model = self._build_model(titles_file, buckets_file)
+            if compiled:
+                model.save_model(compiled_file, dictionary_version, **compiled_model)
+        self._model = self._new_model(dictionary_version, **compiled_model)
+
+        # Changes made by update_titles, update_buckets and refit since the
+        # Coder was built, to repeat in worker processes that build their own.
+        # Updates are made one at a time
+        self._updates = []
+        self._update_lock = threading.Lock()
+        self._reset_drift()
+
+        # Coding keeps no state of its own on the Coder, so threads can share
+        # it; only the stats counters need guarding
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def titles(self):
+        """TitleStore of the scheme's cleaned job titles"""
+        return self._model.titles
+
+    @property
+    def mg_buckets(self):
+        """DataFrame of the scheme's codes and their word buckets"""
+        return self._model.mg_buckets
+
+    @property
+    def dictionary_version(self):
+        """Version of the dictionaries, and of any updates made to them"""
+        return self._model.dictionary_version
+
+    @property
+    def titles_mg(self):
+        """
+        The scheme's cleaned job titles, as a dict of code to list of titles.
+        This is a copy made from the title store on each access, so changing
+        it does not change the titles the Coder matches against; change them
+        with update_titles
+        """
+        return self.titles.to_dict()
+
+    def reset_stats(self):
+        """Resets the counters and timers reported by stats"""
+        info = self.cl.cache_info()
+        with self._stats_lock:
+            self._stats = {
+                "records": dict.fromkeys(STAGES, 0),
+                "seconds": dict.fromkeys(STAGES, 0.0),
+                "outcomes": dict.fromkeys(OUTCOMES, 0),
+                "cache": {"hits": 0, "misses": 0},
+                "result_cache": {"hits": 0, "misses": 0},
+            }
+            self._stats_cache_start = (info.hits, info.misses) if info else (0, 0)
+            self._stats_start = time.perf_counter()
+
+    def _record_stage(self, stage, n_records, tic):
+        """Helper, adds to a stage's counters and returns the time it finished"""
+        toc = time.perf_counter()
+        with self._stats_lock:
+            self._stats["records"][stage] += n_records
+            self._stats["seconds"][stage] += toc - tic
+        return toc
+
+    def _count(self, key, **counts):
+        """Helper, adds to the counters under one key of the stats"""
+        with self._stats_lock:
+            for name, value in counts.items():
+                self._stats[key][name] += value
+
+    def _stats_counts(self):
+        """Helper, the raw counts behind stats, including this process's cache"""
+        with self._stats_lock:
+            counts = {key: dict(values) for key, values in self._stats.items()}
+        info = self.cl.cache_info()
+        if info:
+            counts["cache"]["hits"] += info.hits - self._stats_cache_start[0]
+            counts["cache"]["misses"] += info.misses - self._stats_cache_start[1]
+        return counts
+
+    def _merge_stats(self, counts):
+        """Helper, adds counts from _stats_counts of another Coder to this one"""
+        for key, values in counts.items():
+            self._count(key, **values)
+
+    def stats(self):
+        """
+        Reports how many records were coded and where the time went, since the
+        Coder was created or reset_stats was last called. Records coded by
+        worker processes are included; their stage times add up across
+        processes.
+
+        Returns:
+            dict with
+            records -- num. records coded
+            outcomes -- num. records found in the result cache, matched
+                        exactly, by fuzzy matching of TF-IDF candidates, to a
+                        broader group in place of a weak fuzzy match, or not
+                        at all as they had no text
+            stages -- for each stage, the records it processed, the seconds it
+                      took and the records per second
+            clean_cache -- hits, misses and hit rate of the cleaning cache
+            result_cache -- hits, misses and hit rate of the result cache
+            elapsed_seconds -- wall clock time since the stats were reset
+            records_per_second -- records coded per second of elapsed time
+        """
+        counts = self._stats_counts()
+        elapsed = time.perf_counter() - self._stats_start
+        records = sum(counts["outcomes"].values())
+        lookups = counts["cache"]["hits"] + counts["cache"]["misses"]
+        result_lookups = sum(counts["result_cache"].values())
+        return {
+            "records": records,
+            "outcomes": counts["outcomes"],
+            "stages": {
+                stage: {
+                    "records": counts["records"][stage],
+                    "seconds": counts["seconds"][stage],
+                    "records_per_second": (
+                        counts["records"][stage] / counts["seconds"][stage]
+                        if counts["seconds"][stage]
+                        else None
+                    ),
+                }
+                for stage in STAGES
+            },
+            "clean_cache": {
+                **counts["cache"],
+                "hit_rate": counts["cache"]["hits"] / lookups if lookups else None,
+            },
+            "result_cache": {
+                **counts["result_cache"],
+                "hit_rate": (
+                    counts["result_cache"]["hits"] / result_lookups
+                    if result_lookups
+                    else None
+                ),
+            },
+            "elapsed_seconds": elapsed,
+            "records_per_second": records / elapsed if elapsed else None,
+        }
+
+    def _build_model(self, titles_file, buckets_file):
+        """
+        Helper, builds the model from the scheme's dictionaries: cleans the job
+        titles and fits the TF-IDF model over the buckets
+
+        Returns: dict of titles, mg_buckets, tfidf and tfidf_matrix
+        """
         # Load up the titles lists, ensure codes are loaded as strings...
-        with open(
-            lookup_dir / f"{self.scheme}/titles_{self.scheme}.json", "r"
-        ) as infile:
-            self.titles_mg = json.load(infile, parse_int=str)
+        with open(titles_file, "r") as infile:
+            titles_mg = json.load(infile, parse_int=str)
 
         # Clean the job titles lists with the same code as for records
-        for code in self.titles_mg.keys():
-            self.titles_mg[code] = [
-                self.cl.simple_clean(title, known_only=False)
-                for title in self.titles_mg[code]
+        titles_mg = self._clean_titles(titles_mg)
+
+        mg_buckets = pd.read_json(buckets_file, dtype=str)
+
+        # Build the TF-IDF model, and the matrix of TF-IDF vectors
+        tfidf = model.new_vectorizer()
+        tfidf_matrix = tfidf.fit_transform(mg_buckets.Titles_nospace)
+
+        return {
+            # Where a title appears under several codes, it is an exact match
+            # for the last one, as it always has been
+            "titles": TitleStore.from_dict(titles_mg),
+            "mg_buckets": mg_buckets,
+            "tfidf": tfidf,
+            "tfidf_matrix": tfidf_matrix,
+        }
+
+    def _clean_titles(self, titles_mg):
+        """
+        Helper, cleans lists of job titles all at once
+
+        Keyword arguments:
+            titles_mg -- dict of code to list of job titles
+        Returns:
+            dict of code to list of cleaned job titles
+        """
+        all_titles = pd.Series(
+            list(chain.from_iterable(titles_mg.values())), dtype=object
+        )
+        cleaned = iter(self.cl.clean_series(all_titles, known_only=False).tolist())
+        return {
+            code: [next(cleaned) for _ in code_titles]
+            for code, code_titles in titles_mg.items()
+        }
+
+    def _new_model(self, dictionary_version, titles, mg_buckets, tfidf, tfidf_matrix):
+        """
+        Helper, builds the model a Coder codes with from its parts, indexing
+        the buckets for scoring: an inverted index over the TF-IDF matrix, the
+        bucket codes and a lookup of code -> name
+
+        Returns: _Model
+        """
+        # Inverted index over the matrix, and the bucket codes, for scoring
+        # records against only the buckets they share terms with
+        codes = mg_buckets[f"{self.scheme.upper()}_code"].to_numpy()
+        if self.hierarchical:
+            index = self._hierarchical_index(mg_buckets, tfidf, codes, tfidf_matrix)
+        else:
+            index = scoring.TfidfIndex(tfidf_matrix)
+
+        code_names = {}
+        if "Title" in mg_buckets:
+            for code, name in zip(codes, mg_buckets["Title"]):
+                code_names.setdefault(code, name)
+
+        return _Model(
+            dictionary_version=dictionary_version,
+            titles=titles,
+            code_titles=lru_cache(maxsize=TITLE_CACHE_SIZE)(titles.titles),
+            mg_buckets=mg_buckets,
+            tfidf=tfidf,
+            tfidf_matrix=tfidf_matrix,
+            codes=codes,
+            index=index,
+            analyzer=tfidf.build_analyzer(),
+            vocabulary=tfidf.vocabulary_,
+            idf=tfidf.idf_.tolist(),
+            code_names=code_names,
+        )
+
+    def update_titles(self, titles):
+        """
+        Adds or replaces the job titles of some codes in place, without
+        rebuilding the Coder. The new titles are cleaned as the dictionary's
+        titles are, and take part in exact and fuzzy matching straight away.
+        Records being coded meanwhile in other threads are coded with the
+        titles as they were. The dictionary files are not changed.
+
+        Keyword arguments:
+            titles -- dict of code to the full list of its job titles,
+                      replacing any it had
+        """
+        cleaned = self._clean_titles({str(code): titles[code] for code in titles})
+        with self._update_lock:
+            current = self._model
+            updated = {**current.titles.to_dict(), **cleaned}
+            self._model = self._new_model(
+                self._updated_version("update_titles", titles),
+                titles=TitleStore.from_dict(updated),
+                mg_buckets=current.mg_buckets,
+                tfidf=current.tfidf,
+                tfidf_matrix=current.tfidf_matrix,
+            )
+            self._drift["titles"].update(cleaned)
+            self._updates.append(("update_titles", (titles,)))
+
+    def update_buckets(self, buckets, names=None):
+        """
+        Adds or replaces the word buckets of some codes in place, without
+        rebuilding the Coder. Bucket texts are turned into TF-IDF vectors
+        with the fitted vocabulary and weights, so words and phrases the
+        model has not seen are ignored until it is refit. Reports when the
+        buckets have drifted far enough from the fitted model for a refit to
+        be worthwhile, see drift_report. Records being coded meanwhile in
+        other threads are coded with the buckets as they were. The dictionary
+        files are not changed.
+
+        Keyword arguments:
+            buckets -- dict of code to its bucket text, as in the scheme's
+                       buckets file, replacing any it had
+            names -- dict of code to its name, for codes whose name is added
+                     or changed (default None)
+        """
+        import scipy.sparse as sp
+
+        code_column = f"{self.scheme.upper()}_code"
+        buckets = {str(code): text for code, text in buckets.items()}
+        names = {str(code): name for code, name in (names or {}).items()}
+
+        with self._update_lock:
+            current = self._model
+            mg_buckets = current.mg_buckets.copy()
+            replaced = np.flatnonzero(mg_buckets[code_column].isin(buckets).to_numpy())
+            known_codes = set(current.codes)
+            new_codes = [code for code in buckets if code not in known_codes]
+            mg_buckets = pd.concat(
+                [mg_buckets, pd.DataFrame({code_column: new_codes}, dtype=object)],
+                ignore_index=True,
+            )
+            rows = np.concatenate(
+                [replaced, np.arange(len(current.codes), len(mg_buckets))]
+            ).astype(np.intp)
+            row_codes = mg_buckets[code_column].to_numpy()[rows]
+            mg_buckets.loc[rows, "Titles_nospace"] = [
+                buckets[code] for code in row_codes
             ]
+            if "Title" in mg_buckets:
+                for code in set(names) | set(new_codes):
+                    mg_buckets.loc[
+                        mg_buckets[code_column] == code, "Title"
+                    ] = names.get(code, "")
+
+            # New vectors for the changed rows, stacked after the old matrix,
+            # and then each row taken from the old or the new
+            texts = mg_buckets["Titles_nospace"].to_numpy()[rows]
+            vectors = current.tfidf.transform(texts)
+            order = np.arange(len(mg_buckets))
+            order[rows] = len(current.codes) + np.arange(len(rows))
+            tfidf_matrix = sp.vstack([current.tfidf_matrix, vectors]).tocsr()[order]
+
+            # New codes are given an empty list of titles, if they have none
+            titles = current.titles
+            titled_codes = set(titles.codes.tolist())
+            missing = [code for code in new_codes if code not in titled_codes]
+            if missing:
+                titles = TitleStore.from_dict(
+                    {**titles.to_dict(), **{code: [] for code in missing}}
+                )
+
+            self._model = self._new_model(
+                self._updated_version("update_buckets", buckets, names),
+                titles=titles,
+                mg_buckets=mg_buckets,
+                tfidf=current.tfidf,
+                tfidf_matrix=tfidf_matrix,
+            )
+
+            for text in texts:
+                terms = current.analyzer(text)
+                self._drift["terms"] += len(terms)
+                self._drift["unknown_terms"] += sum(
+                    term not in current.vocabulary for term in terms
+                )
+            self._drift["buckets"].update(row_codes)
+            self._updates.append(("update_buckets", (buckets, names)))
+
+        report = self.drift_report()
+        if report["refit_recommended"]:
+            print(
+                f"Warning: the {self.scheme.upper()} buckets have drifted from the "
+                "fitted TF-IDF model, call refit() to refit it. "
+                f"{report['buckets_updated']} buckets updated, "
+                f"{report['unknown_term_rate']:.0%} of their terms unknown, "
+                f"IDF weights off by {report['idf_drift']:.1%} on average."
+            )
+
+    def refit(self):
+        """
+        Refits the TF-IDF model to the current buckets, including any updated
+        ones, without cleaning the job titles again. Records being coded
+        meanwhile in other threads are coded with the model as it was.
+        """
+        with self._update_lock:
+            current = self._model
+            tfidf = model.new_vectorizer()
+            tfidf_matrix = tfidf.fit_transform(current.mg_buckets.Titles_nospace)
+            self._model = self._new_model(
+                self._updated_version("refit"),
+                titles=current.titles,
+                mg_buckets=current.mg_buckets,
+                tfidf=tfidf,
+                tfidf_matrix=tfidf_matrix,
+            )
+            self._reset_drift()
+            self._updates.append(("refit", ()))
+
+    def drift_report(self):
+        """
+        Reports how far in place updates have moved the buckets from the
+        TF-IDF model they are scored with
 
-        self.mg_buckets = pd.read_json(
-            lookup_dir / f"{self.scheme}/buckets_{self.scheme}.json", dtype=str
+        Returns:
+            dict with
+            buckets_updated, titles_updated -- num. codes whose buckets or
+                                               titles were updated
+            bucket_fraction -- fraction of buckets updated since the last fit
+            unknown_term_rate -- fraction of the terms in updated buckets that
+                                 are not in the fitted vocabulary, and ignored
+            idf_drift -- mean relative difference between the fitted IDF
+                         weights and those the current buckets would give
+            refit_recommended -- whether any of these is past its DRIFT_
+                                 threshold, so refit is worth calling
+        """
+        # IDF weights as a refit would give them, for the terms in the
+        # vocabulary, from the document frequencies in the current matrix
+        current = self._model
+        n_buckets = current.tfidf_matrix.shape[0]
+        doc_freq = np.bincount(
+            current.tfidf_matrix.indices, minlength=len(current.tfidf.idf_)
+        )
+        idf = np.log((1 + n_buckets) / (1 + doc_freq)) + 1
+        idf_drift = float(
+            np.mean(np.abs(idf - current.tfidf.idf_) / current.tfidf.idf_)
         )
 
-        # Build the TF-IDF model
-        self._tfidf = TfidfVectorizer(stop_words="english", ngram_range=(1, 3))
+        terms = self._drift["terms"]
+        report = {
+            "buckets_updated": len(self._drift["buckets"]),
+            "titles_updated": len(self._drift["titles"]),
+            "bucket_fraction": len(self._drift["buckets"]) / n_buckets,
+            "unknown_term_rate": self._drift["unknown_terms"] / terms if terms else 0.0,
+            "idf_drift": idf_drift,
+        }
+        report["refit_recommended"] = (
+            report["bucket_fraction"] > DRIFT_BUCKET_FRACTION
+            or report["unknown_term_rate"] > DRIFT_UNKNOWN_TERMS
+            or report["idf_drift"] > DRIFT_IDF
+        )
+        return report
+
+    def _reset_drift(self):
+        """Helper, resets the record of updates kept for drift_report"""
+        self._drift = {
+            "buckets": set(),
+            "titles": set(),
+            "terms": 0,
+            "unknown_terms": 0,
+        }
+
+    def _updated_version(self, method, *args):
+        """Helper, the dictionary version after an update to the model"""
+        return model.dictionary_hash(
+            [], self.dictionary_version, method, json.dumps(args, sort_keys=True)
+        )
+
+    def _hierarchical_index(self, mg_buckets, tfidf, codes, tfidf_matrix):
+        """
+        Helper, builds the index for hierarchical matching. The scheme's buckets
+        are aggregated into a bucket for every group of codes sharing their
+        first digits, at each level above the scheme's codes.
 
-        # Store the matrix of TF-IDF vectors
-        self._tfidf_matrix = self._tfidf.fit_transform(self.mg_buckets.Titles_nospace)
+        Keyword arguments:
+            mg_buckets, tfidf, codes, tfidf_matrix -- the model's buckets,
+                fitted vectorizer, bucket codes and TF-IDF vectors
+        Returns: scoring.HierarchicalIndex
+        """
+        # Imported here, as it is only needed for hierarchical matching
+        from oc3i.createdictionaries.build_dict import aggregate_buckets
+
+        code_column = f"{self.scheme.upper()}_code"
+        code_length = mg_buckets[code_column].str.len().min()
+        if code_length < 2:
+            raise ValueError(
+                f"{self.scheme.upper()} codes have no levels for hierarchical matching"
+            )
 
-        # Placeholder, column names for fields needed for coding
-        self.df_columns = {"title": None, "sector": None, "description": None}
+        levels = []
+        for level in range(1, code_length):
+            groups = aggregate_buckets(
+                mg_buckets, level, code_column, ["Titles_nospace"], type="buckets"
+            )
+            levels.append(
+                (
+                    groups[code_column].to_numpy(),
+                    tfidf.transform(groups["Titles_nospace"]),
+                )
+            )
+        levels.append((codes, tfidf_matrix))
+        return scoring.HierarchicalIndex(levels)
 
     def get_exact_match(self, title: str):
         """ If it exists, finds exact match to a job title's first three words
@@ -85,15 +659,27 @@ class Coder:
         Returns: Associated dictionary code for the exact match
         """
         title = " ".join(title.split()[:3])
-        result = None
-        keys = self.titles_mg.keys()
-
-        # For each  code:
-        for k in keys:
-            # Check if exact job title is in its list of job titles
-            if title in self.titles_mg[k]:
-                result = k
-        return result
+        return self._model.titles.lookup(title)
+
+    def get_exact_matches(self, clean_titles):
+        """
+        Batch version of get_exact_match, resolving a whole Series of cleaned
+        job titles with a single lookup against the title index
+
+        Keyword arguments:
+            clean_titles -- pandas Series of cleaned job titles
+        Returns:
+            pandas Series of matched codes, None where there is no exact match
+        """
+        return self._exact_matches(self._model, clean_titles)
+
+    @staticmethod
+    def _exact_matches(model, clean_titles):
+        """Helper, get_exact_matches with a given model"""
+        keys = clean_titles.str.split().str[:3].str.join(" ")
+        return pd.Series(
+            model.titles.lookup_many(keys.to_list()), index=clean_titles.index
+        )
 
     def get_tfidf_match(self, text, top_n=5):
         """
@@ -106,18 +692,103 @@ class Coder:
             list of best matching scheme codes, of length top_n
         """
 
-        # Calculate similarities
-        vector = self._tfidf.transform([text])
-        sim_scores = cosine_similarity(vector, self._tfidf_matrix)
+        # Calculate similarities, and return top_n highest scoring
+        model = self._model
+        best, _ = model.index.top_n_one(*self._vectorize_one(model, text), top_n)
+        return model.codes[best].tolist()
+
+    @staticmethod
+    def _vectorize_one(model, text):
+        """
+        Helper, the normalised TF-IDF vector of a single text, as
+        normalize(model.tfidf.transform([text])) gives it, to the last bit
+
+        Returns:
+            tuple of the vector's ascending term columns and its weights
+        """
+        counts = {}
+        for term in model.analyzer(text):
+            column = model.vocabulary.get(term)
+            if column is not None:
+                counts[column] = counts.get(column, 0) + 1
+        columns = sorted(counts)
+        values = [counts[column] * model.idf[column] for column in columns]
+        # Normalised by transform, and again by normalize, summing in order
+        for _ in range(2):
+            norm = 0.0
+            for value in values:
+                norm += value * value
+            if norm:
+                norm = math.sqrt(norm)
+                values = [value / norm for value in values]
+        return columns, values
+
+    def get_tfidf_matches(self, texts, top_n=5, chunk_size=TFIDF_CHUNK_SIZE):
+        """
+        Batch version of get_tfidf_match, scoring many texts against the TF-IDF
+        index a chunk of chunk_size records at a time
+
+        Keyword arguments:
+            texts -- iterable of str. input texts to match.
+            top_n -- num. top N to return. Default 5.
+            chunk_size -- num. records scored at once, bounding memory use.
+        Returns:
+            tuple of two (len(texts) x top_n) arrays, holding the best matching
+            scheme codes and their similarity scores. Each row is ordered as
+            get_tfidf_match orders its codes, least similar first.
+        """
+        return self._tfidf_matches(self._model, texts, top_n, chunk_size)
+
+    @staticmethod
+    def _tfidf_matches(model, texts, top_n=5, chunk_size=TFIDF_CHUNK_SIZE):
+        """Helper, get_tfidf_matches with a given model"""
+        from sklearn.preprocessing import normalize
+
+        texts = list(texts)
+        top_n = min(top_n, len(model.codes))
+        best = np.empty((len(texts), top_n), dtype=np.intp)
+        scores = np.empty((len(texts), top_n), dtype=np.float64)
+
+        for start in range(0, len(texts), chunk_size):
+            stop = start + chunk_size
+            vectors = normalize(model.tfidf.transform(texts[start:stop]))
+            best[start:stop], scores[start:stop] = model.index.top_n(vectors, top_n)
 
-        # Return top_n highest scoring
-        best = sim_scores.argsort()[0, -top_n:]
-        scheme_codes = getattr(self.mg_buckets, f"{self.scheme.upper()}_code")
-        return [scheme_codes[code] for code in best]
+        return model.codes[best], scores
+
+    def get_parent_matches(self, texts, top_n=5, chunk_size=TFIDF_CHUNK_SIZE):
+        """
+        Finds the best matching group of codes at the level above the scheme's
+        codes for some texts, in hierarchical mode
+
+        Keyword arguments:
+            texts -- iterable of str. input texts to match.
+            top_n -- num. codes the texts are routed to, as in get_tfidf_matches
+            chunk_size -- num. records scored at once, bounding memory use.
+        Returns:
+            array of the groups' codes, one per text
+        """
+        if not self.hierarchical:
+            raise ValueError("Groups of codes are only matched in hierarchical mode")
+        return self._parent_matches(self._model, texts, top_n, chunk_size)
+
+    @staticmethod
+    def _parent_matches(model, texts, top_n=5, chunk_size=TFIDF_CHUNK_SIZE):
+        """Helper, get_parent_matches with a given model"""
+        from sklearn.preprocessing import normalize
+
+        texts = list(texts)
+        parents = np.empty(len(texts), dtype=object)
+        for start in range(0, len(texts), chunk_size):
+            vectors = normalize(model.tfidf.transform(texts[start : start + chunk_size]))
+            parents[start : start + chunk_size] = model.index.best_parents(
+                vectors, top_n
+            )
+        return parents
 
     def get_best_fuzzy_match(self, text: str, candidate_codes):
         """
-        Uses partial token set ratio in fuzzywuzzy to check against all
+        Uses token set ratio in rapidfuzz to check against all
         individual job titles.
 
         Keyword arguments:
@@ -128,38 +799,98 @@ class Coder:
             matching codes and corresponding scores), OR a string (best
             matching code, when self.output = "single").
         """
-        options = []
+        return self.get_best_fuzzy_matches([text], [candidate_codes], workers=1)[0]
+
+    def get_best_fuzzy_matches(self, texts, candidate_codes, workers=FUZZY_WORKERS):
+        """
+        Batch version of get_best_fuzzy_match. Each candidate code is scored
+        once for all the records it is a candidate for, using rapidfuzz's
+        multi-threaded cdist, and per-record maxima are then picked out with
+        array operations.
+
+        Keyword arguments:
+            texts -- list of job titles, to compare to job titles for codes
+            candidate_codes -- (len(texts) x n) array or list of lists of
+                               potential codes per text, least likely first,
+                               as returned by get_tfidf_matches
+            workers -- num. threads for rapidfuzz to use, -1 for all cores
+        Returns:
+            list with one result per text, as returned by get_best_fuzzy_match
+        """
+        return self._fuzzy_results(
+            *self._fuzzy_scores(self._model, texts, candidate_codes, workers)
+        )
 
-        # Iterate through the best options TF-IDF similarity suggests
-        for code in candidate_codes:
+    @staticmethod
+    def _fuzzy_scores(model, texts, candidate_codes, workers=FUZZY_WORKERS):
+        """
+        Helper, scores each text against the titles of its candidate codes in
+        a given model
 
-            # Clean descriptions
-            best_fuzzy_match = process.extractOne(
-                text, self.titles_mg[code], scorer=fuzz.token_set_ratio
+        Returns:
+            tuple of two (len(texts) x n) arrays, holding the candidate codes,
+            most likely first and None for codes without titles, and each
+            one's best fuzzy match score
+        """
+        from rapidfuzz import process, fuzz
+
+        if len(texts) == 0:
+            return np.empty((0, 0), dtype=object), np.empty((0, 0))
+        texts = np.asarray(texts, dtype=object)
+        candidate_codes = np.asarray(candidate_codes, dtype=object).reshape(
+            len(texts), -1
+        )
+        # Most probable codes last - flip so that most probable are first, in
+        # case of a draw the first value is kept
+        candidate_codes = candidate_codes[:, ::-1]
+        n_slots = candidate_codes.shape[1]
+        scores = np.zeros(candidate_codes.shape, dtype=np.float64)
+        found = np.zeros(candidate_codes.shape, dtype=bool)
+
+        # Group the (record, candidate) pairs by code
+        unique_codes, code_idx = np.unique(
+            candidate_codes.astype(str).ravel(), return_inverse=True
+        )
+        pairs = np.argsort(code_idx, kind="stable")
+        bounds = np.searchsorted(code_idx[pairs], np.arange(len(unique_codes) + 1))
+
+        for i, code in enumerate(unique_codes):
+            titles = model.titles.titles(code)
+            # Handle non-match, a code without any titles
+            if not titles:
+                continue
+            rows, slots = np.divmod(pairs[bounds[i] : bounds[i + 1]], n_slots)
+            sim_scores = process.cdist(
+                texts[rows],
+                titles,
+                scorer=fuzz.token_set_ratio,
+                dtype=np.float64,
+                workers=workers,
             )
+            scores[rows, slots] = sim_scores.max(axis=1)
+            found[rows, slots] = True
 
-            # Handle non-match by looking at match score
-            if best_fuzzy_match is None:
-                options.append((None, 0, None))
-            else:
-                # Record best match, the score, and the associated scheme code
-                options.append((best_fuzzy_match[0], best_fuzzy_match[1], code))
-
-        # The most probable industries are last - sort so that most probable
-        # are first, in case of a draw, max will take first value only
-        options.reverse()
-        # Order them in terms of confidence level used for 2-3 matches
-        best = max(options, key=lambda x: x[1])
-        # Return the best code, or top 3
+        return np.where(found, candidate_codes, None), scores
+
+    def _fuzzy_results(self, codes, scores):
+        """
+        Helper, picks the best of each text's candidate codes from the arrays
+        returned by _fuzzy_scores
+
+        Returns:
+            list with one result per text, as returned by get_best_fuzzy_match
+        """
+        if len(codes) == 0:
+            return []
         if self.output == "single":
-            return best[2]
-        else:
-            options.sort(key=lambda x: x[1], reverse=True)
-            options = options[:3]
-            options_codes = [i[2] for i in options]
-            options_scores = [i[1] for i in options]
-            options = [options_codes, options_scores]
-            return options
+            best = scores.argmax(axis=1)
+            return codes[np.arange(len(codes)), best].tolist()
+
+        # Order by confidence level, used for 2-3 matches
+        order = np.argsort(-scores, axis=1, kind="stable")[:, :MULTI_OUTPUT_WIDTH]
+        best_codes = np.take_along_axis(codes, order, axis=1).tolist()
+        best_scores = np.take_along_axis(scores, order, axis=1).tolist()
+        return [list(options) for options in zip(best_codes, best_scores)]
 
     def code_record(self, title: str, sector: str = None, description: str = None):
         """
@@ -174,6 +905,7 @@ class Coder:
             list of lists, containing best matches
 
         """
+        tic = time.perf_counter()
         clean_title = self.cl.simple_clean(title)
 
         # Gather all text data
@@ -188,74 +920,597 @@ class Coder:
         if description:
             clean_description = self.cl.simple_clean(description, known_only=False)
             all_text = all_text + " " + clean_description
+        self._record_stage("clean", 1, tic)
 
+        return self._code_cleaned(clean_title, all_text)
+
+    def _code_cleaned(self, clean_title: str, all_text: str):
+        """
+        Codes a record whose text has already been cleaned
+
+        Keyword arguments:
+            clean_title -- cleaned job title
+            all_text -- cleaned title, sector and description joined together
+        Returns:
+            the coded result, in the same form as code_record
+        """
         # If there is no text at all, return None
         if all_text.strip() == "":
-            if self.output == "single":
-                return None
-            else:
-                return [[], []]
-            
+            self._count("outcomes", no_text=1)
+            return self._no_match()
+
+        # The whole record is coded with the model as it is now
+        model = self._model
+        keys = None
+        if self.result_cache is not None:
+            keys, cached = self._cache_lookup(model, [clean_title], [all_text])
+            if cached:
+                return cached[0]
+
         # Try to code using exact title match
-        match = self.get_exact_match(clean_title)
+        tic = time.perf_counter()
+        match = model.titles.lookup(" ".join(clean_title.split()[:3]))
+        self._record_stage("exact", 1, tic)
         if match:
-            return match
+            self._count("outcomes", exact=1)
+            result = match
+        elif self.hierarchical:
+            # Find best fuzzy match possible with the data
+            (result,) = self._match_fuzzy(model, [clean_title], [all_text], workers=1)
+        else:
+            result = self._match_one(model, clean_title, all_text)
+
+        if keys is not None:
+            self.result_cache.put_many([(keys[0], result)])
+        return result
+
+    def _match_fuzzy(self, model, clean_titles, all_text, workers=FUZZY_WORKERS):
+        """
+        Helper, codes records that have no exact match. Finds their TF-IDF
+        candidates and then the best fuzzy match among them, falling back to a
+        broader group where that match scores below fallback_score.
+
+        Keyword arguments:
+            model -- the model to code with
+            clean_titles -- array of cleaned job titles
+            all_text -- array of cleaned title, sector and description text
+            workers -- num. threads for fuzzy matching, -1 for all cores
+        Returns: list of coded results, one per record
+        """
+        tic = time.perf_counter()
+        best_fit_codes, _ = self._tfidf_matches(model, all_text)
+        tic = self._record_stage("tfidf", len(all_text), tic)
+
+        codes, scores = self._fuzzy_scores(model, clean_titles, best_fit_codes, workers)
+        results = self._fuzzy_results(codes, scores)
+        fallback = []
+        if self.fallback_score is not None and len(results):
+            best_scores = scores.max(axis=1)
+            fallback = np.flatnonzero(best_scores < self.fallback_score)
+            parents = self._parent_matches(
+                model, np.asarray(all_text, dtype=object)[fallback]
+            )
+            for i, parent in zip(fallback, parents):
+                if self.output == "single":
+                    results[i] = parent
+                else:
+                    results[i] = [[parent], [float(best_scores[i])]]
+        self._record_stage("fuzzy", len(all_text), tic)
+
+        self._count(
+            "outcomes", fuzzy=len(results) - len(fallback), fallback=len(fallback)
+        )
+        return results
+
+    def _match_one(self, model, clean_title, all_text):
+        """
+        Helper, single record version of _match_fuzzy without hierarchical
+        matching, with the same result. Skips the batch machinery, which
+        dominates the time taken for a single record: the TF-IDF vector is
+        built directly and scored against the index, and the titles of
+        recently matched codes are kept decoded.
+
+        Keyword arguments:
+            model -- the model to code with
+            clean_title -- cleaned job title
+            all_text -- cleaned title, sector and description joined together
+        Returns: the coded result
+        """
+        from rapidfuzz import process, fuzz
+
+        tic = time.perf_counter()
+        best, _ = model.index.top_n_one(*self._vectorize_one(model, all_text))
+        tic = self._record_stage("tfidf", 1, tic)
+
+        # Most probable codes first, as in _fuzzy_scores
+        codes = []
+        scores = []
+        for code in model.codes[best[::-1]].tolist():
+            titles = model.code_titles(code)
+            if titles:
+                scores.append(
+                    process.extractOne(clean_title, titles, scorer=fuzz.token_set_ratio)[1]
+                )
+                codes.append(code)
+            else:
+                scores.append(0.0)
+                codes.append(None)
+        (result,) = self._fuzzy_results(
+            np.array([codes], dtype=object), np.array([scores], dtype=np.float64)
+        )
+        self._record_stage("fuzzy", 1, tic)
+        self._count("outcomes", fuzzy=1)
+        return result
 
-        best_fit_codes = self.get_tfidf_match(all_text)
+    def _no_match(self):
+        """Helper, the result returned for records with no text to code"""
+        if self.output == "single":
+            return None
+        else:
+            return [[], []]
 
-        # Find best fuzzy match possible with the data
-        return self.get_best_fuzzy_match(clean_title, best_fit_codes)
+    def _cache_namespace(self, model):
+        """
+        Helper, identifies the scheme, settings and dictionaries results are
+        coded with, for keying the result cache
+        """
+        return json.dumps(
+            [
+                self.scheme,
+                self.output,
+                self.hierarchical,
+                self.fallback_score,
+                MULTI_OUTPUT_WIDTH,
+                model.dictionary_version,
+            ]
+        )
 
-    def _code_row(self, row):
+    def _cache_lookup(self, model, clean_titles, all_text):
+        """
+        Helper, looks records up in the result cache
+
+        Keyword arguments:
+            model -- the model the records are coded with
+            clean_titles -- list of cleaned job titles
+            all_text -- list of cleaned title, sector and description text
+        Returns:
+            tuple of the records' cache keys, and a dict of the position of
+            each record found to its cached result
         """
-        Helper for applying code_record over the rows of a pandas DataFrame
+        tic = time.perf_counter()
+        namespace = self._cache_namespace(model)
+        keys = [
+            ResultCache.key(namespace, title, text)
+            for title, text in zip(clean_titles, all_text)
+        ]
+        found = self.result_cache.get_many(keys)
+        cached = {i: found[key] for i, key in enumerate(keys) if key in found}
+        self._count("result_cache", hits=len(cached), misses=len(keys) - len(cached))
+        self._count("outcomes", cached=len(cached))
+        self._record_stage("cache", len(keys), tic)
+        return keys, cached
+
+    def _code_unique(
+        self,
+        record_df,
+        title_column,
+        sector_column,
+        description_column,
+        code_columns=None,
+        verbose=True,
+    ):
+        """
+        Codes the text columns of a DataFrame like _code_columns, but codes each
+        unique combination of title, sector and description only once and
+        copies the results back to every row it appears in
 
-        Returns: A coded row in a dataframe, to be used as part of `code_data_frame()`
+        Keyword arguments:
+            code_columns -- function used to code the unique rows, taking the
+                            same arguments as _code_columns (default
+                            _code_columns)
+            verbose -- whether to print how many records are unique
+        Returns: pandas Series of coded results, aligned with record_df
         """
-        return self.code_record(
-            row[self.df_columns["title"]],
-            row[self.df_columns["sector"]],
-            row[self.df_columns["description"]],
+        code_columns = code_columns or self._code_columns
+        first, inverse = _unique_rows(
+            record_df, [title_column, sector_column, description_column], verbose
+        )
+        unique_codes = code_columns(
+            record_df.iloc[first], title_column, sector_column, description_column
+        )
+        return pd.Series(
+            unique_codes.to_numpy()[inverse], index=record_df.index, dtype=object
         )
 
-    def shape_output(self, record_df):
+    def _code_columns(
+        self,
+        record_df,
+        title_column,
+        sector_column,
+        description_column,
+        workers=FUZZY_WORKERS,
+        basic=None,
+    ):
         """
-        Add empty columns and rename to contain predicted code for job description and their scores
+        Codes the text columns of a DataFrame. Exact title matches are resolved
+        for all rows at once, and the remaining rows are scored against the
+        TF-IDF matrix together before fuzzy matching.
+
+        Keyword arguments:
+            workers -- num. threads for fuzzy matching, -1 for all cores
+            basic -- dict of column name to the column already cleaned by
+                     cleaner.basic_clean_series, so that only the scheme
+                     dependent part of cleaning is left to do (default None)
+        Returns: pandas Series of coded results, aligned with record_df
+        """
+        if len(record_df) == 0:
+            return pd.Series(None, index=record_df.index, dtype=object)
+
+        def clean(column, known_only=True):
+            # Work by position, as the DataFrame's index need not be unique
+            if basic is not None:
+                return self.cl.finish_series(
+                    basic[column].reset_index(drop=True), known_only
+                )
+            return self.cl.clean_series(
+                _blank_empty(record_df[column]).reset_index(drop=True),
+                known_only=known_only,
+            )
+
+        tic = time.perf_counter()
+        clean_titles = clean(title_column)
+        all_text = clean_titles
+        for column in [sector_column, description_column]:
+            if column is None:
+                continue
+            # Empty values are left out, rather than adding a space
+            present = record_df[column].astype(bool).to_numpy()
+            cleaned = clean(column, known_only=False).where(present, None)
+            all_text = all_text.where(cleaned.isna(), all_text + " " + cleaned)
+
+        tic = self._record_stage("clean", len(record_df), tic)
+
+        codes = np.empty(len(record_df), dtype=object)
+        # The whole chunk is coded with the model as it is now
+        model = self._model
+
+        # Rows with no text at all are not coded
+        has_text = (all_text.str.strip() != "").to_numpy()
+        for i in np.flatnonzero(~has_text):
+            codes[i] = self._no_match()
+
+        # Results already in the result cache, in one lookup for the chunk
+        to_code = has_text.copy()
+        if self.result_cache is not None:
+            rows = np.flatnonzero(has_text)
+            keys, cached = self._cache_lookup(
+                model, clean_titles.to_numpy()[rows], all_text.to_numpy()[rows]
+            )
+            for i, result in cached.items():
+                codes[rows[i]] = result
+                to_code[rows[i]] = False
+            tic = time.perf_counter()
+
+        # Exact matching stage
+        exact = self._exact_matches(model, clean_titles[to_code]).dropna()
+        codes[exact.index] = exact.to_numpy()
+        matched = np.zeros(len(record_df), dtype=bool)
+        matched[exact.index] = True
+        self._record_stage("exact", int(to_code.sum()), tic)
+
+        # TF-IDF candidates for everything left, then fuzzy matching
+        pending = np.flatnonzero(to_code & ~matched)
+        results = self._match_fuzzy(
+            model,
+            clean_titles.to_numpy()[pending],
+            all_text.to_numpy()[pending],
+            workers=workers,
+        )
+        for i, result in zip(pending, results):
+            codes[i] = result
+
+        if self.result_cache is not None:
+            self.result_cache.put_many(
+                [
+                    (key, codes[i])
+                    for i, key in zip(rows, keys)
+                    if to_code[i]
+                ]
+            )
+
+        self._count(
+            "outcomes",
+            exact=len(exact),
+            no_text=len(record_df) - int(has_text.sum()),
+        )
+        return pd.Series(codes, index=record_df.index, dtype=object)
+
+    def _code_batches(
+        self,
+        record_df,
+        title_column,
+        sector_column,
+        description_column,
+        progress=None,
+        chunk_size=PROGRESS_CHUNK_SIZE,
+    ):
+        """
+        Codes the text columns of a DataFrame like _code_columns, chunk_size
+        rows at a time, reporting progress after each chunk
 
         Keyword arguments:
-            record_df: dataframe where the new columns will be added
+            progress -- function called as progress(done, total, eta), see
+                        code_data_frame
+            chunk_size -- num. records coded between progress reports
+        Returns: pandas Series of coded results, aligned with record_df
+        """
+        tic = time.perf_counter()
+        coded = []
+        for start in range(0, len(record_df), chunk_size):
+            coded.append(
+                self._code_columns(
+                    record_df.iloc[start : start + chunk_size],
+                    title_column,
+                    sector_column,
+                    description_column,
+                )
+            )
+            _report_progress(
+                progress, start + len(coded[-1]), len(record_df), tic
+            )
+        if not coded:
+            return pd.Series(None, index=record_df.index, dtype=object)
+        return pd.concat(coded)
 
+    def worker_pool(self, workers=None):
+        """
+        Starts a pool of worker processes set up to code with this Coder, which
+        can be passed to code_data_frame as pool so that several calls share
+        it. Where processes are forked, see processes.worker_context, workers
+        share this Coder's model with the parent copy-on-write. Otherwise each
+        worker builds its own Coder once, from the compiled model, and repeats
+        any updates made to this one. Either way, workers code with the model
+        as it was when the pool was started.
+
+        Keyword arguments:
+            workers -- num. worker processes (default None, one per core)
         Returns:
-            coded_df: dataframe with added columns
+            concurrent.futures.ProcessPoolExecutor, to be shut down by the
+            caller, e.g. by using it in a with statement
         """
+        context, forks = processes.worker_context()
+        if forks:
+            initargs = (self, None)
+        else:
+            initargs = (None, self._settings, self._updates)
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=initargs,
+        )
 
-        f = lambda x: "prediction {}".format(x + 1)
-        coded_df_codes = (
-            record_df["Predicted_codes"].apply(pd.Series).fillna("").rename(columns=f)
+    def _code_parallel(
+        self,
+        record_df,
+        title_column,
+        sector_column,
+        description_column,
+        workers=None,
+        chunk_size=PARALLEL_CHUNK_SIZE,
+        progress=None,
+        pool=None,
+    ):
+        """
+        Codes the text columns of a DataFrame like _code_columns, split into
+        chunks that are coded in a pool of worker processes. Each worker gets
+        an equal share of the records, in chunks of at most chunk_size rows.
+        Only the records and their codes are passed between processes.
+
+        Keyword arguments:
+            workers -- num. worker processes (default None, one per core)
+            chunk_size -- most records sent to a worker at once
+            progress -- function called as progress(done, total, eta) after
+                        each chunk, see code_data_frame
+            pool -- pool from worker_pool to code in (default None, a pool of
+                    workers processes is started for this call)
+        Returns: pandas Series of coded results, aligned with record_df
+        """
+        if len(record_df) == 0:
+            return pd.Series(None, index=record_df.index, dtype=object)
+
+        columns = [title_column, sector_column, description_column]
+        needed = [col for col in columns if col is not None]
+        chunk_size = min(
+            chunk_size, math.ceil(len(record_df) / (workers or os.cpu_count()))
+        )
+        chunks = (
+            record_df[needed].iloc[start : start + chunk_size]
+            for start in range(0, len(record_df), chunk_size)
+        )
+
+        if pool is None:
+            pool_context = self.worker_pool(workers)
+        else:
+            # A shared pool is left running for the caller's next call
+            pool_context = nullcontext(pool)
+        with pool_context as pool:
+            # Results come back in the order the chunks were sent
+            tic = time.perf_counter()
+            coded = []
+            for chunk_codes, counts in pool.map(_code_chunk, chunks, repeat(columns)):
+                coded.append(chunk_codes)
+                self._merge_stats(counts)
+                _report_progress(
+                    progress, sum(len(c) for c in coded), len(record_df), tic
+                )
+        return pd.Series(np.concatenate(coded), index=record_df.index, dtype=object)
+
+    def _code_threaded(
+        self,
+        record_df,
+        title_column,
+        sector_column,
+        description_column,
+        threads=None,
+        chunk_size=THREAD_CHUNK_SIZE,
+        progress=None,
+    ):
+        """
+        Codes the text columns of a DataFrame like _code_columns, split into
+        chunks of chunk_size rows that are coded by a pool of threads sharing
+        this Coder's model. Fuzzy matching and scoring against the TF-IDF
+        matrix release the GIL, so threads run them side by side without a
+        copy of the model per process.
+
+        Keyword arguments:
+            threads -- num. threads (default None, one per core)
+            chunk_size -- num. records a thread codes at once
+            progress -- function called as progress(done, total, eta) after
+                        each chunk, see code_data_frame
+        Returns: pandas Series of coded results, aligned with record_df
+        """
+        chunks = (
+            record_df.iloc[start : start + chunk_size]
+            for start in range(0, len(record_df), chunk_size)
         )
-        f = lambda x: "score {}".format(x + 1)
-        coded_df_scores = (
-            record_df["Predicted_scores"].apply(pd.Series).fillna("").rename(columns=f)
+        # Parallelism comes from the threads, so fuzzy match in a single thread
+        code_chunk = partial(
+            self._code_columns,
+            title_column=title_column,
+            sector_column=sector_column,
+            description_column=description_column,
+            workers=1,
+        )
+        with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as pool:
+            # Results come back in the order the chunks were sent
+            tic = time.perf_counter()
+            coded = []
+            for chunk_codes in pool.map(code_chunk, chunks):
+                coded.append(chunk_codes.to_numpy())
+                _report_progress(
+                    progress, sum(len(c) for c in coded), len(record_df), tic
+                )
+        if not coded:
+            return pd.Series(None, index=record_df.index, dtype=object)
+        return pd.Series(np.concatenate(coded), index=record_df.index, dtype=object)
+
+    def shape_output(self, record_df, width=None, verbose=True):
+        """
+        Add empty columns and rename to contain predicted code for job description and their scores
+
+        Keyword arguments:
+            record_df: dataframe where the new columns will be added, with the
+                coded results in its "<SCHEME>_code" column
+            width: number of prediction and score columns to add (default None,
+                as many as there are predictions)
+            verbose: whether to warn when titles are asked for but not
+                available (default True)
+
+        Returns:
+            coded_df: dataframe with added columns
+        """
+        columns = self._output_columns(
+            record_df[f"{self.scheme.upper()}_code"], width, verbose
         )
         record_df = record_df.drop(
             [f"{self.scheme.upper()}_code", "Predicted_scores", "Predicted_codes"],
             axis=1,
+            errors="ignore",
         )
+        coded_df = pd.DataFrame(columns, index=record_df.index).fillna("")
+        return pd.concat([record_df, coded_df], axis=1)
+
+    def _result_frame(self, results, output_width=None, verbose=True):
+        """
+        Helper, the columns code_data_frame adds to a DataFrame for the coded
+        results, laid out by shape_output for multi output
+
+        Keyword arguments:
+            results: pandas Series of coded results
+            output_width, verbose: as for code_data_frame
+        Returns:
+            pandas DataFrame of the added columns, aligned with results
+        """
+        code_column = f"{self.scheme.upper()}_code"
+        if self.output == "multi" and (
+            output_width is not None or any(isinstance(val, list) for val in results)
+        ):
+            tic = time.perf_counter()
+            coded_df = self.shape_output(
+                results.to_frame(code_column), width=output_width, verbose=verbose
+            )
+            self._record_stage("shape", len(coded_df), tic)
+            return coded_df
+        return results.to_frame(code_column)
+
+    def _output_columns(self, results, width=None, verbose=True):
+        """
+        Helper, lays out multi output results as the prediction, title and
+        score columns added by shape_output
 
-        coded_df_codenames = pd.DataFrame(index=record_df.index)
+        Keyword arguments:
+            results: coded results, as in the "<SCHEME>_code" column
+            width: number of prediction and score columns (default None, as
+                many as there are predictions)
+            verbose: as for shape_output
+        Returns:
+            dict of column name to array, in output order. Codes and titles are
+            None and scores NaN where there is no prediction.
+        """
+        codes, scores = self._prediction_arrays(results, width)
+        columns = {
+            f"prediction {i + 1}": codes[:, i] for i in range(codes.shape[1])
+        }
         if self.get_titles != "none":
             if self.scheme == "soc":
-                print("Warning: Job titles are not available for SOC scheme, skipping job titles output.")
+                if verbose:
+                    print("Warning: Job titles are not available for SOC scheme, skipping job titles output.")
             else:
-                coded_df_codenames = coded_df_codes.map(self.get_code_name)
-                coded_df_codenames.rename(columns=lambda col: col.replace("prediction", "title"), inplace=True)
-                if self.get_titles == "best":
-                    coded_df_codenames = coded_df_codenames.iloc[:, :1]
-                
-        coded_df = pd.concat([record_df, coded_df_codes, coded_df_codenames, coded_df_scores], axis=1)
-        return coded_df
+                code_names = self._model.code_names
+                n_titles = min(1, codes.shape[1]) if self.get_titles == "best" else codes.shape[1]
+                for i in range(n_titles):
+                    columns[f"title {i + 1}"] = np.array(
+                        [code_names.get(code) for code in codes[:, i]],
+                        dtype=object,
+                    )
+        for i in range(scores.shape[1]):
+            columns[f"score {i + 1}"] = scores[:, i]
+        return columns
+
+    @staticmethod
+    def _prediction_arrays(results, width=None):
+        """
+        Helper, lays out multi output results as fixed width arrays
 
-    def check_input_df(self, record_df, title_column, description_column, sector_column):
+        Keyword arguments:
+            results: coded results, each either a list of codes and a list of
+                scores, or a single exact match code without a score
+            width: number of columns (default None, the most predictions of
+                any result)
+        Returns:
+            tuple of (len(results) x width) arrays of codes, None where missing,
+            and of scores, NaN where missing
+        """
+        results = list(results)
+        lengths = [len(r[0]) if isinstance(r, list) else 1 for r in results]
+        if width is None:
+            width = max(lengths, default=0)
+        codes = np.full((len(results), width), None, dtype=object)
+        scores = np.full((len(results), width), np.nan)
+
+        for i, (result, length) in enumerate(zip(results, lengths)):
+            length = min(length, width)
+            if isinstance(result, list):
+                codes[i, :length] = result[0][:length]
+                scores[i, :length] = result[1][:length]
+            elif length:
+                codes[i, 0] = result
+        return codes, scores
+
+    def check_input_df(
+        self, record_df, title_column, description_column, sector_column, verbose=True
+    ):
         """
         Checks the input dataframe for required columns and NA values
         Keyword arguments:
@@ -263,10 +1518,15 @@ class Coder:
             title_column -- Freetext job title (default 'job_title')
             sector_column -- additional description of industry/sector (default None)
             description_column -- Freetext description of work/role/duties (default None)
+            verbose -- whether to print the number of records to code (default True)
         Returns:
             record_df: same dataframe, with NA values replaced by empty strings
         """
-        columns_to_check = [title_column, sector_column, description_column]
+        # Sector and description columns are optional
+        columns_to_check = [
+            col for col in [title_column, sector_column, description_column]
+            if col is not None
+        ]
         
         missing_columns = [col for col in columns_to_check if col not in record_df.columns]
         if missing_columns:
@@ -275,7 +1535,8 @@ class Coder:
         existing_columns = [col for col in columns_to_check if col in record_df.columns]
         na_counts = record_df[existing_columns].isna().sum().to_dict()
         
-        print(f"Coding {len(record_df)} records in dataframe...")
+        if verbose:
+            print(f"Coding {len(record_df)} records in dataframe...")
         for col, na_count in na_counts.items():
             if na_count > 0:
                 print(
@@ -292,57 +1553,194 @@ class Coder:
         title_column: str = "job_title",
         sector_column: str = None,
         description_column: str = None,
+        deduplicate: bool = None,
+        workers: int = 1,
+        output_width: int = None,
+        progress=None,
+        threads: int = 1,
+        pool=None,
+        verbose: bool = True,
     ):
         """
-        Applies tool to all rows in a provided pandas DataFrame
+        Applies tool to all rows in a provided pandas DataFrame, or pyarrow
+        Table. A Coder can code several data frames at once from different
+        threads.
 
         Keyword arguments:
-            record_df -- Pandas dataframe containing columns named:
+            record_df -- Pandas dataframe, or pyarrow Table, containing columns named:
             title_column -- Freetext job title (default 'job_title')
             sector_column -- additional description of industry/sector
                              (default None)
             description_column -- Freetext description of work/role/duties
                                   (default None)
+            deduplicate -- Whether to code each unique combination of title,
+                           sector and description only once (default None,
+                           which deduplicates when there is no description)
+            workers -- Number of worker processes to code with (default 1,
+                       codes in this process; None uses one per core)
+            output_width -- For multi output, always add this many prediction
+                            and score columns (default None, as many as the
+                            predictions need)
+            progress -- Function called as progress(done, total, eta) as
+                        coding proceeds, with the number of records coded so
+                        far, the number to code after any deduplication, and
+                        the estimated seconds left (default None)
+            threads -- Number of threads to code with, sharing this Coder's
+                       model (default 1, codes in the calling thread; None
+                       uses one per core). Cannot be combined with workers.
+            pool -- Pool from worker_pool to code in when workers is not 1,
+                    so that several calls can share one (default None, a
+                    pool is started for the call)
+            verbose -- Whether to print how many records are coded and
+                       warnings about the output (default True). Warnings
+                       about missing values are always printed.
+        Raises:
+            ValueError, if both workers and threads are set
         Returns:
-            record_df: a final coded dataframe
+            record_df: a final coded dataframe. For a pyarrow Table, a Table
+                with the coded columns appended as typed columns, strings for
+                codes and titles and floats for scores, null where missing;
+                multi output is always laid out in prediction columns.
         """
-        # Record the column names for later
-        self.df_columns.update(
-            {
-                "title": title_column,
-                "sector": sector_column,
-                "description": description_column,
-            }
-        )
-        
+        arrow_table = None
+        if _is_arrow(record_df):
+            # Only the columns to code are converted to pandas, the rest are
+            # passed through to the output as they are
+            arrow_table = _arrow_to_table(record_df)
+            record_df = arrow_table.select(
+                [
+                    col for col in [title_column, sector_column, description_column]
+                    if col is not None and col in arrow_table.column_names
+                ]
+            ).to_pandas()
+
         try:
-            record_df = self.check_input_df(record_df, title_column, description_column, sector_column)    
+            record_df = self.check_input_df(
+                record_df, title_column, description_column, sector_column, verbose
+            )
         except ValueError as e:
             print(e)
             sys.exit(1)
 
-        record_df[f"{self.scheme.upper()}_code"] = record_df.apply(
-            self._code_row, axis=1
+        if workers != 1 and threads != 1:
+            raise ValueError("Code with either worker processes or threads, not both")
+
+        if workers != 1:
+            code_columns = partial(
+                self._code_parallel, workers=workers, progress=progress, pool=pool
+            )
+        elif threads != 1:
+            code_columns = partial(
+                self._code_threaded, threads=threads, progress=progress
+            )
+        elif progress is not None:
+            code_columns = partial(self._code_batches, progress=progress)
+        else:
+            code_columns = self._code_columns
+        if deduplicate is None:
+            deduplicate = description_column is None
+        if deduplicate:
+            code_columns = partial(
+                self._code_unique, code_columns=code_columns, verbose=verbose
+            )
+        results = code_columns(
+            record_df, title_column, sector_column, description_column
         )
+        if arrow_table is not None:
+            return self._arrow_output(
+                arrow_table, results, width=output_width, verbose=verbose
+            )
+        record_df[f"{self.scheme.upper()}_code"] = results
         if self.output == "multi":
             has_multi = any(
                 isinstance(val, list)
                 for val in record_df[f"{self.scheme.upper()}_code"]
             )
-            if has_multi:
-                record_df["Predicted_scores"] = (
-                    record_df[f"{self.scheme.upper()}_code"]
-                    .apply(pd.Series)
-                    .fillna("")[1]
+            if has_multi or output_width is not None:
+                tic = time.perf_counter()
+                record_df = self.shape_output(
+                    record_df, width=output_width, verbose=verbose
                 )
+                self._record_stage("shape", len(record_df), tic)
+        return record_df
+
+    def _arrow_output(self, table, results, width=None, verbose=True):
+        """
+        Helper, appends coded results to a pyarrow Table as typed columns
+
+        Keyword arguments:
+            table: pyarrow Table the records were coded from
+            results: pandas Series of coded results, aligned with the table
+            width: for multi output, number of prediction and score columns
+                (default None, as many as there are predictions)
+            verbose: as for shape_output
+        Returns:
+            pyarrow Table with the coded columns appended
+        """
+        import pyarrow as pa
+
+        if self.output == "multi":
+            tic = time.perf_counter()
+            columns = self._output_columns(results, width, verbose)
+            self._record_stage("shape", len(results), tic)
+        else:
+            columns = {f"{self.scheme.upper()}_code": results.to_numpy()}
+        for name, values in columns.items():
+            arrow_type = pa.float64() if values.dtype.kind == "f" else pa.string()
+            table = table.append_column(
+                name, pa.array(values, type=arrow_type, from_pandas=True)
+            )
+        return table
+
+    def code_data_frame_chunks(
+        self,
+        chunks,
+        title_column: str = "job_title",
+        sector_column: str = None,
+        description_column: str = None,
+        deduplicate: bool = None,
+        workers: int = 1,
+        progress=None,
+        threads: int = 1,
+    ):
+        """
+        Applies tool to an iterable of pandas DataFrames one at a time, for
+        example chunks read from a file too large to hold in memory
 
-                record_df["Predicted_codes"] = (
-                    record_df[f"{self.scheme.upper()}_code"]
-                    .apply(pd.Series)
-                    .fillna("")[0]
+        Keyword arguments:
+            chunks -- iterable of Pandas dataframes, each as for code_data_frame
+            title_column, sector_column, description_column, deduplicate,
+            workers, threads -- as for code_data_frame
+            progress -- Function called as progress(done, None, None) after
+                        each chunk, with the number of records coded so far;
+                        the total is not known in advance (default None)
+        Yields:
+            each coded dataframe. All have the same columns in the same order;
+            multi output always has MULTI_OUTPUT_WIDTH predictions and scores.
+        """
+        columns = None
+        done = 0
+        # One pool of worker processes codes every chunk
+        with self.worker_pool(workers) if workers != 1 else nullcontext() as pool:
+            for chunk in chunks:
+                coded = self.code_data_frame(
+                    chunk,
+                    title_column=title_column,
+                    sector_column=sector_column,
+                    description_column=description_column,
+                    deduplicate=deduplicate,
+                    workers=workers,
+                    output_width=MULTI_OUTPUT_WIDTH if self.output == "multi" else None,
+                    threads=threads,
+                    pool=pool,
+                    # Messages about the run are printed for the first chunk only
+                    verbose=columns is None,
                 )
-                record_df = self.shape_output(record_df)
-        return record_df
+                if columns is None:
+                    columns = list(coded.columns)
+                done += len(coded)
+                _report_progress(progress, done, None, None)
+                yield coded.reindex(columns=columns, fill_value="")
 
     def parallel_code_data_frame(
         self,
@@ -350,9 +1748,11 @@ class Coder:
         title_column: str = "job_title",
         sector_column: str = None,
         description_column: str = None,
+        workers: int = None,
     ):
         """
-        Applies tool to all rows in a provided pandas DataFrame
+        Applies tool to all rows in a provided pandas DataFrame, using a pool
+        of worker processes. Output is the same as for code_data_frame.
 
         Keyword arguments:
             record_df -- Pandas dataframe containing columns named:
@@ -361,34 +1761,18 @@ class Coder:
             sector_column -- Any description of industry/sector (default None)
             description_column -- Freetext description of work/role/duties
                                   (default None)
+            workers -- Number of worker processes (default None, one per core)
+        Returns:
+            record_df: a final coded dataframe
         """
-        # Import within function, makes class/module friendly to systems that
-        # don't have modin installed and don't intend to use the function
-        import modin.pandas as mpd
-
-        # Initialises something Dask needs to parallelise operations
-        from distributed import Client
-
-        client = Client()
-
-        # Record the column names for later
-        self.df_columns.update(
-            {
-                "title": title_column,
-                "sector": sector_column,
-                "description": description_column,
-            }
+        return self.code_data_frame(
+            record_df,
+            title_column=title_column,
+            sector_column=sector_column,
+            description_column=description_column,
+            workers=workers,
         )
 
-        # Overwrite to save memory after conversion to Modin DataFrame
-        record_df = mpd.DataFrame(record_df)
-        record_df["code"] = record_df.apply(self._code_row, axis=1)
-
-        # Hack a private method to convert back to Pandas DataFrame
-        result = record_df._to_pandas()
-        client.close()
-        return result
-
     def get_code_name(self, code: str):
         """
         Returns the name/description associated with a given code
@@ -398,14 +1782,290 @@ class Coder:
         Returns:
             string, the name/description associated with the code
         """
+        return self._model.code_names.get(code, "")
+
+class MultiCoder:
+    def __init__(
+        self,
+        schemes=("soc", "isco"),
+        lookup_dir=lookup_dir,
+        output=config["user"]["output"],
+        get_titles=config["user"]["get_titles"],
+        cache_size=CLEAN_CACHE_SIZE,
+        compiled=True,
+        hierarchical=False,
+        fallback_score=None,
+        result_cache=None,
+        result_cache_size=CACHE_SIZE,
+    ):
+        """
+        Codes records to several schemes in one pass. The cleaning that is the
+        same for every scheme is done once per text, and each scheme's exact,
+        TF-IDF and fuzzy matching then runs on the shared result.
+
+        This is for convenience, and takes about as long as coding with a
+        Coder per scheme. The rest of cleaning depends on each scheme's
+        dictionaries, and matching, which takes nearly all of the time, is
+        against each scheme's own titles and buckets.
+
+        Keyword arguments:
+        schemes:list
+            list of schemes to code to
+        lookup_dir, output, get_titles, cache_size, compiled, hierarchical,
+        fallback_score, result_cache, result_cache_size:
+            as for Coder, used for every scheme. The schemes share one result
+            cache.
+        """
+        if result_cache is not None and not isinstance(result_cache, ResultCache):
+            result_cache = ResultCache(result_cache, max_entries=result_cache_size)
+        self.coders = {
+            scheme.lower(): Coder(
+                lookup_dir=lookup_dir,
+                scheme=scheme,
+                output=output,
+                get_titles=get_titles,
+                cache_size=cache_size,
+                compiled=compiled,
+                hierarchical=hierarchical,
+                fallback_score=fallback_score,
+                result_cache=result_cache,
+            )
+            for scheme in schemes
+        }
+
+    def _shared_cleaners(self):
+        """
+        Helper, cleaning functions for each scheme that share the scheme
+        independent part of cleaning between them
+
+        Returns: dict of scheme to a function taking the same arguments as
+            Cleaner.simple_clean
+        """
+        basic = {}
+
+        def basic_clean(text):
+            if text not in basic:
+                basic[text] = cleaner.basic_clean(text)
+            return basic[text]
+
+        def scheme_cleaner(cl):
+            return lambda text, known_only=True: cl.finish_clean(
+                basic_clean(text), known_only
+            )
+
+        return {
+            scheme: scheme_cleaner(coder.cl) for scheme, coder in self.coders.items()
+        }
+
+    def code_record(self, title: str, sector: str = None, description: str = None):
+        """
+        Codes an individual job title, with optional sector and description
+        text, to every scheme
+
+        Keyword arguments:
+            title, sector, description -- as for Coder.code_record
+        Returns:
+            dict of scheme to the result Coder.code_record gives for it
+        """
+        results = {}
+        for scheme, clean in self._shared_cleaners().items():
+            clean_title = clean(title)
+            all_text = clean_title
+            for text in [sector, description]:
+                if text:
+                    all_text = all_text + " " + clean(text, known_only=False)
+            results[scheme] = self.coders[scheme]._code_cleaned(clean_title, all_text)
+        return results
+
+    def code_data_frame(
+        self,
+        record_df,
+        title_column: str = "job_title",
+        sector_column: str = None,
+        description_column: str = None,
+        deduplicate: bool = None,
+        output_width: int = None,
+    ):
+        """
+        Applies tool to all rows in a provided pandas DataFrame, for every
+        scheme
+
+        Keyword arguments:
+            record_df, title_column, sector_column, description_column,
+            deduplicate, output_width -- as for Coder.code_data_frame
+        Returns:
+            record_df: a final coded dataframe, with the columns
+                Coder.code_data_frame adds for each scheme. In multi output
+                these are prefixed with the scheme, e.g. "ISCO_prediction 1".
+        """
+        first_coder = next(iter(self.coders.values()))
         try:
-            name = self.mg_buckets.loc[
-                self.mg_buckets[f"{self.scheme.upper()}_code"] == code,
-                "Title",
-            ].values[0]
-        except IndexError:
-            name = ""
-        return name
+            record_df = first_coder.check_input_df(
+                record_df, title_column, description_column, sector_column
+            )
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+
+        columns = [title_column, sector_column, description_column]
+        if deduplicate is None:
+            deduplicate = description_column is None
+        if deduplicate:
+            first, inverse = _unique_rows(record_df, columns)
+            coding_df = record_df.iloc[first]
+        else:
+            coding_df = record_df
+
+        # The scheme independent part of cleaning is done once for every scheme
+        basic = {
+            column: cleaner.basic_clean_series(_blank_empty(coding_df[column]))
+            for column in columns
+            if column is not None
+        }
+        coded = [record_df]
+        for scheme, coder in self.coders.items():
+            results = coder._code_columns(coding_df, *columns, basic=basic)
+            if deduplicate:
+                results = pd.Series(
+                    results.to_numpy()[inverse], index=record_df.index, dtype=object
+                )
+            coded_df = coder._result_frame(results, output_width)
+            if coder.output == "multi" and coded_df.columns[0] != f"{scheme.upper()}_code":
+                coded_df = coded_df.add_prefix(f"{scheme.upper()}_")
+            coded.append(coded_df)
+        return pd.concat(coded, axis=1)
+
+    def stats(self):
+        """Returns: dict of scheme to the Coder's stats, see Coder.stats"""
+        return {scheme: coder.stats() for scheme, coder in self.coders.items()}
+
+
+def _init_worker(coder, settings, updates=()):
+    """
+    Sets up a worker process for parallel coding, either with the Coder it
+    was forked with, or by building one from the given settings and repeating
+    the updates made to the original since it was built
+    """
+    global _worker_coder
+    if coder is None:
+        coder = Coder(**settings)
+        for method, args in updates:
+            getattr(coder, method)(*args)
+    _worker_coder = coder
+
+
+def _code_chunk(chunk, columns):
+    """
+    Codes a chunk of records in a worker process, returning the codes and the
+    worker's stats for the chunk
+    """
+    _worker_coder.reset_stats()
+    # Parallelism comes from the processes, so fuzzy match in a single thread
+    codes = _worker_coder._code_columns(chunk, *columns, workers=1).to_numpy()
+    return codes, _worker_coder._stats_counts()
+
+
+def _unique_rows(record_df, columns, verbose=True):
+    """
+    Helper, finds the unique combinations of values in some columns of a
+    DataFrame
+
+    Keyword arguments:
+        record_df -- pandas DataFrame
+        columns -- list of column names, any that are None are ignored
+        verbose -- whether to print how many are unique
+    Returns:
+        tuple of the positions of the first row with each combination, and the
+        position in those of each row's combination
+    """
+    columns = [col for col in columns if col is not None]
+    keys = np.column_stack([pd.factorize(record_df[col])[0] for col in columns])
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    if verbose and len(record_df):
+        print(
+            f"Coding {len(first)} unique records, "
+            f"{len(first) / len(record_df):.1%} of the total"
+        )
+    return first, inverse.reshape(-1)
+
+
+def _blank_empty(texts):
+    """
+    Helper, replaces empty values of a text column, such as None, with empty
+    strings, as they are not coded
+    """
+    return texts.where(texts.astype(bool), "")
+
+
+def _is_arrow(data):
+    """Helper, whether data is a pyarrow Table or RecordBatch"""
+    # Checked by type, so that pyarrow need not be imported
+    return type(data).__module__.startswith("pyarrow")
+
+
+def _arrow_to_table(data):
+    """Helper, a pyarrow Table of the data in a Table or RecordBatch"""
+    import pyarrow as pa
+
+    if isinstance(data, pa.RecordBatch):
+        return pa.Table.from_batches([data])
+    return data
+
+
+def _report_progress(progress, done, total, tic):
+    """
+    Helper, calls a progress function with the records done so far, the total
+    and the estimated seconds left, from the rate since tic
+    """
+    if progress is None:
+        return
+    eta = None
+    if tic is not None and total is not None and done:
+        eta = (total - done) * (time.perf_counter() - tic) / done
+    elif done == total:
+        eta = 0.0
+    progress(done, total, eta)
+
+
+def format_stats(stats):
+    """
+    Lays out the stats of a Coder as a table of stages, for printing
+
+    Keyword arguments:
+        stats -- dict, as returned by Coder.stats
+    Returns:
+        string, the formatted table
+    """
+    lines = [f"{'Stage':<8}{'Records':>12}{'Seconds':>12}{'Records/s':>14}"]
+    for stage, stage_stats in stats["stages"].items():
+        rate = stage_stats["records_per_second"]
+        lines.append(
+            f"{stage:<8}{stage_stats['records']:>12}{stage_stats['seconds']:>12.3f}"
+            + (f"{rate:>14.0f}" if rate is not None else f"{'-':>14}")
+        )
+    outcomes = stats["outcomes"]
+    lines.append(
+        f"Records coded: {stats['records']} ({outcomes['cached']} from the result "
+        f"cache, {outcomes['exact']} exact matches, "
+        f"{outcomes['fuzzy']} fuzzy matches, {outcomes['fallback']} broader "
+        f"groups, {outcomes['no_text']} without text)"
+    )
+    cache = stats["clean_cache"]
+    if cache["hit_rate"] is not None:
+        lines.append(
+            f"Cleaning cache: {cache['hits']} hits, {cache['misses']} misses "
+            f"({cache['hit_rate']:.1%})"
+        )
+    result_cache = stats["result_cache"]
+    if result_cache["hit_rate"] is not None:
+        lines.append(
+            f"Result cache: {result_cache['hits']} hits, {result_cache['misses']} "
+            f"misses ({result_cache['hit_rate']:.1%})"
+        )
+    if stats["records_per_second"] is not None:
+        lines.append(f"Records per second: {stats['records_per_second']:.0f}")
+    return "\n".join(lines)
+
 
 def get_example_file():
     """Path to the bundled example dataset."""
@@ -456,11 +2116,68 @@ def parse_cli_input():
         help='Whether to return job titles for codes: "all", "best", or "none"',
         default=config["user"]["get_titles"],
     )
+    arg_parser.add_argument(
+        "--chunksize",
+        help="Number of records to read, code and write at a time, for large files",
+        type=int,
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--workers",
+        help="Number of worker processes to code with",
+        type=int,
+        default=1,
+    )
+    arg_parser.add_argument(
+        "--threads",
+        help="Number of threads to code with, sharing one model, instead of "
+        "worker processes",
+        type=int,
+        default=1,
+    )
+    arg_parser.add_argument(
+        "--hierarchical",
+        help="Find candidate codes coarse to fine, through each level of the scheme",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "--fallback_score",
+        help="With --hierarchical, fuzzy match score below which records are "
+        "coded to a broader group",
+        type=float,
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--result_cache",
+        help="Directory to keep a cache of coded results in, reused across runs",
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--result_cache_size",
+        help="Most results kept in the result cache",
+        type=int,
+        default=CACHE_SIZE,
+    )
+    arg_parser.add_argument(
+        "--profile",
+        help="Print a breakdown of where coding time went",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "--profile_out",
+        help="File to save cProfile stats for the coding run to",
+        default=None,
+    )
     args = arg_parser.parse_args()
     return args
 
 def main():
     freeze_support()
+    if sys.argv[1:2] == ["serve"]:
+        # The local coding service has its own arguments, see oc3i.server
+        from oc3i import server
+
+        return server.main(sys.argv[2:])
     args = parse_cli_input()
 
     in_file = (
@@ -475,8 +2192,6 @@ def main():
         or Path.cwd() / "output.csv"
     )
 
-    df = pd.read_csv(in_file)
-
     print("\nRunning coder with the following settings:\n")
     print("Input file: " + str(in_file))
     print("Coding to scheme: " + args.scheme)
@@ -485,22 +2200,96 @@ def main():
     print("Data column job titles: " + args.title_col)
     print("Data column job sector: " + args.sector_col)
     print("Data column job description: " + args.description_col)
+    print("Hierarchical matching: " + str(args.hierarchical))
+    print("Result cache: " + str(args.result_cache or "none"))
+    print("Worker processes: " + str(args.workers))
+    print("Threads: " + str(args.threads))
+    print("Chunk size: " + str(args.chunksize or "all records at once"))
     print("Output file: " + str(out_file) + "\n")
 
-    commCoder = Coder(scheme=args.scheme, output=args.output, get_titles=args.get_titles)
-    proc_tic = time.perf_counter()
-    df = commCoder.code_data_frame(
-        df,
-        title_column=args.title_col,
-        sector_column=args.sector_col,
-        description_column=args.description_col,
+    commCoder = Coder(
+        scheme=args.scheme,
+        output=args.output,
+        get_titles=args.get_titles,
+        hierarchical=args.hierarchical,
+        fallback_score=args.fallback_score,
+        result_cache=args.result_cache,
+        result_cache_size=args.result_cache_size,
     )
+    profiler = None
+    if args.profile_out:
+        # Only needed when profiling
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    commCoder.reset_stats()
+    proc_tic = time.perf_counter()
+    columnar_file = columnar.is_columnar(in_file) or columnar.is_columnar(out_file)
+    # Columnar files and chunks are written out as they are coded
+    streamed = columnar_file or bool(args.chunksize)
+    if columnar_file:
+        # Parquet and Arrow files are coded a row group at a time, or
+        # chunksize records at a time if that is smaller
+        coded = columnar.code_file(
+            commCoder,
+            in_file,
+            out_file,
+            title_column=args.title_col,
+            sector_column=args.sector_col,
+            description_column=args.description_col,
+            batch_size=args.chunksize,
+            workers=args.workers,
+            threads=args.threads,
+        )
+        df = coded.slice(0, 5).to_pandas() if coded is not None else None
+    elif args.chunksize:
+        # Stream through the file, writing out each chunk once it is coded
+        chunks = pd.read_csv(in_file, chunksize=args.chunksize)
+        coded_chunks = commCoder.code_data_frame_chunks(
+            chunks,
+            title_column=args.title_col,
+            sector_column=args.sector_col,
+            description_column=args.description_col,
+            workers=args.workers,
+            threads=args.threads,
+        )
+        df = None
+        for coded in coded_chunks:
+            coded.to_csv(
+                out_file,
+                mode="w" if df is None else "a",
+                header=df is None,
+                index=False,
+                encoding="utf-8",
+            )
+            if df is None:
+                df = coded.head()
+    else:
+        df = pd.read_csv(in_file)
+        df = commCoder.code_data_frame(
+            df,
+            title_column=args.title_col,
+            sector_column=args.sector_col,
+            description_column=args.description_col,
+            workers=args.workers,
+            threads=args.threads,
+        )
     proc_toc = time.perf_counter()
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile_out)
     output_dir.mkdir(parents=True, exist_ok=True)
     print("Actual coding ran in: {}".format(proc_toc - proc_tic))
+    if args.profile:
+        print("\nStage breakdown:\n" + format_stats(commCoder.stats()) + "\n")
+    if args.profile_out:
+        print("cProfile stats written to:", args.profile_out)
     print("occupationcoder message:\n" + "Coding complete. Showing first results...")
-    print(df.head())
-    df.to_csv(out_file, index=False, encoding="utf-8")
+    print(df.head() if df is not None else "No records to code.")
+    if not streamed:
+        # Written after timing, so "Actual coding" is the coding alone
+        df.to_csv(out_file, index=False, encoding="utf-8")
     print("Coding complete, output written to:", out_file)
 
 if __name__ == "__main__":
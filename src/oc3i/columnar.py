@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Parquet and Arrow files.
+
+Reads records from, and writes coded records to, Parquet and Arrow IPC
+(Feather) files, a row group or record batch at a time. The columns a Coder
+does not need pass through from input to output without being converted.
+
+Needs the optional pyarrow dependency, installed with
+
+    pip install occupationcoder-international[parquet]
+"""
+import pandas as pd
+
+from pathlib import Path
+from contextlib import nullcontext
+
+# File suffixes read and written as each format, anything else is CSV
+PARQUET_SUFFIXES = {".parquet", ".pq"}
+ARROW_SUFFIXES = {".arrow", ".feather", ".ipc"}
+
+
+def file_format(path):
+    """The format of a file from its suffix: "parquet", "arrow" or "csv" """
+    suffix = Path(str(path)).suffix.lower()
+    if suffix in PARQUET_SUFFIXES:
+        return "parquet"
+    if suffix in ARROW_SUFFIXES:
+        return "arrow"
+    return "csv"
+
+
+def is_columnar(path):
+    """Whether a file is read or written as Parquet or Arrow"""
+    return file_format(path) != "csv"
+
+
+def _import_pyarrow():
+    """Helper, imports pyarrow, explaining how to install it if it is missing"""
+    try:
+        import pyarrow
+    except ImportError as e:
+        raise ImportError(
+            "Parquet and Arrow files need pyarrow, install it with: "
+            "pip install occupationcoder-international[parquet]"
+        ) from e
+    return pyarrow
+
+
+def read_tables(path, batch_size=None):
+    """
+    Reads a Parquet, Arrow or CSV file a piece at a time
+
+    Keyword arguments:
+        path -- file to read
+        batch_size -- most rows in each piece (default None, a row group of a
+                      Parquet file, a record batch of an Arrow file, or all of
+                      a CSV file at a time)
+    Yields:
+        pyarrow Tables of the file's records, in order
+    """
+    pa = _import_pyarrow()
+    fmt = file_format(path)
+    if fmt == "csv":
+        chunks = (
+            pd.read_csv(path, chunksize=batch_size) if batch_size else [pd.read_csv(path)]
+        )
+        for chunk in chunks:
+            yield pa.Table.from_pandas(chunk, preserve_index=False)
+        return
+
+    for table in _read_pieces(pa, path, fmt):
+        if not batch_size:
+            yield table
+            continue
+        # Slices share the table's memory
+        for start in range(0, len(table), batch_size):
+            yield table.slice(start, batch_size)
+
+
+def _read_pieces(pa, path, fmt):
+    """Helper, yields the row groups or record batches of a file as Tables"""
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        for i in range(parquet_file.num_row_groups):
+            yield parquet_file.read_row_group(i)
+    else:
+        with pa.memory_map(str(path)) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield pa.Table.from_batches([reader.get_batch(i)])
+
+
+class TableWriter:
+    def __init__(self, path):
+        """
+        Writes pyarrow Tables one after another to a Parquet, Arrow or CSV
+        file, chosen by the file's suffix. Every table is written with the
+        schema of the first.
+
+        Keyword arguments:
+        path:str
+            file to write to, replacing any existing file
+        """
+        self.path = path
+        self.format = file_format(path)
+        self.schema = None
+        self._writer = None
+        self._csv_started = False
+
+    def write(self, table):
+        """Writes a pyarrow Table to the end of the file"""
+        pa = _import_pyarrow()
+        if self.schema is None:
+            self.schema = table.schema
+            if self.format == "parquet":
+                import pyarrow.parquet as pq
+
+                self._writer = pq.ParquetWriter(self.path, self.schema)
+            elif self.format == "arrow":
+                self._writer = pa.ipc.new_file(str(self.path), self.schema)
+        elif not table.schema.equals(self.schema):
+            # For example a column of a CSV chunk that was all missing
+            table = table.cast(self.schema)
+
+        if self._writer is not None:
+            self._writer.write_table(table)
+        else:
+            table.to_pandas().to_csv(
+                self.path,
+                mode="a" if self._csv_started else "w",
+                header=not self._csv_started,
+                index=False,
+                encoding="utf-8",
+            )
+            self._csv_started = True
+
+    def close(self):
+        """Finishes writing the file"""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def code_file(
+    commCoder,
+    in_file,
+    out_file,
+    title_column="job_title",
+    sector_column=None,
+    description_column=None,
+    batch_size=None,
+    deduplicate=None,
+    workers=1,
+    output_width=None,
+    threads=1,
+):
+    """
+    Codes the records in a file a piece at a time, writing each piece to the
+    output file once it is coded. Either file may be Parquet, Arrow or CSV.
+
+    Keyword arguments:
+        commCoder -- Coder to code with
+        in_file, out_file -- files to read records from and write them to
+        title_column, sector_column, description_column, deduplicate,
+        workers, threads -- as for Coder.code_data_frame
+        batch_size -- most records to code at a time, as for read_tables
+        output_width -- for multi output, number of prediction and score
+                        columns (default None, MULTI_OUTPUT_WIDTH, so that
+                        every piece has the same columns)
+    Returns:
+        pyarrow Table, the first coded piece, or None if there were no records
+    """
+    # Imported here, as the coder module imports this one
+    from oc3i.coder import MULTI_OUTPUT_WIDTH
+
+    first = None
+    # One pool of worker processes codes every piece
+    pool_context = commCoder.worker_pool(workers) if workers != 1 else nullcontext()
+    with TableWriter(out_file) as writer, pool_context as pool:
+        for table in read_tables(in_file, batch_size):
+            coded = commCoder.code_data_frame(
+                table,
+                title_column=title_column,
+                sector_column=sector_column,
+                description_column=description_column,
+                deduplicate=deduplicate,
+                workers=workers,
+                output_width=output_width or MULTI_OUTPUT_WIDTH,
+                threads=threads,
+                pool=pool,
+                # Messages about the run are printed for the first piece only
+                verbose=first is None,
+            )
+            writer.write(coded)
+            if first is None:
+                first = coded
+    return first
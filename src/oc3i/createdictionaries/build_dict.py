@@ -5,8 +5,11 @@ import pandas as pd
 from pathlib import Path
 from unidecode import unidecode
 from datetime import datetime
+from functools import partial
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
 
-from oc3i import cleaner
+from oc3i import cleaner, processes
 
 config = cleaner.load_config()
 CURRENT_DIR = Path(__file__).resolve()
@@ -15,6 +18,15 @@ lookup_dir = (PACKAGE_ROOT / config["dirs"]["lookup_dir"]).resolve()
 
 cl = cleaner.Cleaner(scheme="")
 
+# Bracketed list markers, e.g. "(a)", removed from bucket text
+PATTERN_BRACKET_LIST = re.compile(r"\([a-z]\)")
+
+# Shortest exact match title kept, in characters
+MIN_TITLE_LENGTH = 4
+
+# Number of distinct texts cleaned by a worker process at once
+CLEAN_CHUNK_SIZE = 2000
+
 
 def aggregate_buckets(
     dataframe, level=None, code_col=None, content_col=None, type=None
@@ -51,7 +63,7 @@ def aggregate_buckets(
         combined_df = (
             dataframe[[code_col, content_col]]
             .groupby(code_col)
-            .agg(lambda x: sum(x, []))
+            .agg(lambda x: list(chain.from_iterable(x)))
             .reset_index()
         )
 
@@ -108,10 +120,10 @@ def remove_substr(df_col, exclude_text=None):
     if exclude_text is None:
         raise ValueError("No substring to remove specified!")
 
-    if df_col.name in exclude_text:
-        exclude = exclude_text[df_col.name]
-        for txt in exclude:
-            df_col = df_col.apply(lambda x: str(x).replace(txt, ""))
+    if df_col.name in exclude_text and exclude_text[df_col.name]:
+        df_col = df_col.astype(str)
+        for txt in exclude_text[df_col.name]:
+            df_col = df_col.str.replace(txt, "", regex=False)
     return df_col
 
 
@@ -132,11 +144,12 @@ def column_cleaner(df_col):
 
     """
     df_col = df_col.fillna("")
-    df_col = df_col.apply(unidecode)
-    return df_col
+    # Each distinct value is only decoded once
+    values = df_col.unique()
+    return df_col.map(dict(zip(values, map(unidecode, values))))
 
 
-def list_exact_titles(titles, min_text_length = 4):
+def list_exact_titles(titles, min_text_length = MIN_TITLE_LENGTH):
     """
     Helper function to apply simple_clean() on a list consisting of text string elements.
     Addtionally removes any very short text list elements (shorter than min_text_length).
@@ -152,9 +165,8 @@ def list_exact_titles(titles, min_text_length = 4):
         # >>> list_exact_titles(test_list)
 
     """
-    result = [cl.simple_clean(s, advanced=False) for s in titles]
-    result = [s for s in result if len(s) >= min_text_length]
-    return result
+    result = cl.clean_series(pd.Series(titles, dtype=object), advanced=False)
+    return [s for s in result.tolist() if len(s) >= min_text_length]
 
 
 def save_json(jsondata, filename=None):
@@ -197,6 +209,110 @@ def save_json(jsondata, filename=None):
         json.dump(jsondata, json_file, indent=4)
 
 
+def _clean_bucket_texts(texts, exclude=(), exclude_pattern=None):
+    """
+    Helper, cleans values of a word bucket column: decodes them to ASCII,
+    removes excluded substrings and patterns, hard returns and bracketed list
+    markers, then applies clean_series
+
+    Returns: list of cleaned strings
+    """
+    result = []
+    for text in texts:
+        text = unidecode(text)
+        for txt in exclude:
+            text = text.replace(txt, "")
+        if exclude_pattern is not None:
+            text = re.sub(exclude_pattern, "", text)
+        text = text.replace("\n", " ")
+        result.append(PATTERN_BRACKET_LIST.sub("", text))
+    return cl.clean_series(pd.Series(result, dtype=object), known_only=False).tolist()
+
+
+def _clean_exact_texts(texts, exclude=(), split=""):
+    """
+    Helper, cleans values of an exact match column: removes excluded
+    substrings, decodes them to ASCII, and splits them into lists of titles
+    cleaned as list_exact_titles does, all at once
+
+    Returns: list of lists of cleaned titles
+    """
+    split_texts = []
+    for text in texts:
+        for txt in exclude:
+            text = str(text).replace(txt, "")
+        split_texts.append(unidecode(text).split(split))
+    cleaned = iter(list_exact_titles(list(chain.from_iterable(split_texts)), 0))
+    return [
+        [title for title in (next(cleaned) for _ in titles) if len(title) >= MIN_TITLE_LENGTH]
+        for titles in split_texts
+    ]
+
+
+def _call(func, values):
+    """Helper, calls func on values, for mapping different functions in a pool"""
+    return func(values)
+
+
+def _clean_distinct(columns, workers=None, chunk_size=CLEAN_CHUNK_SIZE):
+    """
+    Helper, cleans the distinct values of several columns, in chunks spread
+    over a pool of worker processes
+
+    Keyword arguments:
+        columns -- list of (column, function) pairs, each function taking a
+                   list of a column's values and returning their cleaned values
+        workers -- num. worker processes (default None, one per core), 1 to
+                   clean in this process
+        chunk_size -- num. distinct values sent to a worker at once
+    Returns:
+        list of cleaned columns, as pandas Series aligned with the inputs
+    """
+    distinct = []
+    tasks = []
+    for df_col, func in columns:
+        values = df_col.unique().tolist()
+        distinct.append(values)
+        for start in range(0, len(values), chunk_size):
+            tasks.append((func, values[start : start + chunk_size]))
+
+    if workers == 1 or len(tasks) <= 1:
+        results = [func(values) for func, values in tasks]
+    else:
+        context, _ = processes.worker_context()
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            results = list(pool.map(_call, *zip(*tasks)))
+
+    cleaned = iter(chain.from_iterable(results))
+    cleaned_columns = []
+    for (df_col, _), values in zip(columns, distinct):
+        lookup = {value: next(cleaned) for value in values}
+        cleaned_columns.append(
+            pd.Series(
+                [lookup[value] for value in df_col],
+                index=df_col.index,
+                name=df_col.name,
+                dtype=object,
+            )
+        )
+    return cleaned_columns
+
+
+def compile_model(scheme):
+    """
+    Builds and saves the compiled runtime model for a scheme's dictionaries in
+    lookup_dir, as a Coder for the scheme would the first time it is created
+
+    Keyword arguments:
+        scheme -- name of the scheme, whose dictionaries are saved as
+                  <scheme>/buckets_<scheme>.json and <scheme>/titles_<scheme>.json
+    """
+    # Imported here, as the coder imports this module
+    from oc3i.coder import Coder
+
+    Coder(lookup_dir=lookup_dir, scheme=scheme)
+
+
 # Takes given Pd dataframe, processes specified columns (calls column_cleaner, simple_clean), puts back into working df
 def process_file(
     input_df,
@@ -209,6 +325,8 @@ def process_file(
     output_files={"buckets": "buckets.json", "exact": "titles.json"},
     bucket_field_names=["code", "description"],
     level=None,
+    workers=None,
+    scheme=None,
 ):
     """
     Processes a given dataframe representing a code scheme (codes, descriptions, tasks, etc).
@@ -243,6 +361,11 @@ def process_file(
         Defaults: ['code','description'].
         level (list, optional): List of level codes (numbers) to process. If not specified (default: None),
         all levels present in input are included.
+        workers (int, optional): Number of worker processes to clean text in. Default: None, one per core;
+        1 cleans everything in this process.
+        scheme (str, optional): If given, the compiled runtime model for this scheme is built and saved once
+        the JSON files are written, so the first Coder for the scheme does not have to. Needs output_files
+        to be '<scheme>/buckets_<scheme>.json' and '<scheme>/titles_<scheme>.json'. Default: None.
     Returns:
         Nothing, saves output as specified JSON files.
 
@@ -256,24 +379,32 @@ def process_file(
     # Keep original titles for future storage:
     orig_titles = buckets_df["Title EN"]
     
-    for col in bucket_cols:
-
-        buckets_df[col] = column_cleaner(buckets_df[col])
-        buckets_df[col] = remove_substr(buckets_df[col], exclude_text=exclude_text)
-        if exclude_pattern is not None:
-            buckets_df[col] = buckets_df[col].apply(
-                lambda x: re.sub(exclude_pattern, "", x)
-            )
-
-        buckets_df[col] = buckets_df[col].apply(lambda x: str(x).replace("\n", " "))
-        pattern_bracket_list = r"\([a-z]\)"
-        buckets_df[col] = buckets_df[col].apply(
-            lambda x: re.sub(pattern_bracket_list, "", x)
+    # Each distinct value of each column is cleaned once, across processes:
+    columns = [
+        (
+            buckets_df[col].fillna(""),
+            partial(
+                _clean_bucket_texts,
+                exclude=exclude_text.get(col, []),
+                exclude_pattern=exclude_pattern,
+            ),
         )
-
-        buckets_df[col] = buckets_df[col].apply(
-            lambda x: cl.simple_clean(x, known_only=False)
+        for col in bucket_cols
+    ]
+    if exact_col != "":
+        columns.append(
+            (
+                input_df[exact_col].fillna(""),
+                partial(
+                    _clean_exact_texts,
+                    exclude=exclude_text.get(exact_col, []),
+                    split=exact_col_split,
+                ),
+            )
         )
+    cleaned = _clean_distinct(columns, workers=workers)
+    for col, cleaned_col in zip(bucket_cols, cleaned):
+        buckets_df[col] = cleaned_col
 
     # Reattach original titles:
     buckets_df["Title"] = orig_titles
@@ -289,9 +420,10 @@ def process_file(
     buckets_code = bucket_field_names[0]
     buckets_code_name = bucket_field_names[1]
     buckets_description_name = bucket_field_names[2]
-    buckets_df[buckets_description_name] = buckets_df.apply(
-        lambda row: " ".join(row[bucket_cols]), axis=1
-    )
+    descriptions = buckets_df[bucket_cols[0]]
+    for col in bucket_cols[1:]:
+        descriptions = descriptions + " " + buckets_df[col]
+    buckets_df[buckets_description_name] = descriptions
     buckets_df[buckets_code] = buckets_df[code_col]
     buckets_json = buckets_df[[buckets_code, buckets_code_name, buckets_description_name]].to_dict(
         orient="records"
@@ -300,14 +432,7 @@ def process_file(
 
     # Exact match JSON processing:
     if exact_col != "":
-        input_df[exact_col] = remove_substr(
-            input_df[exact_col], exclude_text=exclude_text
-        )
-        input_df[exact_col] = column_cleaner(input_df[exact_col])
-        input_df[exact_col] = input_df[exact_col].apply(
-            lambda x: x.split(exact_col_split)
-        )
-        input_df[exact_col] = input_df[exact_col].apply(lambda x: list_exact_titles(x))
+        input_df[exact_col] = cleaned[-1]
 
         # Remove any levels not desired:
         if level == 4:
@@ -321,6 +446,9 @@ def process_file(
         exact_json = dict(zip(input_df[code_col], input_df[exact_col]))
         save_json(exact_json, filename=output_files["exact"])
 
+    if scheme is not None:
+        compile_model(scheme)
+
 
 if __name__ == "__main__":
     # print("Please see 'building_custom_dictionaries.ipynb' for information on how to use the functionality in this module.")
@@ -361,4 +489,5 @@ if __name__ == "__main__":
         },
         bucket_field_names=["ISCO_code", "Title", "Titles_nospace"],
         level=4,
+        scheme="isco",
     )
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled runtime model for a coding scheme.
+
+Building a Coder cleans every dictionary title and fits a TF-IDF model over
+the scheme's buckets, which takes seconds. The results are saved next to the
+scheme's dictionaries, keyed by a hash of the files they were built from and
+the package version, and loaded from there while that key still matches.
+"""
+import os
+import struct
+import zipfile
+import hashlib
+import tempfile
+import warnings
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+from oc3i import __version__
+from oc3i.titles import TitleStore
+
+
+def model_file(lookup_dir, scheme: str):
+    """Path of the compiled model for a scheme, next to its dictionaries"""
+    return Path(lookup_dir) / scheme / f"compiled_{scheme}.npz"
+
+
+def dictionary_hash(files, *extra):
+    """
+    Hashes the dictionary files a model is built from, along with the package
+    version and any other settings that change the model
+
+    Keyword arguments:
+        files -- list of paths to dictionary files
+        extra -- any further values to include in the hash
+    Returns:
+        string, hex digest identifying the model
+    """
+    digest = hashlib.sha256()
+    for item in (__version__, *extra):
+        digest.update(str(item).encode("utf-8") + b"\0")
+    for file in files:
+        digest.update(Path(file).read_bytes() + b"\0")
+    return digest.hexdigest()
+
+
+def new_vectorizer():
+    """The TF-IDF vectorizer used to match records to scheme buckets"""
+    # Imported here as scikit-learn is slow to import
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    return TfidfVectorizer(stop_words="english", ngram_range=(1, 3))
+
+
+def _pack(strings):
+    """Helper, packs a list of strings into one UTF-8 buffer and offsets"""
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in strings], out=offsets[1:])
+    pool = np.frombuffer("".join(strings).encode("utf-8"), dtype=np.uint8)
+    return pool, offsets
+
+
+def _unpack(pool, offsets):
+    """Helper, inverse of _pack"""
+    text = pool.tobytes().decode("utf-8")
+    offsets = offsets.tolist()
+    return [text[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+
+
+def save_model(path, key, titles, mg_buckets, tfidf, tfidf_matrix):
+    """
+    Saves a compiled model. The file is written to a temporary name and then
+    moved into place, so other processes never load a partial model. Failing
+    to write, for example to a read-only install, only raises a warning.
+
+    Keyword arguments:
+        path -- path to save the model to
+        key -- string identifying the model, from dictionary_hash
+        titles -- TitleStore of cleaned titles
+        mg_buckets -- DataFrame of scheme buckets
+        tfidf -- fitted TfidfVectorizer
+        tfidf_matrix -- sparse matrix of TF-IDF vectors for the buckets
+    """
+    import scipy.sparse as sp
+
+    arrays = {"key": np.array(key)}
+    for name, array in titles.to_arrays().items():
+        arrays[f"titles_{name}"] = array
+    arrays["bucket_columns"], arrays["bucket_columns_offsets"] = _pack(
+        list(mg_buckets.columns)
+    )
+    for i, column in enumerate(mg_buckets.columns):
+        arrays[f"bucket_{i}"], arrays[f"bucket_{i}_offsets"] = _pack(
+            mg_buckets[column].to_list()
+        )
+    terms = sorted(tfidf.vocabulary_, key=tfidf.vocabulary_.get)
+    arrays["terms"], arrays["terms_offsets"] = _pack(terms)
+    arrays["idf"] = tfidf.idf_
+    tfidf_matrix = sp.csr_matrix(tfidf_matrix)
+    arrays["data"] = tfidf_matrix.data
+    arrays["indices"] = tfidf_matrix.indices
+    arrays["indptr"] = tfidf_matrix.indptr
+    arrays["shape"] = np.array(tfidf_matrix.shape)
+
+    path = Path(path)
+    tmp_name = None
+    try:
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, prefix=path.name, delete=False
+        ) as outfile:
+            tmp_name = outfile.name
+            np.savez(outfile, **arrays)
+        os.chmod(tmp_name, 0o644)
+        os.replace(tmp_name, path)
+    except OSError as e:
+        warnings.warn(f"Could not save compiled model to {path}: {e}")
+        if tmp_name is not None and os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
+
+def load_model(path, key):
+    """
+    Loads a compiled model, if one exists and was built with the given key
+
+    Keyword arguments:
+        path -- path the model was saved to
+        key -- string identifying the expected model, from dictionary_hash
+    Returns:
+        dict of titles, mg_buckets, tfidf and tfidf_matrix as passed to
+        save_model, or None if there is no valid model
+    """
+    try:
+        with np.load(path, allow_pickle=False) as arrays:
+            if str(arrays["key"]) != key:
+                return None
+            return _read_arrays(arrays, _map_arrays(path, "titles_"))
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        # Missing, unreadable or from an older layout, so needs rebuilding
+        return None
+
+
+def _map_arrays(path, prefix):
+    """
+    Helper, memory maps the arrays in an npz file whose names start with
+    prefix. np.load reads the members of an npz into memory whatever its
+    mmap_mode, but np.savez stores them uncompressed, so each can be mapped
+    where its data starts in the file. Processes mapping the same file share
+    one copy of the arrays through the page cache.
+
+    Keyword arguments:
+        path -- path to an npz file written by np.savez
+        prefix -- start of the names of the arrays to map
+    Raises:
+        ValueError, if an array is compressed or in an unsupported format
+    Returns:
+        dict of name, without the prefix, to read-only array
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as infile:
+        for info in archive.infolist():
+            name = info.filename[: -len(".npy")]
+            if not name.startswith(prefix):
+                continue
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{info.filename} is compressed")
+            # The data follows the member's local header, whose name and extra
+            # field can differ in length from the central directory's
+            infile.seek(info.header_offset)
+            header = infile.read(30)
+            name_length, extra_length = struct.unpack("<HH", header[26:30])
+            infile.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(infile)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(infile)
+            elif version == (2, 0):
+                header = np.lib.format.read_array_header_2_0(infile)
+            else:
+                raise ValueError(f"{info.filename} has unsupported version {version}")
+            shape, fortran_order, dtype = header
+            if dtype.hasobject:
+                raise ValueError(f"{info.filename} holds Python objects")
+            if int(np.prod(shape)) == 0:
+                # An empty map is not allowed
+                array = np.empty(shape, dtype=dtype)
+            else:
+                array = np.memmap(
+                    infile,
+                    dtype=dtype,
+                    mode="r",
+                    offset=infile.tell(),
+                    shape=shape,
+                    order="F" if fortran_order else "C",
+                )
+            arrays[name[len(prefix) :]] = array
+    return arrays
+
+
+def _read_arrays(arrays, title_arrays):
+    """
+    Helper, rebuilds a model from the arrays saved by save_model
+
+    Keyword arguments:
+        arrays -- the saved arrays, as loaded by np.load
+        title_arrays -- the arrays of the TitleStore, which may be memory mapped
+    """
+    import scipy.sparse as sp
+
+    titles = TitleStore.from_arrays(title_arrays)
+
+    columns = _unpack(arrays["bucket_columns"], arrays["bucket_columns_offsets"])
+    mg_buckets = pd.DataFrame(
+        {
+            column: _unpack(arrays[f"bucket_{i}"], arrays[f"bucket_{i}_offsets"])
+            for i, column in enumerate(columns)
+        },
+        dtype=object,
+    )
+
+    terms = _unpack(arrays["terms"], arrays["terms_offsets"])
+    tfidf = new_vectorizer()
+    tfidf.vocabulary_ = dict(zip(terms, range(len(terms))))
+    tfidf.idf_ = arrays["idf"]
+
+    tfidf_matrix = sp.csr_matrix(
+        (arrays["data"], arrays["indices"], arrays["indptr"]),
+        shape=tuple(arrays["shape"]),
+    )
+
+    return {
+        "titles": titles,
+        "mg_buckets": mg_buckets,
+        "tfidf": tfidf,
+        "tfidf_matrix": tfidf_matrix,
+    }
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Start method for pools of worker processes.
+
+Forking a worker is fast, and it shares the parent's model copy-on-write, but
+forking a process after numpy, BLAS or scikit-learn have started threads can
+deadlock or crash. That is why macOS starts processes by spawning them by
+default, though it still offers fork. Workers are only forked where that is
+safe; elsewhere they are started the platform's default way, and are sent
+what they need to load the compiled model themselves.
+"""
+import sys
+import multiprocessing
+
+
+def worker_context():
+    """
+    The multiprocessing context to start worker processes with. Processes are
+    forked on Linux, or where fork was already chosen as the start method, and
+    otherwise started with the platform's default method.
+
+    Returns:
+        tuple of the context, and whether it forks processes
+    """
+    if (
+        multiprocessing.get_start_method(allow_none=True) == "fork"
+        or sys.platform.startswith("linux")
+    ):
+        return multiprocessing.get_context("fork"), True
+    context = multiprocessing.get_context()
+    return context, context.get_start_method() == "fork"
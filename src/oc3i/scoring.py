@@ -0,0 +1,518 @@
+# -*- coding: utf-8 -*-
+"""
+Inverted index for TF-IDF matching.
+
+A record's cleaned text shares n-grams with only some of a scheme's buckets.
+Rather than scoring it against every bucket, the index keeps a posting list
+per n-gram, of the buckets it appears in and its weight there, and only the
+buckets on the postings of a record's n-grams are scored and ranked.
+
+The hierarchical index goes further for schemes with levels of codes, scoring
+records against the broad groups first and then only the codes under their
+best groups.
+"""
+import numpy as np
+
+# Fractions of a record's best score below which the ranking prefilter drops
+# candidates, tried in turn until enough candidates are left to fill the top n
+PREFILTER_RATIOS = (0.9, 0.5, 0.0)
+
+# Fraction of buckets touched on average, above which records' scores are
+# ranked as dense arrays instead, which is then faster and no larger
+DENSE_FRACTION = 0.25
+
+# Most (records x buckets) scores ranked as a dense array. Beyond it, ranking
+# the candidates with the prefilter is faster however many buckets are touched,
+# and the array would take a lot of memory
+DENSE_MAX_CELLS = 10_000_000
+
+# Number of best groups each record is routed to at each level above the
+# scheme's codes, in hierarchical matching
+HIERARCHY_BEAM = 5
+
+
+class TfidfIndex:
+    def __init__(self, tfidf_matrix):
+        """
+        Builds the posting lists for a fitted TF-IDF matrix
+
+        Keyword arguments:
+        tfidf_matrix:scipy.sparse matrix
+            TF-IDF vectors of the buckets, one row per bucket
+        """
+        # Imported here as scikit-learn is slow to import
+        from sklearn.preprocessing import normalize
+
+        # One row of (bucket, weight) postings per term, with bucket vectors
+        # normalised so that dot products are cosine similarities
+        self.postings = normalize(tfidf_matrix).T.tocsr()
+        self.n_buckets = tfidf_matrix.shape[0]
+
+    def scores(self, vectors):
+        """
+        Similarities of records to the buckets they share terms with
+
+        Keyword arguments:
+            vectors -- sparse matrix of normalised TF-IDF vectors of records
+        Returns:
+            sparse (records x buckets) matrix of cosine similarities, holding
+            only the buckets touched by each record's postings
+        """
+        return (vectors @ self.postings).tocsr()
+
+    def top_n(self, vectors, top_n=5, prefilter=True):
+        """
+        Finds the top_n most similar buckets to each record, in the same order
+        as sorting the records' similarities to every bucket in full
+
+        Only the buckets on the postings of a record's terms are scored, in
+        one sparse product. Where those buckets tell its top_n apart, they are
+        ranked after a prefilter drops the candidates that score too far
+        below the record's best to make the top n. The prefilter only saves
+        ranking work, which for schemes of thousands of buckets takes far
+        longer than the product. Records that touch too few buckets, or have
+        ties around their top_n, are sorted in full.
+
+        Keyword arguments:
+            vectors -- sparse matrix of normalised TF-IDF vectors of records
+            top_n -- num. buckets to return for each record
+            prefilter -- whether to prefilter candidates before ranking them,
+                which never changes the results
+        Returns:
+            tuple of two (records x top_n) arrays, holding the indices of the
+            best matching buckets and their similarities, least similar first
+        """
+        n_records = vectors.shape[0]
+        top_n = min(top_n, self.n_buckets)
+        if top_n == 0:
+            return (
+                np.empty((n_records, 0), dtype=np.intp),
+                np.empty((n_records, 0), dtype=np.float64),
+            )
+
+        sim_scores = self.scores(vectors)
+        cells = n_records * self.n_buckets
+        if sim_scores.nnz > DENSE_FRACTION * cells and cells <= DENSE_MAX_CELLS:
+            sim_scores = sim_scores.toarray()
+            best = _dense_top_n(sim_scores, top_n)
+            return best, np.take_along_axis(sim_scores, best, axis=1)
+
+        best = np.empty((n_records, top_n), dtype=np.intp)
+        best_scores = np.empty((n_records, top_n), dtype=np.float64)
+        ranked, ranked_best, ranked_scores = _sparse_top_n(
+            sim_scores, top_n, PREFILTER_RATIOS if prefilter else (0.0,)
+        )
+        best[ranked] = ranked_best
+        best_scores[ranked] = ranked_scores
+
+        # Everything else is sorted in full, zero scores included
+        full = np.ones(n_records, dtype=bool)
+        full[ranked] = False
+        full = np.flatnonzero(full)
+        if len(full):
+            dense = sim_scores[full].toarray()
+            best[full] = dense.argsort()[:, -top_n:]
+            best_scores[full] = np.take_along_axis(dense, best[full], axis=1)
+        return best, best_scores
+
+    def top_n_one(self, columns, values, top_n=5):
+        """
+        Single record version of top_n, for low latency. Scores are summed
+        straight from the postings of the record's terms into a dense array,
+        adding in the same order as the sparse product in scores, so they are
+        the same to the last bit.
+
+        Keyword arguments:
+            columns -- ascending term columns of the record's TF-IDF vector
+            values -- the vector's normalised weights for those terms
+            top_n -- num. buckets to return
+        Returns:
+            tuple of two arrays, the indices of the top_n most similar buckets
+            and their similarities, least similar first
+        """
+        top_n = min(top_n, self.n_buckets)
+        sim_scores = np.zeros(self.n_buckets)
+        indptr, indices, data = (
+            self.postings.indptr,
+            self.postings.indices,
+            self.postings.data,
+        )
+        for column, value in zip(columns, values):
+            start, stop = indptr[column], indptr[column + 1]
+            sim_scores[indices[start:stop]] += value * data[start:stop]
+        if top_n == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float64)
+        best = _dense_top_n(sim_scores[None, :], top_n)[0]
+        return best, sim_scores[best]
+
+
+class HierarchicalIndex:
+    def __init__(self, levels, beam=HIERARCHY_BEAM):
+        """
+        Routes records down a scheme's hierarchy, coarse to fine: records are
+        scored against every group at the top level, then only against the
+        children of their best groups at each level below, down to the codes
+
+        Each level's postings are ordered by term and then by the parent of
+        the nodes on them, so the postings a record's term has under a kept
+        parent are one contiguous block. Scores are summed only over those
+        blocks, for the (record, node) pairs under the kept parents, without
+        touching the postings of any other nodes.
+
+        Keyword arguments:
+        levels:list
+            (codes, tfidf_matrix) for each level, from the coarsest to the
+            scheme's codes, with one matrix row per code. Each code's parent is
+            the code at the level above that it starts with.
+        beam:int
+            num. best groups at each level whose children are scored. More are
+            kept where needed for the codes below them to fill the top n.
+        """
+        # Imported here as scikit-learn is slow to import
+        from sklearn.preprocessing import normalize
+
+        self.beam = beam
+        self.codes = [np.asarray(codes) for codes, _ in levels]
+        self.n_buckets = len(self.codes[-1])
+
+        # For each level, the (children, child_starts, postings, term_blocks,
+        # block_parents, block_starts) that _route scores it with. Nodes are
+        # ordered by parent in children, with the top level's nodes all under a
+        # single root, and those of each parent start at child_starts[parent].
+        # postings holds a row of (position in children, weight) per term. Its
+        # runs of postings under the same parent are blocks, those of each term
+        # starting at term_blocks[term], with the parent of each block in
+        # block_parents and the start of its postings in block_starts
+        self._levels = []
+        parents = []
+        for level, (codes, tfidf_matrix) in enumerate(levels):
+            if level == 0:
+                n_parents = 1
+                node_parents = np.zeros(len(codes), dtype=np.intp)
+            else:
+                n_parents = len(self.codes[level - 1])
+                above = {code: i for i, code in enumerate(self.codes[level - 1])}
+                length = len(self.codes[level - 1][0])
+                node_parents = np.array(
+                    [above[code[:length]] for code in codes], dtype=np.intp
+                )
+            children = np.argsort(node_parents, kind="stable")
+            child_starts = np.zeros(n_parents + 1, dtype=np.intp)
+            np.cumsum(
+                np.bincount(node_parents, minlength=n_parents), out=child_starts[1:]
+            )
+            postings = normalize(tfidf_matrix)[children].T.tocsr()
+            postings.sort_indices()
+            terms = np.repeat(np.arange(postings.shape[0]), np.diff(postings.indptr))
+            blocks, block_starts = np.unique(
+                terms * n_parents + node_parents[children][postings.indices],
+                return_index=True,
+            )
+            term_blocks = np.searchsorted(
+                blocks // n_parents, np.arange(postings.shape[0] + 1)
+            )
+            self._levels.append(
+                (
+                    children,
+                    child_starts,
+                    postings,
+                    term_blocks,
+                    blocks % n_parents,
+                    np.append(block_starts, postings.nnz),
+                )
+            )
+            parents.append(node_parents)
+
+        # Num. codes under each node, for keeping enough nodes to fill the top n
+        self._leaf_counts = [np.ones(self.n_buckets, dtype=np.int64)]
+        for level in range(len(levels) - 1, 0, -1):
+            self._leaf_counts.insert(
+                0,
+                np.bincount(
+                    parents[level],
+                    weights=self._leaf_counts[0],
+                    minlength=len(self.codes[level - 1]),
+                ).astype(np.int64),
+            )
+
+    def _route(self, indptr, indices, data, top_n, levels=None):
+        """
+        Helper, scores records level by level against the children of the
+        groups they were routed to at the level above
+
+        Keyword arguments:
+            indptr, indices, data -- CSR arrays of the records' normalised
+                TF-IDF vectors
+            top_n -- num. codes the kept groups must be able to fill
+            levels -- num. levels to route through, all of them by default
+        Returns:
+            tuple of three arrays, the record, node and similarity of each
+            pair scored at the last level routed through, ordered by record
+        """
+        n_records = len(indptr) - 1
+        levels = len(self._levels) if levels is None else levels
+        term_rows = np.repeat(np.arange(n_records), np.diff(indptr))
+        # Every record starts under the top level's single root
+        kept_rows = np.arange(n_records)
+        kept_nodes = np.zeros(n_records, dtype=np.intp)
+        for level in range(levels):
+            (
+                children,
+                child_starts,
+                postings,
+                term_blocks,
+                block_parents,
+                block_starts,
+            ) = self._levels[level]
+            n_parents = len(child_starts) - 1
+            kept_keys = kept_rows * n_parents + kept_nodes
+            order = np.argsort(kept_keys)
+            kept_rows, kept_nodes, kept_keys = (
+                kept_rows[order],
+                kept_nodes[order],
+                kept_keys[order],
+            )
+
+            # The (record, node) pairs under each kept parent, ordered by record
+            first_children = child_starts[kept_nodes]
+            lengths = child_starts[kept_nodes + 1] - first_children
+            pair_starts = np.cumsum(lengths) - lengths
+            owner, pair_positions = _ranges(first_children, first_children + lengths)
+            pair_rows = kept_rows[owner]
+
+            # The blocks of postings of each record's terms, under the parents
+            # kept for the record
+            owner, blocks = _ranges(term_blocks[indices], term_blocks[indices + 1])
+            keys = term_rows[owner] * n_parents + block_parents[blocks]
+            kept = np.minimum(np.searchsorted(kept_keys, keys), len(kept_keys) - 1)
+            hits = np.flatnonzero(kept_keys[kept] == keys)
+            owner, blocks, kept = owner[hits], blocks[hits], kept[hits]
+
+            # Summed into the pairs of the parents the blocks are under
+            block_owner, posting_positions = _ranges(
+                block_starts[blocks], block_starts[blocks + 1]
+            )
+            kept = kept[block_owner]
+            pairs = pair_starts[kept] - first_children[kept]
+            pairs += postings.indices[posting_positions]
+            scores = np.bincount(
+                pairs,
+                weights=data[owner[block_owner]] * postings.data[posting_positions],
+                minlength=len(pair_rows),
+            )
+            pair_nodes = children[pair_positions]
+            if level < levels - 1:
+                kept_rows, kept_nodes = self._keep(
+                    n_records,
+                    pair_rows,
+                    pair_nodes,
+                    scores,
+                    self._leaf_counts[level],
+                    top_n,
+                )
+        return pair_rows, pair_nodes, scores
+
+    def _keep(self, n_records, rows, nodes, scores, leaf_counts, top_n):
+        """
+        Helper, picks the nodes whose children are scored at the next level:
+        each record's beam best, and then as many more as are needed for the
+        codes under them to fill its top_n
+
+        Returns: tuple of the records and nodes kept, ordered by record
+        """
+        ranked = _rank(n_records, rows, nodes, scores)
+        valid = ranked >= 0
+        counts = np.where(valid, leaf_counts[nodes[ranked]], 0)
+        covered = np.cumsum(counts, axis=1) - counts
+        ranks = np.arange(ranked.shape[1])
+        kept = ranked[valid & ((ranks < self.beam) | (covered < top_n))]
+        return rows[kept], nodes[kept]
+
+    def _top_n(self, indptr, indices, data, top_n):
+        """Helper, top_n for the CSR arrays of the records' vectors"""
+        n_records = len(indptr) - 1
+        top_n = min(top_n, self.n_buckets)
+        if top_n == 0:
+            return (
+                np.empty((n_records, 0), dtype=np.intp),
+                np.empty((n_records, 0), dtype=np.float64),
+            )
+        rows, nodes, scores = self._route(indptr, indices, data, top_n)
+        # Enough codes are kept to fill every record's top_n, and they are
+        # returned least similar first
+        best = _rank(n_records, rows, nodes, scores, ties="last")[:, top_n - 1 :: -1]
+        return nodes[best], scores[best]
+
+    def top_n(self, vectors, top_n=5):
+        """
+        Finds the top_n most similar codes to each record among those under
+        the groups it was routed to, as TfidfIndex.top_n does among all codes.
+        Tied codes are ranked by their order in the scheme.
+
+        Keyword arguments:
+            vectors -- sparse matrix of normalised TF-IDF vectors of records
+            top_n -- num. codes to return for each record
+        Returns:
+            tuple of two (records x top_n) arrays, holding the indices of the
+            best matching codes and their similarities, least similar first
+        """
+        vectors = vectors.tocsr()
+        return self._top_n(vectors.indptr, vectors.indices, vectors.data, top_n)
+
+    def top_n_one(self, columns, values, top_n=5):
+        """
+        Single record version of top_n, for low latency, taking the record's
+        vector as TfidfIndex.top_n_one does
+
+        Returns:
+            tuple of two arrays, the indices of the top_n most similar codes
+            and their similarities, least similar first
+        """
+        best, scores = self._top_n(
+            np.array([0, len(columns)]),
+            np.asarray(columns, dtype=np.intp),
+            np.asarray(values, dtype=np.float64),
+            top_n,
+        )
+        return best[0], scores[0]
+
+    def best_parents(self, vectors, top_n=5):
+        """
+        Finds the best matching group for each record at the level just above
+        the scheme's codes, routing as top_n does
+
+        Returns: array of the groups' codes, one per record
+        """
+        vectors = vectors.tocsr()
+        top_n = min(top_n, self.n_buckets)
+        rows, nodes, scores = self._route(
+            vectors.indptr,
+            vectors.indices,
+            vectors.data,
+            top_n,
+            levels=len(self._levels) - 1,
+        )
+        best = _rank(vectors.shape[0], rows, nodes, scores)[:, 0]
+        return self.codes[-2][nodes[best]]
+
+
+def _ranges(starts, stops):
+    """
+    Helper, concatenates the ranges of integers [start, stop)
+
+    Returns:
+        tuple of two arrays, the index of the range each integer came from,
+        and the integers
+    """
+    lengths = stops - starts
+    owner = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return owner, np.arange(len(owner)) + offsets
+
+
+def _rank(n_records, rows, nodes, scores, ties="first"):
+    """
+    Helper, ranks scored (record, node) pairs within each record, best first
+
+    Keyword arguments:
+        n_records -- num. records
+        rows, nodes, scores -- arrays of the pairs, ordered by record
+        ties -- "first" to rank tied nodes in ascending order, as a stable
+            sort of negated scores does, or "last" for descending order, as
+            taking the end of a stable ascending sort does
+    Returns:
+        (records x most pairs of a record) array of the indices of each
+        record's pairs, best first, padded with -1
+    """
+    counts = np.bincount(rows, minlength=n_records)
+    ranked = np.full((n_records, counts.max(initial=0)), -1, dtype=np.intp)
+    ranked[rows, np.arange(len(rows)) - (np.cumsum(counts) - counts)[rows]] = (
+        np.arange(len(rows))
+    )
+    valid = ranked >= 0
+    tiebreak = np.where(valid, nodes[ranked] if ties == "first" else -nodes[ranked], 0)
+    ranked = np.take_along_axis(ranked, tiebreak.argsort(axis=1, kind="stable"), axis=1)
+    # Padding sorts last, below every similarity
+    sort_scores = np.where(ranked >= 0, -scores[ranked], np.inf)
+    return np.take_along_axis(
+        ranked, sort_scores.argsort(axis=1, kind="stable"), axis=1
+    )
+
+
+def _sparse_top_n(sim_scores, top_n, ratios=PREFILTER_RATIOS):
+    """
+    Helper, ranks the candidates in each row of a sparse matrix of scores
+
+    Keyword arguments:
+        sim_scores -- sparse (records x buckets) matrix of similarities
+        top_n -- num. buckets to rank for each record
+        ratios -- fractions of a row's best score tried by the prefilter
+
+    Returns:
+        tuple of the rows whose top_n could be told apart from their candidates,
+        and the (rows x top_n) arrays of column indices and scores of their
+        top_n, in ascending order of score
+    """
+    n_records = sim_scores.shape[0]
+    counts = np.diff(sim_scores.indptr)
+    rows = np.repeat(np.arange(n_records), counts)
+    data = sim_scores.data
+
+    # Ranking prefilter: a candidate below some fraction of the row's best
+    # score cannot be in its top_n when top_n + 1 others are above that. The
+    # scores are all known by now, so this only cuts the candidates sorted
+    touched = counts > 0
+    row_max = np.zeros(n_records)
+    row_max[touched] = np.maximum.reduceat(data, sim_scores.indptr[:-1][touched])
+    row_bound = np.full(n_records, np.inf)
+    for ratio in ratios:
+        pending = np.isinf(row_bound)
+        bound = ratio * row_max
+        above = data >= bound[rows]
+        enough = np.bincount(rows[above], minlength=n_records) > top_n
+        row_bound[pending & enough] = bound[pending & enough]
+    keep = data >= row_bound[rows]
+
+    # Rank each row's remaining candidates, best first
+    kept_rows = rows[keep]
+    kept_data = data[keep]
+    kept_cols = sim_scores.indices[keep]
+    order = np.lexsort((-kept_data, kept_rows))
+    kept_counts = np.bincount(kept_rows, minlength=n_records)
+    starts = np.cumsum(kept_counts) - kept_counts
+
+    ranked = np.flatnonzero(kept_counts > top_n)
+    positions = order[starts[ranked, None] + np.arange(top_n + 1)]
+    ranked_scores = kept_data[positions]
+    # Ties make the selection or its order depend on the full sort
+    untied = (np.diff(ranked_scores, axis=1) != 0).all(axis=1)
+    positions = positions[untied, top_n - 1 :: -1]
+    return ranked[untied], kept_cols[positions], ranked_scores[untied, top_n - 1 :: -1]
+
+
+def _dense_top_n(sim_scores, top_n):
+    """
+    Helper, picks the column indices of the top_n highest scores in each row
+    of a dense matrix, ordered by ascending score
+
+    Uses a partial sort, falling back to a full argsort for rows where tied
+    scores make the selection or its order ambiguous, so results are the
+    same as sorting each row in full.
+    """
+    n_cols = sim_scores.shape[1]
+    if top_n >= n_cols:
+        return sim_scores.argsort()[:, -top_n:]
+
+    # Take one extra so ties across the top_n boundary can be seen
+    part = np.argpartition(sim_scores, n_cols - top_n - 1, axis=1)
+    part = part[:, -(top_n + 1):]
+    part_scores = np.take_along_axis(sim_scores, part, axis=1)
+    order = part_scores.argsort(axis=1)
+    part = np.take_along_axis(part, order, axis=1)
+    part_scores = np.take_along_axis(part_scores, order, axis=1)
+
+    best = part[:, 1:]
+    tied = (np.diff(part_scores, axis=1) == 0).any(axis=1)
+    if tied.any():
+        best[tied] = sim_scores[tied].argsort()[:, -top_n:]
+    return best
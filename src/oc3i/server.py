@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+"""
+Local coding service.
+
+Serves a Coder over HTTP/JSON on localhost, so that other programs can code
+records without each paying the Coder's startup cost. Start it with
+
+    oc3i serve --scheme=isco --port=8080
+
+and code a record by POSTing JSON to /code:
+
+    {"title": "Data scientist", "sector": "IT", "description": "..."}
+
+which returns the result as Coder.code_record would, as {"code": ...}.
+A list of records returns a list of results. GET /health reports the loaded
+scheme and dictionary version.
+
+Requests arriving at the same time are coded together in small batches. A
+batch is coded once it has max_batch_size records, or max_latency seconds
+after its first record arrived. When more than max_queue records are waiting,
+new requests are turned away with 503 until the queue drains.
+"""
+import json
+import asyncio
+import pandas as pd
+
+from http import HTTPStatus
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+from oc3i import __version__, cleaner
+from oc3i.coder import Coder
+
+config = cleaner.load_config()
+
+# Defaults for where the server listens
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+
+# Most records coded in one batch
+MAX_BATCH_SIZE = 64
+
+# Longest time, in seconds, a record waits for others to fill its batch
+MAX_LATENCY = 0.005
+
+# Most records waiting to be coded before requests are turned away
+MAX_QUEUE = 4096
+
+# Largest request body accepted, in bytes
+MAX_BODY_SIZE = 1024 * 1024
+
+# Fields of a record, in the order Coder.code_record takes them
+RECORD_FIELDS = ["title", "sector", "description"]
+
+
+class RequestError(Exception):
+    """An HTTP request that cannot be served, with the status to reply with"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class CodingServer:
+    def __init__(
+        self,
+        commCoder,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_latency=MAX_LATENCY,
+        max_queue=MAX_QUEUE,
+    ):
+        """
+        Keyword arguments:
+        commCoder:Coder
+            the Coder to code records with
+        max_batch_size:int
+            most records to code in one batch
+        max_latency:float
+            longest time in seconds a record waits for others to fill a batch
+        max_queue:int
+            most records waiting to be coded before requests are turned away
+        """
+        self.coder = commCoder
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.max_queue = max_queue
+        self.batches = 0
+        self.records = 0
+        self._queue = None
+        self._batcher = None
+        # Batches are coded one at a time, off the event loop
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def health(self):
+        """Status of the server and the Coder it serves"""
+        return {
+            "status": "ok",
+            "version": __version__,
+            "scheme": self.coder.scheme,
+            "output": self.coder.output,
+            "dictionary_version": self.coder.dictionary_version,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "batches": self.batches,
+            "records": self.records,
+        }
+
+    async def code(self, records):
+        """
+        Queues records to be coded in the next batch and waits for the results
+
+        Keyword arguments:
+            records -- list of (title, sector, description) tuples
+        Raises:
+            RequestError, if there is no room in the queue for the records
+        Returns:
+            list of coded results, one per record
+        """
+        if self._queue.qsize() + len(records) > self.max_queue:
+            raise RequestError(HTTPStatus.SERVICE_UNAVAILABLE, "Server busy, try again")
+        loop = asyncio.get_running_loop()
+        futures = []
+        for record in records:
+            future = loop.create_future()
+            self._queue.put_nowait((record, future))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    async def _run_batches(self):
+        """Collects queued records into batches and codes them, until cancelled"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            records = [record for record, _ in batch]
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self._code_batch, records
+                )
+            except Exception as e:
+                results = [e] * len(batch)
+            self.batches += 1
+            self.records += len(batch)
+
+            for (_, future), result in zip(batch, results):
+                # The client may have gone away in the meantime
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _code_batch(self, records):
+        """Helper, codes a batch of (title, sector, description) tuples"""
+        record_df = pd.DataFrame(records, columns=RECORD_FIELDS, dtype=object)
+        return self.coder._code_columns(record_df, *RECORD_FIELDS).to_list()
+
+    async def _handle_request(self, method, path, body):
+        """
+        Helper, serves a single request
+
+        Returns: tuple of HTTP status and the JSON-able response body
+        """
+        if path == "/health":
+            if method != "GET":
+                raise RequestError(HTTPStatus.METHOD_NOT_ALLOWED, "Use GET")
+            return HTTPStatus.OK, self.health()
+        if path != "/code":
+            raise RequestError(HTTPStatus.NOT_FOUND, f"Unknown path: {path}")
+        if method != "POST":
+            raise RequestError(HTTPStatus.METHOD_NOT_ALLOWED, "Use POST")
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "Request body is not valid JSON")
+        if isinstance(payload, list):
+            results = await self.code([_parse_record(record) for record in payload])
+            return HTTPStatus.OK, [{"code": result} for result in results]
+        (result,) = await self.code([_parse_record(payload)])
+        return HTTPStatus.OK, {"code": result}
+
+    async def _handle_connection(self, reader, writer):
+        """Helper, serves HTTP/1.1 requests on a connection until it closes"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get("connection", "").lower() != "close"
+
+                try:
+                    try:
+                        method, path, _ = request_line.decode("latin-1").split()
+                        length = int(headers.get("content-length", 0))
+                    except ValueError:
+                        keep_alive = False
+                        raise RequestError(HTTPStatus.BAD_REQUEST, "Malformed request")
+                    if length > MAX_BODY_SIZE:
+                        keep_alive = False
+                        raise RequestError(
+                            HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Request body too large"
+                        )
+                    body = await reader.readexactly(length)
+                    status, response = await self._handle_request(method, path, body)
+                except RequestError as e:
+                    status, response = e.status, {"error": str(e)}
+                except Exception as e:
+                    status = HTTPStatus.INTERNAL_SERVER_ERROR
+                    response = {"error": f"{type(e).__name__}: {e}"}
+
+                payload = json.dumps(response).encode("utf-8")
+                head = (
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                )
+                if status == HTTPStatus.SERVICE_UNAVAILABLE:
+                    head += "Retry-After: 1\r\n"
+                writer.write(head.encode("latin-1") + b"\r\n" + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        """
+        Starts serving. Must be called from a running event loop.
+
+        Keyword arguments:
+            host -- address to listen on, localhost by default
+            port -- port to listen on, 0 to pick a free one
+        Returns:
+            the asyncio Server, whose sockets give the address served on
+        """
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.ensure_future(self._run_batches())
+        return await asyncio.start_server(self._handle_connection, host, port)
+
+    async def stop(self, server):
+        """Stops serving, given the Server returned by start"""
+        server.close()
+        await server.wait_closed()
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+        self._executor.shutdown(wait=True)
+
+
+def _parse_record(record):
+    """
+    Helper, checks a record sent to the server
+
+    Returns: tuple of title, sector and description, as code_record takes them
+    """
+    if not isinstance(record, dict):
+        raise RequestError(HTTPStatus.BAD_REQUEST, "Each record must be a JSON object")
+    if not isinstance(record.get("title"), str):
+        raise RequestError(HTTPStatus.BAD_REQUEST, "Each record needs a title string")
+    for field in RECORD_FIELDS[1:]:
+        if not isinstance(record.get(field), (str, type(None))):
+            raise RequestError(HTTPStatus.BAD_REQUEST, f"{field} must be a string")
+    return tuple(record.get(field) for field in RECORD_FIELDS)
+
+
+def serve(commCoder, host=DEFAULT_HOST, port=DEFAULT_PORT, **kwargs):
+    """
+    Serves a Coder until interrupted
+
+    Keyword arguments:
+        commCoder -- the Coder to code records with
+        host, port -- address to listen on
+        kwargs -- batching settings passed to CodingServer
+    """
+    coding_server = CodingServer(commCoder, **kwargs)
+
+    async def run():
+        server = await coding_server.start(host, port)
+        address = server.sockets[0].getsockname()
+        print(f"Serving {commCoder.scheme.upper()} codes on http://{address[0]}:{address[1]}")
+        try:
+            await server.serve_forever()
+        finally:
+            await coding_server.stop(server)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print("Server stopped")
+
+
+def parse_cli_input(argv=None):
+    arg_parser = ArgumentParser(
+        prog="oc3i serve", description="Serve the occupation coder on localhost"
+    )
+    arg_parser.add_argument(
+        "--scheme", help="Scheme to code to", default=config["user"]["scheme"]
+    )
+    arg_parser.add_argument(
+        "--output",
+        help="Type of Outputs: single or multi",
+        default=config["user"]["output"],
+    )
+    arg_parser.add_argument("--host", help="Address to listen on", default=DEFAULT_HOST)
+    arg_parser.add_argument(
+        "--port", help="Port to listen on", type=int, default=DEFAULT_PORT
+    )
+    arg_parser.add_argument(
+        "--max_batch_size",
+        help="Most records to code in one batch",
+        type=int,
+        default=MAX_BATCH_SIZE,
+    )
+    arg_parser.add_argument(
+        "--max_latency",
+        help="Longest time in seconds a record waits for others to fill a batch",
+        type=float,
+        default=MAX_LATENCY,
+    )
+    arg_parser.add_argument(
+        "--result_cache",
+        help="Directory to keep a cache of coded results in, reused across runs",
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--max_queue",
+        help="Most records waiting to be coded before requests are turned away",
+        type=int,
+        default=MAX_QUEUE,
+    )
+    return arg_parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_cli_input(argv)
+    commCoder = Coder(
+        scheme=args.scheme, output=args.output, result_cache=args.result_cache
+    )
+    serve(
+        commCoder,
+        host=args.host,
+        port=args.port,
+        max_batch_size=args.max_batch_size,
+        max_latency=args.max_latency,
+        max_queue=args.max_queue,
+    )
+
+
+if __name__ == "__main__":
+    main()
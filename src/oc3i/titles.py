@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Compact store of a scheme's cleaned job titles.
+
+A scheme lists tens of thousands of job titles under its codes. Held as a dict
+of lists of strings, each title is a Python object of its own, and a worker
+process forked from a Coder ends up copying them as their reference counts
+change, while a spawned worker loads and cleans them all again. The store
+instead keeps every distinct title once, as UTF-8 in a single buffer, with the
+positions of titles and of each code's titles, and a table of title hashes
+for exact lookups, in numpy arrays. Titles are only decoded when they are
+needed. Saved with the compiled model, the arrays are memory mapped when it is
+loaded, so every process using the model shares one copy of them.
+"""
+import zlib
+import numpy as np
+
+from collections.abc import Mapping
+
+# Separator put between a code's titles to decode them all at once. Cleaned
+# titles never contain it
+SEPARATOR = b"\0"
+
+
+def title_hash(title: bytes):
+    """
+    The hash titles are looked up by. Unlike Python's own string hash it is
+    the same in every process, so the table of hashes can be saved
+
+    Keyword arguments:
+        title -- UTF-8 encoded title
+    """
+    return zlib.crc32(title)
+
+
+class TitleStore(Mapping):
+    def __init__(
+        self, codes, pool, offsets, entries, code_starts, exact_codes, hashes, hash_order
+    ):
+        """
+        A read-only mapping of code to the tuple of titles listed under it.
+
+        Keyword arguments:
+        codes:numpy array
+            the scheme's codes, in the order their titles were listed
+        pool:numpy array
+            every distinct title, one after another, as UTF-8 bytes
+        offsets:numpy array
+            start of each distinct title in pool, and the end of the last
+        entries:numpy array
+            the distinct titles listed under each code in turn, as indices
+        code_starts:numpy array
+            start of each code's titles in entries, and the end of the last
+        exact_codes:numpy array
+            index of the code each distinct title is an exact match for, the
+            last code it is listed under
+        hashes:numpy array
+            title_hash of each distinct title, sorted
+        hash_order:numpy array
+            index of the distinct title with each of the sorted hashes
+        """
+        self.codes = codes
+        self.pool = pool
+        self.offsets = offsets
+        self.entries = entries
+        self.code_starts = code_starts
+        self.exact_codes = exact_codes
+        self.hashes = hashes
+        self.hash_order = hash_order
+        self._buffer = memoryview(pool)
+        self._code_index = {code: i for i, code in enumerate(codes.tolist())}
+
+    @classmethod
+    def from_dict(cls, titles_mg):
+        """
+        Builds a store from a dict of code to list of cleaned titles
+
+        Keyword arguments:
+            titles_mg -- dict of code to list of cleaned job titles
+        Raises:
+            ValueError, if a title contains a null character
+        Returns:
+            TitleStore
+        """
+        ids = {}
+        entries = []
+        code_starts = [0]
+        exact_codes = []
+        for code_idx, titles in enumerate(titles_mg.values()):
+            for title in titles:
+                if title not in ids:
+                    ids[title] = len(ids)
+                    exact_codes.append(code_idx)
+                entries.append(ids[title])
+                exact_codes[ids[title]] = code_idx
+            code_starts.append(len(entries))
+
+        encoded = [title.encode("utf-8") for title in ids]
+        if any(SEPARATOR in title for title in encoded):
+            raise ValueError("Job titles cannot contain null characters")
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(title) for title in encoded], out=offsets[1:])
+        hashes = np.array([title_hash(title) for title in encoded], dtype=np.int64)
+        hash_order = np.argsort(hashes, kind="stable")
+        return cls(
+            codes=np.array(list(titles_mg), dtype=str),
+            pool=np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            offsets=offsets,
+            entries=np.array(entries, dtype=np.int32),
+            code_starts=np.array(code_starts, dtype=np.int64),
+            exact_codes=np.array(exact_codes, dtype=np.int32),
+            hashes=hashes[hash_order],
+            hash_order=hash_order,
+        )
+
+    def to_arrays(self):
+        """The store as a dict of numpy arrays, for saving"""
+        return {
+            "codes": self.codes,
+            "pool": self.pool,
+            "offsets": self.offsets,
+            "entries": self.entries,
+            "code_starts": self.code_starts,
+            "exact_codes": self.exact_codes,
+            "hashes": self.hashes,
+            "hash_order": self.hash_order,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Rebuilds a store from the arrays returned by to_arrays, which may be
+        memory mapped; they are used as they are, not copied
+        """
+        return cls(**{name: arrays[name] for name in cls._array_names()})
+
+    @staticmethod
+    def _array_names():
+        """Helper, the names of the arrays returned by to_arrays"""
+        return [
+            "codes",
+            "pool",
+            "offsets",
+            "entries",
+            "code_starts",
+            "exact_codes",
+            "hashes",
+            "hash_order",
+        ]
+
+    def title(self, i):
+        """The distinct title with index i"""
+        return str(self._buffer[self.offsets[i] : self.offsets[i + 1]], "utf-8")
+
+    def titles(self, code):
+        """
+        The titles listed under a code, in their original order
+
+        Raises:
+            KeyError, if the code is not in the store
+        Returns:
+            list of titles
+        """
+        i = self._code_index[code]
+        ids = self.entries[self.code_starts[i] : self.code_starts[i + 1]]
+        if len(ids) == 0:
+            return []
+        # Decoded all at once, rather than title by title
+        buffer = self._buffer
+        joined = SEPARATOR.join(
+            [
+                buffer[start:stop]
+                for start, stop in zip(
+                    self.offsets[ids].tolist(), self.offsets[ids + 1].tolist()
+                )
+            ]
+        )
+        return joined.decode("utf-8").split("\0")
+
+    def to_dict(self):
+        """The store as a dict of code to list of titles"""
+        return {code: self.titles(code) for code in self.codes.tolist()}
+
+    def _find(self, title):
+        """
+        Helper, the index of a distinct title
+
+        Keyword arguments:
+            title -- UTF-8 encoded title
+        Returns: the index, or -1 if the title is not in the store
+        """
+        hashed = title_hash(title)
+        position = int(np.searchsorted(self.hashes, hashed))
+        buffer = self._buffer
+        while position < len(self.hashes) and self.hashes[position] == hashed:
+            i = int(self.hash_order[position])
+            if buffer[self.offsets[i] : self.offsets[i + 1]] == title:
+                return i
+            position += 1
+        return -1
+
+    def lookup(self, title):
+        """
+        The code a title is an exact match for
+
+        Returns: the code, or None if the title is not in the store
+        """
+        i = self._find(title.encode("utf-8"))
+        if i < 0:
+            return None
+        return str(self.codes[self.exact_codes[i]])
+
+    def lookup_many(self, titles):
+        """
+        Batch version of lookup
+
+        Keyword arguments:
+            titles -- list of titles
+        Returns:
+            numpy object array of codes, None where a title is not in the store
+        """
+        encoded = [title.encode("utf-8") for title in titles]
+        codes = np.full(len(encoded), None, dtype=object)
+        if len(self.hashes) == 0:
+            return codes
+        hashes = np.fromiter(
+            (title_hash(title) for title in encoded), dtype=np.int64, count=len(encoded)
+        )
+        positions = np.searchsorted(self.hashes, hashes)
+        positions = np.minimum(positions, len(self.hashes) - 1)
+        hits = np.flatnonzero(self.hashes[positions] == hashes)
+        ids = self.hash_order[positions[hits]]
+
+        # Check the titles themselves, in case of hash collisions
+        found = np.full(len(encoded), -1, dtype=np.int64)
+        buffer = self._buffer
+        for i, id_, start, stop in zip(
+            hits.tolist(),
+            ids.tolist(),
+            self.offsets[ids].tolist(),
+            self.offsets[ids + 1].tolist(),
+        ):
+            if buffer[start:stop] == encoded[i]:
+                found[i] = id_
+            else:
+                found[i] = self._find(encoded[i])
+
+        matched = found >= 0
+        codes[matched] = self.codes[self.exact_codes[found[matched]]].astype(object)
+        return codes
+
+    def __getitem__(self, code):
+        return tuple(self.titles(code))
+
+    def __iter__(self):
+        return iter(self.codes.tolist())
+
+    def __len__(self):
+        return len(self.codes)
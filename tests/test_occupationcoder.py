@@ -7,13 +7,32 @@ import time
 import sys
 import os
 import subprocess
+import multiprocessing
+import json
+import shutil
+import tempfile
+import asyncio
+import io
+from pathlib import Path
+from unittest import mock
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
 from importlib.resources import files
-from oc3i import coder, cleaner
+from oc3i import coder, cleaner, benchmark, server, columnar, scoring, processes
+from oc3i.titles import TitleStore
+from oc3i.cache import ResultCache
+from oc3i.createdictionaries import build_dict
 
 SAMPLE_SIZE = 100000
 
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
 
 class TestOccupationcoder(unittest.TestCase):
     """Tests for `occupationcoder` package."""
@@ -58,6 +77,61 @@ class TestOccupationcoder(unittest.TestCase):
         for title in clean_titles:
             self.assertIn(title, self.expected_titles)
 
+    def test_clean_cache(self):
+        """Cached cleaning gives the same results, evicts and bypasses long text"""
+        cached = cleaner.Cleaner(cache_size=2, cache_max_length=20)
+        for title in ["Physicist", "Economist", "Physicist"]:
+            self.assertEqual(cached.simple_clean(title), self.cl.simple_clean(title))
+        info = cached.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 2, 2))
+
+        cached.simple_clean("Ground worker")
+        cached.simple_clean("A much longer job description than allowed")
+        self.assertEqual(cached.cache_info().currsize, 2)
+        self.assertEqual(cached.cache_info().misses, 3)
+
+        cached.clear_cache()
+        self.assertEqual(cached.cache_info().currsize, 0)
+        self.assertIsNone(self.cl.cache_info())
+
+    def test_token_table(self):
+        """Token lookup tables agree with lemmatising, expanding and filtering"""
+        # The known words and synonyms are found relative to the package
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(str(files("oc3i")))
+        cl = cleaner.Cleaner(scheme="soc")
+        self.assertTrue(cl.advanced)
+
+        text = "Senior HGV drivers <b>and</b> care assistants, comms & sales"
+        # self.cl was set up outside the package, so only does basic cleaning
+        basic = self.cl.simple_clean(text)
+        tokens = [cl.expand_dict.get(t, t) for t in cl.lemmatize(basic)]
+        self.assertEqual(cl.simple_clean(text, known_only=False), " ".join(tokens))
+        known = [
+            t for t in tokens
+            if t in cl.known_words_dict and t not in cleaner.STOPWORDS
+        ]
+        self.assertEqual(cl.simple_clean(text), " ".join(known))
+
+    def test_clean_series(self):
+        """Cleaning a whole Series gives the same results as simple_clean"""
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(str(files("oc3i")))
+        texts = pd.concat(
+            [
+                self.test_df["job_title"],
+                self.test_df["job_description"],
+                pd.Series(["", "  ", "<b>HGV</b>  drivers!!", "Café 42", "Physicist"]),
+            ]
+        )
+        for cl in [self.cl, cleaner.Cleaner(scheme="soc")]:
+            for known_only in [True, False]:
+                cleaned = cl.clean_series(texts, known_only=known_only)
+                expected = texts.apply(cl.simple_clean, known_only=known_only)
+                self.assertTrue(cleaned.equals(expected))
+        with self.assertRaises(TypeError):
+            self.cl.clean_series(pd.Series(["Physicist", None]))
+
     def test_code_exact_matcher(self):
         """Results of exact title matching"""
         clean_titles = self.test_df["job_title"].apply(self.cl.simple_clean)
@@ -72,6 +146,15 @@ class TestOccupationcoder(unittest.TestCase):
         for match in matches:
             self.assertIn(match, ["2111", "2631", None])
 
+    def test_batch_exact_matches(self):
+        """Batch exact matching agrees with matching one title at a time"""
+        clean_titles = self.test_df["job_title"].apply(self.cl.simple_clean)
+        batch = self.isco_matcher.get_exact_matches(clean_titles)
+        single = clean_titles.apply(self.isco_matcher.get_exact_match)
+        self.assertEqual(
+            batch.where(batch.notna(), None).to_list(), single.to_list()
+        )
+
     def test_code_tfidf_matcher(self):
         """TF-IDF similarity suggestions for categories?"""
         df = self.test_df.copy()
@@ -90,6 +173,257 @@ class TestOccupationcoder(unittest.TestCase):
             for code in SOC_codes:
                 self.assertIn(code, self.expected_codes)
 
+    def test_batch_tfidf_matcher(self):
+        """Batch TF-IDF suggestions match one record at a time, across chunks"""
+        texts = self.test_df["job_description"].apply(
+            lambda x: self.cl.simple_clean(x, known_only=False)
+        ).to_list() + ["physicist", ""]
+        codes, scores = self.isco_matcher.get_tfidf_matches(texts, chunk_size=2)
+        self.assertEqual(codes.shape, (len(texts), 5))
+        self.assertEqual(scores.shape, (len(texts), 5))
+        for text, row in zip(texts, codes):
+            self.assertEqual(list(row), self.isco_matcher.get_tfidf_match(text))
+
+    def test_tfidf_index(self):
+        """The inverted index ranks buckets as sorting every similarity would"""
+        from sklearn.metrics.pairwise import cosine_similarity
+        from sklearn.preprocessing import normalize
+
+        texts = self.test_df["job_description"].apply(
+            lambda x: self.cl.simple_clean(x, known_only=False)
+        ).to_list() + ["physicist", "data scientist", "software", "", "zzz"]
+        vectors = self.isco_matcher._model.tfidf.transform(texts)
+        sim_scores = cosine_similarity(vectors, self.isco_matcher._model.tfidf_matrix)
+        index = self.isco_matcher._model.index
+        for top_n in [1, 5, 50]:
+            best, scores = index.top_n(normalize(vectors), top_n)
+            expected = sim_scores.argsort()[:, -top_n:]
+            self.assertEqual(best.tolist(), expected.tolist())
+            self.assertEqual(
+                scores.tolist(),
+                np.take_along_axis(sim_scores, expected, axis=1).tolist(),
+            )
+            # The ranking prefilter only saves work
+            unfiltered, _ = index.top_n(normalize(vectors), top_n, prefilter=False)
+            self.assertEqual(unfiltered.tolist(), expected.tolist())
+
+    def test_hierarchical_matching(self):
+        """Routing through every group finds the same candidates as scoring
+        every code, and weak matches fall back to broader groups"""
+        from sklearn.preprocessing import normalize
+
+        matcher = coder.Coder(scheme="isco", output="single", hierarchical=True)
+        vectors = normalize(
+            matcher._model.tfidf.transform(["physicist", "data scientist", "software", ""])
+        )
+        index = matcher._model.index
+        self.assertEqual(
+            [len(codes[0]) for codes in index.codes], [1, 2, 3, 4]
+        )
+        index.beam = len(matcher._model.codes)
+        best, scores = index.top_n(vectors, 5)
+        expected, expected_scores = self.isco_matcher._model.index.top_n(vectors, 5)
+        # Codes tied at zero, as for texts with no known terms, can come in
+        # another order
+        untied = (expected_scores > 0).all(axis=1)
+        self.assertEqual(untied.sum(), 2)
+        self.assertEqual(best[untied].tolist(), expected[untied].tolist())
+        np.testing.assert_allclose(scores, expected_scores)
+        index.beam = scoring.HIERARCHY_BEAM
+
+        # The single record path finds the same codes as the batch one
+        texts = ["physicist", "data scientist", "software engineer", ""]
+        batch, _ = matcher.get_tfidf_matches(texts)
+        self.assertEqual(
+            [matcher.get_tfidf_match(text) for text in texts], batch.tolist()
+        )
+
+        fallback = coder.Coder(
+            scheme="isco", output="single", hierarchical=True, fallback_score=101
+        )
+        self.assertEqual(fallback.code_record("Physicist"), "2111")
+        self.assertEqual(len(fallback.code_record("Wizard")), 3)
+        self.assertEqual(fallback.stats()["outcomes"]["fallback"], 1)
+        with self.assertRaises(ValueError):
+            coder.Coder(scheme="isco", fallback_score=50)
+
+    def test_title_store(self):
+        """The title store keeps each code's titles, and exact matches are for
+        the last code listing a title"""
+        titles_mg = {
+            "111": ["chief executive", "director"],
+            "222": ["data scientist", "director", "café owner"],
+            "333": [],
+        }
+        store = TitleStore.from_dict(titles_mg)
+        loaded = TitleStore.from_arrays(store.to_arrays())
+        for titles in [store, loaded]:
+            self.assertEqual(titles.to_dict(), titles_mg)
+            self.assertEqual(titles.lookup("director"), "222")
+            self.assertEqual(titles.lookup("chief executive"), "111")
+            self.assertEqual(
+                titles.lookup_many(["café owner", "wizard", ""]).tolist(),
+                ["222", None, None],
+            )
+        distinct = set(sum(titles_mg.values(), []))
+        self.assertEqual(len(store.pool), len("".join(distinct).encode("utf-8")))
+        self.assertEqual(dict(store), {code: tuple(t) for code, t in titles_mg.items()})
+        with self.assertRaises(TypeError):
+            store["444"] = ["wizard"]
+        with self.assertRaises(ValueError):
+            TitleStore.from_dict({"111": ["chief\0executive"]})
+        self.assertEqual(TitleStore.from_dict({}).lookup("director"), None)
+
+    def test_process_file(self):
+        """Dictionaries are the same however many processes clean them, and
+        the compiled model is built alongside them"""
+        input_df = pd.DataFrame(
+            {
+                "Code": ["1", "11", "1111", "1112", "1113"] * 3,
+                "Title EN": ["Managers", "Chief executives", "Legislators",
+                             "Senior officials", "Village heads"] * 3,
+                "Definition": ["Plan and direct (a) things\nTasks include 42",
+                               "Café owner", None, "Tasks include policy", ""] * 3,
+                "Included occupations": ["", "Examples: Chief executive\nCEO",
+                                         "Examples: Member of parliament",
+                                         np.nan, "Examples: Village head"] * 3,
+            }
+        )
+        settings = dict(
+            code_col="Code",
+            bucket_cols=["Title EN", "Definition"],
+            exact_col="Included occupations",
+            exact_col_split="\n",
+            exclude_text={"Definition": ["Tasks include"],
+                          "Included occupations": ["Examples:"]},
+            exclude_pattern=r"\d+",
+            output_files={
+                "buckets": "test/buckets_test.json",
+                "exact": "test/titles_test.json",
+            },
+            bucket_field_names=["TEST_code", "Title", "Titles_nospace"],
+            level=4,
+        )
+        default_lookup_dir = build_dict.lookup_dir
+        outputs = []
+        try:
+            for workers in [1, 2]:
+                with tempfile.TemporaryDirectory() as tmp:
+                    build_dict.lookup_dir = Path(tmp)
+                    build_dict.process_file(
+                        input_df.copy(), workers=workers, scheme="test", **settings
+                    )
+                    self.assertTrue((Path(tmp) / "test" / "compiled_test.npz").exists())
+                    outputs.append(
+                        [
+                            json.loads((Path(tmp) / "test" / name).read_text())
+                            for name in ["buckets_test.json", "titles_test.json"]
+                        ]
+                    )
+        finally:
+            build_dict.lookup_dir = default_lookup_dir
+
+        buckets, titles = outputs[0]
+        self.assertEqual(outputs[1], outputs[0])
+        self.assertEqual(
+            buckets[0],
+            {"TEST_code": "1111", "Title": "Legislators", "Titles_nospace": "legislators "},
+        )
+        self.assertEqual(buckets[1]["Titles_nospace"], "senior officials policy")
+        self.assertEqual(
+            titles, {"1111": ["member of parliament"], "1112": [], "1113": ["village head"]}
+        )
+
+    def test_incremental_updates(self):
+        """Titles and buckets can be updated in place, and the updates are
+        repeated in worker processes that build their own Coder"""
+        matcher = coder.Coder(scheme="isco", output="single")
+        version = matcher.dictionary_version
+        matcher.update_titles({"2111": ["Physicist", "Quantum wizard"]})
+        self.assertEqual(matcher.code_record("Quantum wizard"), "2111")
+        self.assertNotEqual(matcher.dictionary_version, version)
+
+        before = matcher._model
+        matcher.update_buckets(
+            {"0110": "commissioned armed forces officer", "9999": "dragon tamer"},
+            names={"9999": "Dragon tamers"},
+        )
+        # The model is replaced whole, so calls already coding with the old
+        # one see it unchanged
+        self.assertIsNot(matcher._model, before)
+        self.assertNotIn("9999", before.codes)
+        self.assertEqual(before.tfidf_matrix.shape[0], len(before.codes))
+        self.assertEqual(before.titles.titles("2111")[-1], "quantum wizard")
+        self.assertEqual(matcher.get_code_name("9999"), "Dragon tamers")
+        self.assertEqual(matcher.titles.titles("9999"), [])
+        row = matcher._model.codes.tolist().index("0110")
+        self.assertEqual(
+            (matcher._model.tfidf_matrix[row] != matcher._model.tfidf.transform(
+                ["commissioned armed forces officer"]
+            )).nnz,
+            0,
+        )
+        report = matcher.drift_report()
+        self.assertEqual(report["buckets_updated"], 2)
+        self.assertTrue(report["refit_recommended"])
+
+        before = matcher._model
+        matcher.refit()
+        self.assertIsNot(before.vocabulary, matcher._model.vocabulary)
+        self.assertEqual(len(before.vocabulary), before.tfidf_matrix.shape[1])
+        self.assertFalse(matcher.drift_report()["refit_recommended"])
+        self.assertEqual(matcher.get_tfidf_match("dragon tamer", 1), ["9999"])
+
+        coder._init_worker(None, matcher._settings, matcher._updates)
+        self.assertEqual(coder._worker_coder.dictionary_version, matcher.dictionary_version)
+        self.assertEqual(coder._worker_coder.get_tfidf_match("dragon tamer", 1), ["9999"])
+
+    def test_batch_fuzzy_matcher(self):
+        """Batch fuzzy matching keeps the single record ordering and output"""
+        titles = ["physicist", "data scientist", ""]
+        candidates = [["2120", "2111", "2511"], ["2111", "2120", "2511"]] * 2
+        for matcher in [self.isco_matcher, coder.Coder(scheme="isco", output="single")]:
+            batch = matcher.get_best_fuzzy_matches(titles, candidates[:3])
+            single = [
+                matcher.get_best_fuzzy_match(title, codes)
+                for title, codes in zip(titles, candidates)
+            ]
+            self.assertEqual(batch, single)
+        self.assertEqual(self.isco_matcher.get_best_fuzzy_matches([], []), [])
+
+    def test_compiled_model(self):
+        """Compiled models are saved, reloaded, and rebuilt when stale"""
+        with tempfile.TemporaryDirectory() as tmp:
+            lookup = Path(tmp)
+            shutil.copytree(files("oc3i") / "dictionaries" / "isco", lookup / "isco")
+            built = coder.Coder(lookup_dir=lookup, scheme="isco")
+            compiled_file = lookup / "isco" / "compiled_isco.npz"
+            self.assertTrue(compiled_file.exists())
+
+            loaded = coder.Coder(lookup_dir=lookup, scheme="isco")
+            self.assertEqual(loaded.titles_mg, built.titles_mg)
+            # The saved titles are memory mapped, not read into memory
+            self.assertIsInstance(loaded.titles.pool, np.memmap)
+            self.assertIsInstance(loaded.titles.hashes, np.memmap)
+            # titles_mg is still a dict of lists, for existing callers
+            self.assertIsInstance(loaded.titles_mg, dict)
+            self.assertEqual(loaded.titles_mg, loaded.titles.to_dict())
+            self.assertIsInstance(next(iter(loaded.titles_mg.values())), list)
+            self.assertTrue(loaded.mg_buckets.equals(built.mg_buckets))
+            self.assertEqual((loaded._model.tfidf_matrix != built._model.tfidf_matrix).nnz, 0)
+            self.assertEqual(
+                loaded.code_record("data scientist"), built.code_record("data scientist")
+            )
+
+            # Changing a dictionary invalidates the compiled model
+            titles_file = lookup / "isco" / "titles_isco.json"
+            titles = json.loads(titles_file.read_text())
+            titles["2120"].append("sports statistician")
+            titles_file.write_text(json.dumps(titles))
+            rebuilt = coder.Coder(lookup_dir=lookup, scheme="isco")
+            self.assertNotEqual(rebuilt.dictionary_version, built.dictionary_version)
+            self.assertEqual(rebuilt.get_exact_match("sports statistician"), "2120")
+
     def test_code_record(self):
         """Confirm it correctly runs on our example single record"""
         result = self.matcher.code_record(
@@ -111,6 +445,67 @@ class TestOccupationcoder(unittest.TestCase):
         )
         self.assertEqual(df["SOC_code"].to_list(), ["211", "242", "912"])
 
+    def test_deduplicated_code_data_frame(self):
+        """Title only runs code unique titles once and keep the row order"""
+        df = self.test_df[["job_title"]].sample(20, replace=True, random_state=1)
+        coded = self.matcher.code_data_frame(df.copy(), title_column="job_title")
+        expected = [self.matcher.code_record(title) for title in df["job_title"]]
+        self.assertEqual(coded["SOC_code"].to_list(), expected)
+        self.assertTrue(coded.index.equals(df.index))
+
+        full = self.matcher.code_data_frame(
+            df.copy(), title_column="job_title", deduplicate=False
+        )
+        self.assertTrue(coded.equals(full))
+
+    def test_result_cache(self):
+        """Cached results are the same as coding afresh, and are no longer
+        used once the dictionaries change"""
+        df = self.test_df.sample(20, replace=True, random_state=1)
+        columns = dict(
+            title_column="job_title",
+            sector_column="job_sector",
+            description_column="job_description",
+        )
+        expected = self.isco_matcher.code_data_frame(df.copy(), **columns)
+        with tempfile.TemporaryDirectory() as tmp:
+            cached = coder.Coder(scheme="isco", result_cache=tmp)
+            for _ in range(2):
+                self.assertTrue(cached.code_data_frame(df.copy(), **columns).equals(expected))
+            stats = cached.stats()
+            self.assertEqual(stats["outcomes"]["cached"], 20)
+            self.assertEqual(stats["result_cache"]["misses"], 20)
+
+            # Another Coder, as in a later run, finds the same results
+            record = df.iloc[0][["job_title", "job_sector", "job_description"]]
+            later = coder.Coder(scheme="isco", result_cache=tmp)
+            self.assertEqual(later.code_record(*record), self.isco_matcher.code_record(*record))
+            self.assertEqual(later.stats()["result_cache"]["hits"], 1)
+            later.update_titles({"2111": ["Physicist"]})
+            later.code_record(*record)
+            self.assertEqual(later.stats()["result_cache"]["misses"], 1)
+            later.result_cache.close()
+            cached.result_cache.close()
+
+            # The least recently used results are evicted past the size limit
+            cache = ResultCache(Path(tmp) / "small.sqlite", max_entries=10)
+            keys = [ResultCache.key("test", str(i), "") for i in range(15)]
+            cache.put_many([(key, i) for i, key in enumerate(keys[:8])])
+            cache.get_many(keys[:2])
+            cache.put_many([(key, i) for i, key in enumerate(keys[8:], 8)])
+            found = cache.get_many(keys)
+            self.assertEqual(cache.info()["entries"], 9)
+            self.assertEqual(set(found.values()), {0, 1} | set(range(8, 15)))
+
+            # Lookups from several threads at once are all counted
+            before = cache.info()
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                list(pool.map(lambda _: cache.get_many(keys), range(40)))
+            info = cache.info()
+            self.assertEqual(info["hits"] - before["hits"], 40 * 9)
+            self.assertEqual(info["misses"] - before["misses"], 40 * 6)
+            cache.close()
+
     def test_multi_code_output(self):
         """Running samples from file and getting codes and scores out using ISCO"""
         df = pd.read_csv(files("oc3i.data") / "test_vacancies.csv")
@@ -122,20 +517,254 @@ class TestOccupationcoder(unittest.TestCase):
         )
         self.assertEqual(df["prediction 1"].to_list(), ["2111", "2631", "3333"])
 
-    # def test_parallel_code_data_frame(self):
-    #     """
-    #     Running the included examples from a file.
-    #     DISABLED because it can't be run through testr, parallel testing
-    #     interferes with parallelism in code
-    #     """
-    #     df = pd.read_csv(os.path.join('tests', 'test_vacancies.csv'))
-    #     df = self.matcher.parallel_code_data_frame(
-    #         df,
-    #         title_column="job_title",
-    #         sector_column="job_sector",
-    #         description_column="job_description"
-    #         )
-    #     self.assertEqual(df['SOC_code'].to_list(), ['211', '242', '912'])
+    def test_shape_output(self):
+        """Multi output is laid out in fixed columns, with titles for codes"""
+        self.assertEqual(
+            self.isco_matcher.get_code_name("2111"), "Physicists and Astronomers"
+        )
+        self.assertEqual(self.isco_matcher.get_code_name("not a code"), "")
+
+        record_df = pd.DataFrame(
+            {"ISCO_code": ["2111", [["2631", "2120"], [90.0, 80.0]], [[], []]]}
+        )
+        shaped = self.isco_matcher.shape_output(record_df, width=3)
+        self.assertEqual(
+            list(shaped.columns),
+            [f"{name} {i}" for name in ["prediction", "title", "score"] for i in [1, 2, 3]],
+        )
+        self.assertEqual(shaped["prediction 1"].to_list(), ["2111", "2631", ""])
+        self.assertEqual(shaped["prediction 3"].to_list(), ["", "", ""])
+        self.assertEqual(shaped["title 1"].to_list()[0], "Physicists and Astronomers")
+        self.assertEqual(shaped["score 1"].to_list(), ["", 90.0, ""])
+
+    def test_multi_coder(self):
+        """Coding to several schemes at once matches coding to each in turn"""
+        columns = ["job_title", "job_sector", "job_description"]
+        multi = coder.MultiCoder(schemes=["soc", "isco"], output="multi")
+        coded = multi.code_data_frame(self.test_df.copy(), *columns)
+        for scheme, matcher in multi.coders.items():
+            expected = matcher.code_data_frame(self.test_df.copy(), *columns)
+            for column in expected.columns.drop(self.test_df.columns):
+                self.assertEqual(
+                    coded[f"{scheme.upper()}_{column}"].to_list(),
+                    expected[column].to_list(),
+                )
+        self.assertEqual(
+            multi.code_record("Physicist"),
+            {"soc": "211", "isco": "2111"},
+        )
+
+    def test_code_data_frame_chunks(self):
+        """Chunks are coded with the same columns as coding all records at once"""
+        columns = {
+            "title_column": "job_title",
+            "sector_column": "job_sector",
+            "description_column": "job_description",
+        }
+        full = self.isco_matcher.code_data_frame(self.test_df.copy(), **columns)
+        chunks = [self.test_df.iloc[[i]].copy() for i in range(len(self.test_df))]
+        output = io.StringIO()
+        with redirect_stdout(output):
+            coded = list(
+                self.matcher.code_data_frame_chunks(
+                    (chunk.copy() for chunk in chunks), deduplicate=True, **columns
+                )
+            )
+        # Messages about the run are printed once, not for every chunk
+        self.assertEqual(output.getvalue().count("Coding "), 2)
+        coded = list(self.isco_matcher.code_data_frame_chunks(chunks, **columns))
+        for chunk in coded:
+            self.assertEqual(list(chunk.columns), list(full.columns))
+        self.assertTrue(pd.concat(coded).equals(full))
+
+        # With workers, one pool codes every chunk, each split between them
+        pools = []
+
+        class CountingPool(ProcessPoolExecutor):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.tasks = 0
+                pools.append(self)
+
+            def submit(self, *args, **kwargs):
+                self.tasks += 1
+                return super().submit(*args, **kwargs)
+
+        big_df = self.test_df.sample(12, replace=True, random_state=0)
+        chunks = [big_df.iloc[start : start + 4].copy() for start in range(0, 12, 4)]
+        expected = self.isco_matcher.code_data_frame(
+            big_df.copy(), deduplicate=False, **columns
+        )
+        with mock.patch.object(coder, "ProcessPoolExecutor", CountingPool):
+            coded = list(
+                self.isco_matcher.code_data_frame_chunks(
+                    chunks, deduplicate=False, workers=2, **columns
+                )
+            )
+        self.assertEqual(len(pools), 1)
+        self.assertEqual(pools[0].tasks, 6)
+        self.assertTrue(pd.concat(coded).equals(expected))
+
+    def test_parallel_code_data_frame(self):
+        """Coding in worker processes gives the same output as in one process"""
+        df = pd.read_csv(files("oc3i.data") / "test_vacancies.csv")
+        big_df = df.sample(12, replace=True, random_state=0)
+        columns = ["job_title", "job_sector", "job_description"]
+        for matcher in [self.matcher, self.isco_matcher]:
+            expected = matcher._code_columns(big_df, *columns)
+            codes = matcher._code_parallel(big_df, *columns, workers=2, chunk_size=5)
+            self.assertEqual(codes.to_list(), expected.to_list())
+            self.assertTrue(codes.index.equals(big_df.index))
+
+        df = self.matcher.parallel_code_data_frame(
+            df,
+            title_column="job_title",
+            sector_column="job_sector",
+            description_column="job_description",
+            workers=2,
+        )
+        self.assertEqual(df["SOC_code"].to_list(), ["211", "242", "912"])
+
+    def test_worker_context(self):
+        """Workers are only forked on Linux or where fork was chosen, and are
+        otherwise spawned with what they need to load the model"""
+        real_get_context = multiprocessing.get_context
+
+        def spawn_default(method=None):
+            return real_get_context(method or "spawn")
+
+        with mock.patch.object(processes.sys, "platform", "linux"):
+            context, forks = processes.worker_context()
+        self.assertEqual((context.get_start_method(), forks), ("fork", True))
+
+        with mock.patch.object(processes.sys, "platform", "darwin"), mock.patch.object(
+            processes.multiprocessing, "get_start_method", return_value=None
+        ), mock.patch.object(processes.multiprocessing, "get_context", spawn_default):
+            context, forks = processes.worker_context()
+            self.assertEqual((context.get_start_method(), forks), ("spawn", False))
+
+            df = pd.read_csv(files("oc3i.data") / "test_vacancies.csv")
+            columns = ["job_title", "job_sector", "job_description"]
+            expected = self.isco_matcher._code_columns(df, *columns)
+            codes = self.isco_matcher._code_parallel(df, *columns, workers=2)
+            self.assertEqual(codes.to_list(), expected.to_list())
+
+        with mock.patch.object(processes.sys, "platform", "darwin"), mock.patch.object(
+            processes.multiprocessing, "get_start_method", return_value="fork"
+        ):
+            self.assertTrue(processes.worker_context()[1])
+
+    def test_stats(self):
+        """Stage counters, progress reports and stats from worker processes"""
+        df = pd.read_csv(files("oc3i.data") / "test_vacancies.csv")
+        big_df = df.sample(12, replace=True, random_state=0)
+        columns = ["job_title", "job_sector", "job_description"]
+        reports = []
+        self.isco_matcher.reset_stats()
+        self.isco_matcher.code_data_frame(
+            big_df.copy(),
+            *columns,
+            deduplicate=False,
+            progress=lambda *report: reports.append(report),
+        )
+        stats = self.isco_matcher.stats()
+        self.assertEqual(stats["records"], 12)
+        self.assertEqual(sum(stats["outcomes"].values()), 12)
+        self.assertEqual(stats["stages"]["clean"]["records"], 12)
+        self.assertEqual(
+            stats["stages"]["tfidf"]["records"], stats["outcomes"]["fuzzy"]
+        )
+        self.assertEqual(reports[-1][:2], (12, 12))
+        self.assertIn("fuzzy", coder.format_stats(stats))
+
+        self.isco_matcher.reset_stats()
+        reports = []
+        self.isco_matcher._code_parallel(
+            big_df, *columns, workers=2, chunk_size=5,
+            progress=lambda *report: reports.append(report),
+        )
+        self.assertEqual(self.isco_matcher.stats()["records"], 12)
+        self.assertEqual([report[0] for report in reports], [5, 10, 12])
+
+        self.isco_matcher.reset_stats()
+        self.isco_matcher.code_record("Physicist")
+        self.assertEqual(self.isco_matcher.stats()["outcomes"]["exact"], 1)
+
+    def test_server(self):
+        """The local coding service batches requests and matches code_record"""
+        titles = ["Physicist", "data scientist", "", "bus driver", "Economist"]
+
+        async def request(port, method, path, payload=None):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            body = json.dumps(payload).encode() if payload is not None else b""
+            writer.write(
+                f"{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            response = await reader.read()
+            writer.close()
+            head, _, body = response.partition(b"\r\n\r\n")
+            return int(head.split()[1]), json.loads(body)
+
+        async def run():
+            coding_server = server.CodingServer(self.isco_matcher, max_latency=0.05)
+            http_server = await coding_server.start(port=0)
+            port = http_server.sockets[0].getsockname()[1]
+            try:
+                responses = await asyncio.gather(
+                    *[request(port, "POST", "/code", {"title": t}) for t in titles]
+                )
+                health = await request(port, "GET", "/health")
+                bad = await request(port, "POST", "/code", {"sector": "IT"})
+                coding_server.max_queue = 1
+                busy = await request(port, "POST", "/code", [{"title": "a"}] * 2)
+            finally:
+                await coding_server.stop(http_server)
+            return responses, health, bad, busy
+
+        responses, health, bad, busy = asyncio.run(run())
+        expected = [self.isco_matcher.code_record(title) for title in titles]
+        self.assertEqual([body["code"] for _, body in responses], expected)
+        self.assertEqual(health[0], 200)
+        self.assertEqual(health[1]["scheme"], "isco")
+        self.assertEqual(
+            health[1]["dictionary_version"], self.isco_matcher.dictionary_version
+        )
+        # Concurrent requests are coded together
+        self.assertLess(health[1]["batches"], len(titles))
+        self.assertEqual(bad[0], 400)
+        self.assertEqual(busy[0], 503)
+
+    @unittest.skipIf(pa is None, "pyarrow is not installed")
+    def test_columnar_files(self):
+        """Parquet files are coded a row group at a time into typed columns"""
+        df = self.test_df.sample(10, replace=True, random_state=0)
+        df["id"] = range(len(df))
+        columns = ["job_title", "job_sector", "job_description"]
+        expected = self.isco_matcher.code_data_frame(
+            df.copy(), *columns, output_width=coder.MULTI_OUTPUT_WIDTH
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            in_file = Path(tmp) / "input.parquet"
+            out_file = Path(tmp) / "output.parquet"
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            pq.write_table(table, in_file, row_group_size=4)
+            columnar.code_file(self.isco_matcher, in_file, out_file, *columns)
+            coded = pq.read_table(out_file)
+
+        self.assertEqual(coded.num_rows, len(df))
+        # Columns not being coded pass through unchanged
+        self.assertTrue(coded.select(table.column_names).equals(table))
+        self.assertEqual(coded.schema.field("prediction 1").type, pa.string())
+        self.assertEqual(coded.schema.field("score 1").type, pa.float64())
+        coded_df = coded.to_pandas()
+        for column in ["prediction 1", "title 2", "score 3"]:
+            self.assertEqual(
+                coded_df[column].fillna("").to_list(), expected[column].to_list()
+            )
 
     def test_command_line(self):
         """Test code execution at command line"""
@@ -154,6 +783,215 @@ class TestOccupationcoder(unittest.TestCase):
         df = pd.read_csv("output.csv")
         self.assertEqual(df["SOC_code"].to_list(), [211, 242, 912])
 
+    def test_import_time(self):
+        """Test importing the package does not load the slow NLP libraries"""
+        # Run in a fresh interpreter, as this one has loaded everything already.
+        # What is loaded is checked rather than the time taken, which varies
+        # too much between machines
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys; import oc3i; "
+                "print(sorted({m.split('.')[0] for m in sys.modules}))",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        for module in ["pandas", "sklearn", "rapidfuzz", "nltk"]:
+            self.assertNotIn(f"'{module}'", result.stdout)
+
+        # The coder needs pandas, but not the NLP libraries
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys; import oc3i.coder; "
+                "print(sorted({m.split('.')[0] for m in sys.modules}))",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        for module in ["nltk", "sklearn", "rapidfuzz", "scipy"]:
+            self.assertNotIn(f"'{module}'", result.stdout)
+
+        # The cleaner alone does not need pandas either
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys; import oc3i.cleaner; "
+                "print(sorted({m.split('.')[0] for m in sys.modules}))",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        for module in ["nltk", "pandas"]:
+            self.assertNotIn(f"'{module}'", result.stdout)
+
+        # Nor does building a Cleaner load NLTK before there is text to clean
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys; from oc3i import cleaner; "
+                "print(cleaner.Cleaner(scheme='soc').advanced); "
+                "print(sorted({m.split('.')[0] for m in sys.modules}))",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+            # The Cleaner's dictionaries are found relative to the package
+            cwd=str(files("oc3i")),
+        )
+        advanced, modules = result.stdout.splitlines()
+        self.assertEqual(advanced, "True")
+        self.assertNotIn("'nltk'", modules)
+
+    def test_benchmark(self):
+        """Test synthetic data generation and per-stage benchmark timings"""
+        df = benchmark.synthetic_vacancies(1000, duplicate_rate=0.75, seed=1)
+        self.assertEqual(len(df), 1000)
+        self.assertLessEqual(len(df.drop_duplicates()), 250)
+        self.assertEqual(df["job_description"].str.split().str.len().max(), 30)
+        pd.testing.assert_frame_equal(
+            df, benchmark.synthetic_vacancies(1000, duplicate_rate=0.75, seed=1)
+        )
+
+        timings = benchmark.time_stages(self.matcher, df)
+        self.assertEqual(list(timings), benchmark.STAGES + ["total"])
+
+        report = {"results": [{"rows": 1000, "seconds": timings}]}
+        self.assertEqual(benchmark.compare_reports(report, report), [])
+        slower = {"results": [{"rows": 1000, "seconds": {"fuzzy": timings["fuzzy"] + 1}}]}
+        self.assertEqual(
+            [stage for _, stage, _, _ in benchmark.compare_reports(report, slower)],
+            ["fuzzy"],
+        )
+
+        latency = benchmark.time_single_records(self.matcher, df.head(50))
+        self.assertEqual(list(latency), ["p50", "p99", "mean"])
+        self.assertLessEqual(latency["p50"], latency["p99"])
+        report["latency"] = {"records": 50, "full": latency}
+        slower = {
+            "results": report["results"],
+            "latency": {"records": 50, "full": {**latency, "p99": latency["p99"] + 1}},
+        }
+        self.assertEqual(
+            [stage for _, stage, _, _ in benchmark.compare_reports(report, slower)],
+            ["latency full p99"],
+        )
+
+        threads = benchmark.time_threads(self.matcher, df.head(200), [1, 2])
+        self.assertEqual([entry["threads"] for entry in threads], [1, 2])
+        self.assertEqual(threads[0]["speedup"], 1.0)
+
+        ranking = benchmark.time_ranking(self.matcher, df.head(100), [1, 3])
+        buckets = len(self.matcher._model.codes)
+        self.assertEqual([entry["buckets"] for entry in ranking], [buckets, 3 * buckets])
+        self.assertTrue(all(0 < entry["density"] <= 1 for entry in ranking))
+
+    def test_benchmark_cleans_from_scratch(self):
+        """Every timed run cleans with empty token tables, not warm ones"""
+        # The known words and synonyms are found relative to the package
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(str(files("oc3i")))
+        matcher = coder.Coder(scheme="soc")
+        self.assertTrue(matcher.cl.advanced)
+        df = benchmark.synthetic_vacancies(50, seed=2)
+
+        calls = []
+        for _ in range(2):
+            with mock.patch.object(
+                cleaner.Cleaner,
+                "_normalise_token",
+                autospec=True,
+                side_effect=cleaner.Cleaner._normalise_token,
+            ) as normalise:
+                benchmark.time_stages(matcher, df)
+            calls.append(normalise.call_count)
+        self.assertGreater(calls[0], 0)
+        self.assertEqual(calls[0], calls[1])
+
+        matcher.cl.simple_clean("Physicist")
+        matcher.cl.reset()
+        self.assertEqual(matcher.cl._token_tables, {True: {}, False: {}})
+
+    def test_single_record_path(self):
+        """Test code_record gives the same results as coding a data frame"""
+        df = self.test_df.head(20)
+        coded = self.matcher.code_data_frame(
+            df,
+            title_column="job_title",
+            sector_column="job_sector",
+            description_column="job_description",
+        )
+        for record, code in zip(df.itertuples(), coded["SOC_code"]):
+            self.assertEqual(
+                self.matcher.code_record(
+                    record.job_title, record.job_sector, record.job_description
+                ),
+                code,
+            )
+
+    def test_threads(self):
+        """Test threaded coding, and one Coder coding from several threads"""
+        df = self.test_df.head(40)
+        expected = self.matcher.code_data_frame(
+            df.copy(),
+            title_column="job_title",
+            sector_column="job_sector",
+            description_column="job_description",
+        )
+        threaded = self.matcher.code_data_frame(
+            df.copy(),
+            title_column="job_title",
+            sector_column="job_sector",
+            description_column="job_description",
+            threads=2,
+        )
+        pd.testing.assert_frame_equal(threaded, expected)
+
+        renamed = df.rename(columns={"job_title": "title"})
+        titles_only = self.matcher.code_data_frame(renamed.copy(), title_column="title")
+        self.matcher.reset_stats()
+        self.matcher.code_data_frame(
+            df.copy(),
+            title_column="job_title",
+            sector_column="job_sector",
+            description_column="job_description",
+        )
+        self.matcher.code_data_frame(renamed.copy(), title_column="title")
+        records = self.matcher.stats()["records"]
+        self.matcher.reset_stats()
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futures = [
+                pool.submit(
+                    self.matcher.code_data_frame,
+                    df.copy(),
+                    title_column="job_title",
+                    sector_column="job_sector",
+                    description_column="job_description",
+                )
+                for _ in range(3)
+            ] + [
+                pool.submit(
+                    self.matcher.code_data_frame, renamed.copy(), title_column="title"
+                )
+                for _ in range(3)
+            ]
+        for future in futures[:3]:
+            pd.testing.assert_frame_equal(future.result(), expected)
+        for future in futures[3:]:
+            pd.testing.assert_frame_equal(future.result(), titles_only)
+        self.assertEqual(self.matcher.stats()["records"], 3 * records)
+
+        with self.assertRaises(ValueError):
+            self.matcher.code_data_frame(df.copy(), workers=2, threads=2)
+
     def manual_load_test(self):
         """
         Look at execution speed.